@@ -0,0 +1,99 @@
+"""LLM latency and final score of separate vs fused review and revision.
+
+Refines each prompt of a fixed set both ways, with the image and response
+caches off, then has the refine model score every chain's best image with
+the ordinary review, so that both modes are judged the same way. For
+example, with ComfyUI and Ollama running locally:
+
+    uv run python benchmarks/fused_review.py -o /tmp/fused --iterations 3
+"""
+
+import asyncio
+import statistics
+from pathlib import Path
+
+import click
+
+from perfect_prompt import metrics, pipeline, refine
+from perfect_prompt.generate import get_generator
+
+PROMPTS = [
+    "A robot holding a bouquet of sunflowers, standing in front of a crumbling brick wall covered in graffiti.",
+    "A red fox reading a newspaper on a park bench in the rain, under a yellow umbrella.",
+    "Three glass bottles on a windowsill: one blue, one green, one empty, with a cat's silhouette outside.",
+    "An astronaut planting tomatoes in a greenhouse on Mars, Earth visible through the roof.",
+    "A lighthouse made of stacked books on a cliff at sunset, seagulls made of paper.",
+]
+
+
+@click.command()
+@click.option(
+    "-o",
+    "--output-dir",
+    required=True,
+    type=click.Path(file_okay=False, path_type=Path),
+)
+@click.option("--prompt", "prompts", multiple=True, help="Replaces the built-in set")
+@click.option("--refine-model", default="ministral-3:14b", show_default=True)
+@click.option("--gen-model", default="comfyui-flux", show_default=True)
+@click.option("--iterations", default=3, show_default=True)
+def main(output_dir, prompts, refine_model, gen_model, iterations):
+    model = refine.get_refine_model(refine_model)
+    prompts = prompts or PROMPTS
+
+    click.echo(
+        f"{'mode':>8}  {'LLM calls':>9}  {'LLM s/iter':>10}  {'judged score':>12}"
+        f"  {'fallbacks':>9}"
+    )
+    for fused in [False, True]:
+        run_metrics = metrics.Metrics()
+        token = run_metrics.activate()
+        try:
+            histories = asyncio.run(
+                run(model, gen_model, prompts, output_dir, iterations, fused)
+            )
+        finally:
+            metrics.deactivate(token)
+
+        llm_seconds = [
+            iteration.llm_seconds for history in histories for iteration in history
+        ]
+        scores = []
+        for prompt, history in zip(prompts, histories, strict=True):
+            best = pipeline.best_image(history)
+            assert best is not None
+            text = refine.review_image(model, prompt, best.image_path)
+            if (score := refine.parse_review(text).score) is not None:
+                scores.append(score)
+        mean_score = f"{statistics.fmean(scores):.2f}" if scores else "-"
+        click.echo(
+            f"{'fused' if fused else 'separate':>8}"
+            f"  {run_metrics.counters.get('llm.calls', 0):>9}"
+            f"  {statistics.fmean(llm_seconds):>10.2f}  {mean_score:>12}"
+            f"  {run_metrics.counters.get('llm.fused_fallbacks', 0):>9}"
+        )
+
+
+async def run(model, gen_model, prompts, output_dir, iterations, fused):
+    output_dir.mkdir(parents=True, exist_ok=True)
+    scheduler = pipeline.Scheduler(get_generator(gen_model))
+    try:
+        # One chain at a time, so that LLM latency isn't inflated by queueing.
+        return [
+            await pipeline.refine_chain(
+                scheduler,
+                model,
+                prompt,
+                output_dir,
+                iterations=iterations,
+                fused=fused,
+                echo=lambda message: None,
+            )
+            for prompt in prompts
+        ]
+    finally:
+        await scheduler.aclose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""Review latency against review-image resolution.
+
+Reviews each image at every --max-side (0 means full resolution) with the
+refine model, bypassing the response cache, and prints the median latency and
+attachment size. For example, with Ollama running locally:
+
+    uv run python benchmarks/review_latency.py images/*.png \
+        --prompt "A robot holding a bouquet of sunflowers" --repeat 3
+"""
+
+import statistics
+import time
+from pathlib import Path
+
+import click
+
+from perfect_prompt import refine
+
+
+@click.command()
+@click.argument(
+    "images", nargs=-1, required=True, type=click.Path(exists=True, path_type=Path)
+)
+@click.option("--prompt", required=True, help="Prompt the images were generated from")
+@click.option("--refine-model", default="ministral-3:14b", show_default=True)
+@click.option(
+    "--max-side",
+    "max_sides",
+    multiple=True,
+    type=int,
+    default=[0, 1536, 1024, 768, 512],
+    show_default=True,
+)
+@click.option(
+    "--format",
+    "image_format",
+    default="png",
+    show_default=True,
+    type=click.Choice(list(refine.REVIEW_IMAGE_FORMATS)),
+)
+@click.option("--quality", default=85, show_default=True)
+@click.option("--repeat", default=1, show_default=True)
+def main(images, prompt, refine_model, max_sides, image_format, quality, repeat):
+    model = refine.get_refine_model(refine_model)
+    # Load the model before timing anything.
+    refine.review_image(model, prompt, images[0])
+
+    click.echo(f"{'max side':>8}  {'KB':>8}  {'median s':>8}  {'score':>5}")
+    for max_side in max_sides:
+        settings = refine.ReviewImageSettings(max_side or None, image_format, quality)
+        seconds = []
+        sizes = []
+        scores = []
+        for image in images:
+            content, _ = refine.encode_review_image(image.read_bytes(), settings)
+            sizes.append(len(content))
+            for _ in range(repeat):
+                start = time.perf_counter()
+                text = refine.review_image(
+                    model, prompt, image, image_settings=settings
+                )
+                seconds.append(time.perf_counter() - start)
+                scores.append(refine.parse_review(text).score)
+        known = [score for score in scores if score is not None]
+        mean_score = f"{statistics.fmean(known):.1f}" if known else "-"
+        click.echo(
+            f"{max_side or 'full':>8}  {statistics.fmean(sizes) / 1024:>8.0f}"
+            f"  {statistics.median(seconds):>8.2f}  {mean_score:>5}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""Revision prompt size and latency per iteration for each --history strategy.
+
+Runs a chain of revisions with the refine model, feeding each revised prompt
+back in with a canned review (no images are rendered), and prints the size
+of each revision prompt, the input tokens the model reports, and the latency.
+With --dry-run, no model is called and only prompt sizes are printed. For
+example, with Ollama running locally:
+
+    uv run python benchmarks/revision_history.py \
+        --prompt "A robot holding a bouquet of sunflowers" --iterations 10
+"""
+
+import time
+
+import click
+
+from perfect_prompt import refine
+
+CRITIQUE = (
+    "The composition is balanced and the lighting is convincing, but the "
+    "image drifts from the prompt in several places. Secondary elements are "
+    "rendered generically, the background lacks the described detail, and "
+    "the overall style is more photographic than the prompt suggests. "
+) * 2
+
+
+def canned_review(iteration: int) -> str:
+    return str(
+        refine.Review(
+            score=4 + iteration * 3 % 6,
+            critique=CRITIQUE,
+            present=["main subject", "lighting"],
+            missing=["background detail", "style"],
+            structured=True,
+        )
+    )
+
+
+@click.command()
+@click.option("--prompt", required=True, help="Intent to refine")
+@click.option("--refine-model", default="ministral-3:14b", show_default=True)
+@click.option("--iterations", default=8, show_default=True)
+@click.option(
+    "--strategy",
+    "strategies",
+    multiple=True,
+    type=click.Choice(list(refine.HISTORY_STRATEGIES)),
+    default=list(refine.HISTORY_STRATEGIES),
+    show_default=True,
+)
+@click.option("--history-size", default=3, show_default=True)
+@click.option("--dry-run", is_flag=True, help="Only measure prompt sizes")
+def main(prompt, refine_model, iterations, strategies, history_size, dry_run):
+    model = None if dry_run else refine.get_refine_model(refine_model)
+
+    click.echo(f"{'strategy':>8}  {'iter':>4}  {'chars':>6}  {'tokens':>6}  {'s':>6}")
+    for strategy in strategies:
+        history = refine.HistorySettings(strategy, history_size)
+        attempts = []
+        current_prompt = prompt
+        total_chars = total_tokens = total_seconds = 0
+        for i in range(iterations):
+            review = canned_review(i)
+            revision_prompt = refine.create_revision_prompt(
+                prompt, current_prompt, review, attempts, history
+            )
+            attempts.append((current_prompt, review))
+            tokens = seconds = None
+            if model is None:
+                current_prompt = f"{prompt}, variation {i + 1}"
+            else:
+                start = time.perf_counter()
+                response = model.prompt(revision_prompt)
+                current_prompt = response.text().strip()
+                seconds = time.perf_counter() - start
+                tokens = response.usage().input
+                total_seconds += seconds
+                total_tokens += tokens or 0
+            total_chars += len(revision_prompt)
+            click.echo(
+                f"{strategy:>8}  {i + 1:>4}  {len(revision_prompt):>6}"
+                f"  {tokens if tokens is not None else '-':>6}"
+                f"  {f'{seconds:.2f}' if seconds is not None else '-':>6}"
+            )
+        click.echo(
+            f"{strategy:>8}  {'all':>4}  {total_chars:>6}"
+            f"  {total_tokens if model else '-':>6}"
+            f"  {f'{total_seconds:.2f}' if model else '-':>6}"
+        )
+
+
+if __name__ == "__main__":
+    main()
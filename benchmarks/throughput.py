@@ -0,0 +1,489 @@
+"""Throughput, per-stage latency and memory of `perfect-prompt batch`.
+
+Runs the batch command against simulated backends, in a fresh process for
+every combination of --iterations, --prompts and --concurrency. The refine
+model is an `llm` plugin, and images come from an in-process generator
+(--backend sim), from --servers local stand-ins for ComfyUI (--backend
+comfyui), or from a stand-in for the Flux API (--backend bfl). Every answer
+and image takes a log-normal time around its median (--llm-latency,
+--gen-latency; --jitter is the sigma of its log) and fails with the given
+probability. Each simulated GPU renders one image at a time.
+
+Prints iterations per second, p50/p99 latency of the main stages (every
+stage's is in the JSON), the fraction of the run the GPUs were idle, and peak
+RSS. Results are written to --output as JSON; pass an earlier file as
+--baseline to compare against it. For example:
+
+    uv run python benchmarks/throughput.py --backend comfyui --servers 2 \
+        --prompts 1 --prompts 16 --concurrency 1 --concurrency 8 \
+        -o after.json --baseline before.json
+"""
+
+import asyncio
+import contextlib
+import io
+import itertools
+import json
+import math
+import os
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from unittest import mock
+
+import click
+import llm
+
+from perfect_prompt import cli
+from perfect_prompt.generate import ImageGenerator, write_output_image
+
+# The HTTP stand-ins are shared with the tests.
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "tests"))
+from fake_bfl import FakeBFL  # noqa: E402
+from fake_comfyui import FakeComfyUI, make_png  # noqa: E402
+
+BACKENDS = ("sim", "comfyui", "bfl")
+# Shown in the table; the JSON has every stage.
+STAGES = ("generate", "review", "revise")
+
+
+@dataclass(frozen=True)
+class Latency:
+    median: float
+    jitter: float
+    failure_rate: float
+
+    def seconds(self, rng: random.Random) -> float:
+        return self.median * math.exp(rng.gauss(0, self.jitter))
+
+    def fails(self, rng: random.Random) -> bool:
+        return rng.random() < self.failure_rate
+
+
+class Device:
+    """A simulated GPU, which renders one image at a time."""
+
+    def __init__(self):
+        self.busy_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def render(self, latency: Latency, rng: random.Random) -> None:
+        seconds = latency.seconds(rng)
+        with self._lock:
+            time.sleep(seconds)
+            self.busy_seconds += seconds
+        if latency.fails(rng):
+            raise RuntimeError("simulated render failure")
+
+
+class SimulatedGenerator(ImageGenerator):
+    def __init__(self, device: Device, latency: Latency, rng: random.Random):
+        self.device = device
+        self.latency = latency
+        self.rng = rng
+        self.image = make_png()
+
+    @property
+    def model_name(self) -> str:
+        return "simulated"
+
+    async def agenerate_image(self, prompt: str, output_dir: Path, **kwargs) -> Path:
+        await asyncio.to_thread(self.device.render, self.latency, self.rng)
+        return write_output_image(output_dir, self.model_name, self.image)
+
+    async def afree_memory(self) -> None:
+        pass
+
+    async def aclose(self) -> None:
+        pass
+
+
+class Simulation:
+    """Answers for the simulated refine model.
+
+    At most ``parallel`` answers are produced at once, like a local server
+    (e.g. OLLAMA_NUM_PARALLEL).
+    """
+
+    def __init__(self, latency: Latency, parallel: int, rng: random.Random):
+        self.latency = latency
+        self.parallel = parallel
+        self.rng = rng
+        self.slots = threading.Semaphore(parallel)
+        self.async_slots: asyncio.Semaphore | None = None
+
+    def answer(self, prompt: llm.Prompt) -> tuple[float, list[str]]:
+        if self.latency.fails(self.rng):
+            raise llm.ModelError("simulated LLM failure")
+        if prompt.attachments:
+            text = (
+                "Present: subject, lighting\nMissing: background\n"
+                f"Score: {self.rng.randint(1, 10)}/10"
+            )
+        else:
+            text = f"A simulated scene, revision {self.rng.getrandbits(32):08x}"
+        return self.latency.seconds(self.rng), text.split(" ")
+
+
+class Options(llm.Options):
+    temperature: float | None = None
+
+
+class SimulatedModel(llm.Model):
+    model_id = "simulated"
+    can_stream = True
+    attachment_types = {"image/png"}
+    Options = Options  # type: ignore[assignment]
+
+    def __init__(self, simulation: Simulation):
+        self.simulation = simulation
+
+    def execute(self, prompt, stream, response, conversation):
+        seconds, words = self.simulation.answer(prompt)
+        with self.simulation.slots:
+            time.sleep(seconds)
+        for i, word in enumerate(words):
+            yield word if i == 0 else f" {word}"
+
+
+class SimulatedAsyncModel(llm.AsyncModel):
+    model_id = "simulated"
+    can_stream = True
+    attachment_types = {"image/png"}
+    Options = Options  # type: ignore[assignment]
+
+    def __init__(self, simulation: Simulation):
+        self.simulation = simulation
+
+    async def execute(self, prompt, stream, response, conversation):
+        simulation = self.simulation
+        if simulation.async_slots is None:
+            simulation.async_slots = asyncio.Semaphore(simulation.parallel)
+        seconds, words = simulation.answer(prompt)
+        async with simulation.async_slots:
+            await asyncio.sleep(seconds)
+        for i, word in enumerate(words):
+            yield word if i == 0 else f" {word}"
+
+
+class SimulatedPlugin:
+    def __init__(self, simulation: Simulation):
+        self.simulation = simulation
+
+    @llm.hookimpl
+    def register_models(self, register):
+        register(SimulatedModel(self.simulation), SimulatedAsyncModel(self.simulation))
+
+
+def percentiles(values: list[float]) -> dict:
+    if len(values) == 1:
+        return {"count": 1, "p50": values[0], "p99": values[0]}
+    quantiles = statistics.quantiles(values, n=100, method="inclusive")
+    return {"count": len(values), "p50": quantiles[49], "p99": quantiles[98]}
+
+
+def run_once(config: dict) -> dict:
+    rng = random.Random(config["seed"])
+    gen_latency = Latency(**config["gen"])
+    simulation = Simulation(Latency(**config["llm"]), config["llm_parallel"], rng)
+    llm.get_plugins()  # Loads the installed plugins first.
+    llm.plugins.pm.register(SimulatedPlugin(simulation), name="simulated")
+
+    with tempfile.TemporaryDirectory() as tmp, contextlib.ExitStack() as stack:
+        work_dir = Path(tmp)
+        manifest = work_dir / "prompts.jsonl"
+        manifest.write_text(
+            "".join(
+                json.dumps({"prompt": f"A simulated scene number {i}"}) + "\n"
+                for i in range(config["prompts"])
+            )
+        )
+        trace = work_dir / "trace.jsonl"
+        args = [
+            "batch",
+            str(manifest),
+            "-o",
+            str(work_dir / "images"),
+            "--iterations",
+            str(config["iterations"]),
+            "--concurrency",
+            str(config["concurrency"]),
+            "--refine-model",
+            "simulated",
+            "--no-cache",
+            "--trace",
+            str(trace),
+        ]
+        for option in ["llm_concurrency", "workers"]:
+            if config[option] is not None:
+                args += [f"--{option.replace('_', '-')}", str(config[option])]
+
+        devices = []
+        if config["backend"] == "sim":
+            devices.append(Device())
+            generator = SimulatedGenerator(devices[0], gen_latency, rng)
+            stack.enter_context(
+                mock.patch(
+                    "perfect_prompt.session.get_generator",
+                    lambda model, **kwargs: generator,
+                )
+            )
+        elif config["backend"] == "comfyui":
+            for _ in range(config["servers"]):
+                device = Device()
+                devices.append(device)
+                server = stack.enter_context(
+                    FakeComfyUI(
+                        render=lambda workflow, device=device: device.render(
+                            gen_latency, rng
+                        )
+                    )
+                )
+                args += ["--comfyui-url", server.url]
+        else:
+            server = stack.enter_context(
+                FakeBFL(
+                    failure_rate=gen_latency.failure_rate,
+                    failure_status=503,
+                    render_seconds=lambda: gen_latency.seconds(rng),
+                )
+            )
+            stack.enter_context(
+                mock.patch.dict(
+                    os.environ, {"BFL_API_URL": server.url, "BFL_API_KEY": "simulated"}
+                )
+            )
+            args += ["--gen-model", "flux-dev"]
+
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            cli.cli.main(args, standalone_mode=False)
+        total_seconds = time.perf_counter() - start
+
+        records = [
+            json.loads(line)
+            for line in (work_dir / "images" / "results.jsonl").read_text().splitlines()
+        ]
+        # The spans are the first of the trace file's two OTLP requests.
+        traces = json.loads(trace.read_text().splitlines()[0])
+        spans = traces["resourceSpans"][0]["scopeSpans"][0]["spans"]
+
+    durations = {}
+    for span in spans:
+        duration = int(span["endTimeUnixNano"]) - int(span["startTimeUnixNano"])
+        durations.setdefault(span["name"], []).append(duration / 1e9)
+    # Throughput is measured over the batch loop; setting up the session (and
+    # loading every llm plugin) is reported separately.
+    (seconds,) = durations.pop("batch")
+    iterations = sum(
+        len(record["timings"]["iterations"])
+        for record in records
+        if "error" not in record
+    )
+    # Kilobytes on Linux, bytes on macOS.
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        peak_rss *= 1024
+    return {
+        "seconds": seconds,
+        "startup_seconds": total_seconds - seconds,
+        "iterations": iterations,
+        "iterations_per_second": iterations / seconds,
+        "failed_prompts": sum("error" in record for record in records),
+        "errors": sorted({record["error"] for record in records if "error" in record}),
+        "stages": {
+            name: percentiles(values) for name, values in sorted(durations.items())
+        },
+        "peak_rss_mb": peak_rss / 1024**2,
+        # The Flux API's GPUs aren't ours to keep busy.
+        "device_idle_fraction": (
+            1 - sum(device.busy_seconds for device in devices) / len(devices) / seconds
+            if devices
+            else None
+        ),
+    }
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=Path(__file__).parent,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@click.command()
+@click.option(
+    "--backend", default="sim", show_default=True, type=click.Choice(BACKENDS)
+)
+@click.option("--servers", default=1, show_default=True, help="ComfyUI stand-ins")
+@click.option(
+    "--iterations",
+    "iteration_counts",
+    multiple=True,
+    type=int,
+    default=[3],
+    show_default=True,
+)
+@click.option(
+    "--prompts",
+    "prompt_counts",
+    multiple=True,
+    type=int,
+    default=[1, 8],
+    show_default=True,
+)
+@click.option(
+    "--concurrency",
+    "concurrencies",
+    multiple=True,
+    type=int,
+    default=[1, 4],
+    show_default=True,
+    help="Prompts refined at once",
+)
+@click.option("--llm-concurrency", type=int, help="Passed on to the batch command")
+@click.option("--workers", type=int, help="Passed on to the batch command")
+@click.option("--gen-latency", default=0.5, show_default=True)
+@click.option("--llm-latency", default=0.2, show_default=True)
+@click.option("--jitter", default=0.3, show_default=True)
+@click.option("--gen-failure-rate", default=0.0, show_default=True)
+@click.option("--llm-failure-rate", default=0.0, show_default=True)
+@click.option(
+    "--llm-parallel",
+    default=4,
+    show_default=True,
+    help="Answers the simulated refine model produces at once",
+)
+@click.option("--seed", default=0, show_default=True)
+@click.option(
+    "-o",
+    "--output",
+    type=click.Path(dir_okay=False, path_type=Path),
+    help="JSON file for the results",
+)
+@click.option(
+    "--baseline",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    help="Results of an earlier run to compare with",
+)
+@click.option("--worker", hidden=True, help="Run one configuration (JSON)")
+def main(
+    backend,
+    servers,
+    iteration_counts,
+    prompt_counts,
+    concurrencies,
+    llm_concurrency,
+    workers,
+    gen_latency,
+    llm_latency,
+    jitter,
+    gen_failure_rate,
+    llm_failure_rate,
+    llm_parallel,
+    seed,
+    output,
+    baseline,
+    worker,
+):
+    if worker:
+        result = run_once(json.loads(worker))
+        output.write_text(json.dumps(result))
+        return
+
+    baseline_runs = {}
+    if baseline:
+        for run in json.loads(baseline.read_text())["runs"]:
+            baseline_runs[json.dumps(run["config"], sort_keys=True)] = run
+
+    click.echo(
+        f"{'prompts':>7}  {'iters':>5}  {'conc':>4}  {'it/s':>6}"
+        + "".join(f"  {stage + ' p50/p99':>18}" for stage in STAGES)
+        + f"  {'idle':>5}  {'RSS MB':>6}  {'failed':>6}"
+        + ("  vs baseline" if baseline else "")
+    )
+    runs = []
+    for iterations, prompts, concurrency in itertools.product(
+        iteration_counts, prompt_counts, concurrencies
+    ):
+        config = {
+            "backend": backend,
+            "servers": servers,
+            "iterations": iterations,
+            "prompts": prompts,
+            "concurrency": concurrency,
+            "llm_concurrency": llm_concurrency,
+            "workers": workers,
+            "gen": asdict(Latency(gen_latency, jitter, gen_failure_rate)),
+            "llm": asdict(Latency(llm_latency, jitter, llm_failure_rate)),
+            "llm_parallel": llm_parallel,
+            "seed": seed,
+        }
+        # A fresh process per run, so that peak RSS is the run's own.
+        with tempfile.TemporaryDirectory() as tmp:
+            result_path = Path(tmp) / "result.json"
+            process = subprocess.run(
+                [
+                    sys.executable,
+                    __file__,
+                    "--worker",
+                    json.dumps(config),
+                    "--output",
+                    str(result_path),
+                ],
+                capture_output=True,
+                text=True,
+            )
+            if process.returncode != 0:
+                raise click.ClickException(process.stderr)
+            result = json.loads(result_path.read_text())
+        runs.append({"config": config, **result})
+
+        stages = result["stages"]
+        line = f"{prompts:>7}  {iterations:>5}  {concurrency:>4}"
+        line += f"  {result['iterations_per_second']:>6.2f}"
+        for stage in STAGES:
+            latency = (
+                f"{stages[stage]['p50']:.2f}/{stages[stage]['p99']:.2f}"
+                if stage in stages
+                else "-"
+            )
+            line += f"  {latency:>18}"
+        idle = result["device_idle_fraction"]
+        line += f"  {'-' if idle is None else f'{idle:.0%}':>5}"
+        line += f"  {result['peak_rss_mb']:>6.0f}  {result['failed_prompts']:>6}"
+        before = baseline_runs.get(json.dumps(config, sort_keys=True))
+        if before:
+            change = result["iterations_per_second"] / before["iterations_per_second"]
+            line += f"  {change - 1:>+11.0%}"
+        click.echo(line)
+
+    if output:
+        output.write_text(
+            json.dumps(
+                {
+                    "commit": git_commit(),
+                    "python": platform.python_version(),
+                    "runs": runs,
+                },
+                indent=2,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
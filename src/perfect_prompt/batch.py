@@ -0,0 +1,151 @@
+import asyncio
+import csv
+import json
+import time
+from collections.abc import Callable, Iterable, Iterator
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TextIO
+
+import llm
+
+from . import pipeline
+from .journal import NULL_JOURNAL, Journal
+
+
+@dataclass
+class ManifestEntry:
+    id: str
+    prompt: str
+    # Why the entry can't be run, if its line was malformed or had no prompt.
+    error: str | None = None
+
+
+def read_manifest(path: Path) -> Iterator[ManifestEntry]:
+    # Entries are streamed so that arbitrarily large manifests use constant
+    # memory. CSV manifests need a "prompt" column; JSONL lines are objects with
+    # a "prompt" key. Both may give an "id", which defaults to the entry number.
+    # A bad entry is yielded with an error rather than ending the batch.
+    with path.open(newline="", encoding="utf-8") as f:
+        if path.suffix.lower() == ".csv":
+            rows: Iterable[dict | str] = csv.DictReader(f)
+        else:
+            rows = (line for line in f if line.strip())
+        for number, row in enumerate(rows, start=1):
+            if isinstance(row, str):
+                try:
+                    row = json.loads(row)
+                except ValueError as e:
+                    error = f"{path}: entry {number} is not valid JSON: {e}"
+                    yield ManifestEntry(str(number), "", error)
+                    continue
+            if not isinstance(row, dict):
+                error = f"{path}: entry {number} is not a JSON object"
+                yield ManifestEntry(str(number), "", error)
+                continue
+            entry_id = str(row.get("id") or number)
+            prompt = str(row.get("prompt") or "").strip()
+            if not prompt:
+                error = f"{path}: entry {number} has no prompt"
+                yield ManifestEntry(entry_id, "", error)
+                continue
+            yield ManifestEntry(entry_id, prompt)
+
+
+def result_record(
+    entry: ManifestEntry, history: list[pipeline.Iteration], seconds: float
+) -> dict:
+    attempts = [
+        {
+            "iteration": i + 1,
+            "prompt": candidate.prompt,
+            "seed": candidate.seed,
+            "batch_index": candidate.batch_index,
+            "image_path": str(candidate.image_path),
+            "review": candidate.review,
+            "score": candidate.score,
+            "present": candidate.present,
+            "missing": candidate.missing,
+            "selected": candidate is iteration.best,
+        }
+        for i, iteration in enumerate(history)
+        for candidate in iteration.candidates
+    ]
+    best = pipeline.best_image(history)
+    # In draft mode, the best prompt was rendered again at full quality.
+    rendered = (history[-1].final if history else None) or best
+    return {
+        "id": entry.id,
+        "prompt": entry.prompt,
+        "final_prompt": best.prompt if best else None,
+        "final_image_path": str(rendered.image_path) if rendered else None,
+        "final_score": best.score if best else None,
+        "next_prompt": (
+            history[-1].refined_prompts[0]
+            if history and history[-1].refined_prompts
+            else None
+        ),
+        "attempts": attempts,
+        "timings": {
+            "total_seconds": round(seconds, 3),
+            "iterations": [
+                {
+                    "generate_seconds": round(iteration.generate_seconds, 3),
+                    "llm_seconds": round(iteration.llm_seconds, 3),
+                }
+                for iteration in history
+            ],
+        },
+    }
+
+
+async def run_batch(
+    entries: Iterable[ManifestEntry],
+    results: TextIO,
+    scheduler: pipeline.Scheduler,
+    model: llm.Model,
+    output_dir: Path,
+    *,
+    concurrency: int,
+    on_result: Callable[[dict], None] = lambda record: None,
+    journal: Journal | None = None,
+    **chain_kwargs,
+) -> None:
+    # A fixed pool of workers pulls from the shared iterator, so only
+    # `concurrency` prompts are held in memory at once. Records are written in
+    # completion order as soon as each prompt finishes.
+    entry_iter = iter(entries)
+
+    async def worker():
+        for entry in entry_iter:
+            if journal is not None and journal.is_done(entry.id):
+                continue
+            start = time.perf_counter()
+            chain_journal = NULL_JOURNAL
+            try:
+                if entry.error is not None:
+                    raise ValueError(entry.error)
+                if journal is not None:
+                    chain_journal = journal.chain(entry.id, entry.prompt)
+                history = await pipeline.refine_chain(
+                    scheduler,
+                    model,
+                    entry.prompt,
+                    output_dir,
+                    echo=lambda message: None,
+                    journal=chain_journal,
+                    **chain_kwargs,
+                )
+            except Exception as e:
+                record = {"id": entry.id, "prompt": entry.prompt, "error": repr(e)}
+            else:
+                record = result_record(entry, history, time.perf_counter() - start)
+            results.write(json.dumps(record) + "\n")
+            results.flush()
+            if "error" not in record:
+                # Only after its record is written, so a resumed batch never
+                # skips a prompt whose result was lost.
+                await chain_journal.finish()
+            on_result(record)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
@@ -0,0 +1,158 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+
+def default_cache_dir() -> Path:
+    cache_home = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(cache_home) / "perfect-prompt"
+
+
+def cache_key(*parts) -> str:
+    data = json.dumps(parts, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class ImageCache:
+    """Content-addressed store of rendered images with LRU eviction.
+
+    Images live in ``directory`` as ``<key>.png``. A small SQLite index keeps
+    each entry's size and last use so that eviction never has to scan the
+    directory.
+    """
+
+    def __init__(self, directory: Path, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        directory.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            directory / "index.sqlite", check_same_thread=False, isolation_level=None
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS images"
+            " (key TEXT PRIMARY KEY, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.png"
+
+    def get(self, key: str) -> bytes | None:
+        with self._lock:
+            try:
+                image_bytes = self._path(key).read_bytes()
+            except FileNotFoundError:
+                self._db.execute("DELETE FROM images WHERE key = ?", (key,))
+                self.misses += 1
+                return None
+            self._db.execute(
+                "UPDATE images SET last_used = ? WHERE key = ?", (time.time(), key)
+            )
+            self.hits += 1
+            return image_bytes
+
+    def put(self, key: str, image_bytes: bytes) -> None:
+        if len(image_bytes) > self.max_bytes:
+            return
+        with self._lock:
+            path = self._path(key)
+            tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+            tmp_path.write_bytes(image_bytes)
+            os.replace(tmp_path, path)
+            self._db.execute(
+                "INSERT OR REPLACE INTO images VALUES (?, ?, ?)",
+                (key, len(image_bytes), time.time()),
+            )
+            self._evict()
+
+    def _evict(self) -> None:
+        (total,) = self._db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM images"
+        ).fetchone()
+        if total <= self.max_bytes:
+            return
+        for key, size in self._db.execute(
+            "SELECT key, size FROM images ORDER BY last_used"
+        ).fetchall():
+            self._path(key).unlink(missing_ok=True)
+            self._db.execute("DELETE FROM images WHERE key = ?", (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def close(self) -> None:
+        self._db.close()
+
+
+class ResponseCache:
+    """Persistent memo of LLM responses in SQLite.
+
+    Entries older than ``ttl`` seconds are treated as misses, and the least
+    recently used entries are evicted once the stored text exceeds
+    ``max_bytes``.
+    """
+
+    def __init__(self, path: Path, max_bytes: int, ttl: float | None = None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL, size INTEGER NOT NULL, created REAL NOT NULL,"
+            " last_used REAL NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)"
+        )
+
+    def get(self, key: str) -> str | None:
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or (self.ttl is not None and row[1] < now - self.ttl):
+                self.misses += 1
+                return None
+            self._db.execute(
+                "UPDATE responses SET last_used = ? WHERE key = ?", (now, key)
+            )
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, value: str) -> None:
+        now = time.time()
+        size = len(value.encode("utf-8"))
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (key, value, size, now, now),
+            )
+            if self.ttl is not None:
+                self._db.execute(
+                    "DELETE FROM responses WHERE created < ?", (now - self.ttl,)
+                )
+            (total,) = self._db.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+            if total > self.max_bytes:
+                # Drop the least recently used entries until back under budget.
+                self._db.execute(
+                    "DELETE FROM responses WHERE key IN (SELECT key FROM ("
+                    " SELECT key, SUM(size) OVER (ORDER BY last_used DESC) AS kept"
+                    " FROM responses) WHERE kept > ?)",
+                    (self.max_bytes,),
+                )
+
+    def close(self) -> None:
+        self._db.close()
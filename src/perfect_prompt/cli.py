@@ -1,140 +1,496 @@
 from pathlib import Path
 
 import click
+from click_default_group import DefaultGroup
 
-from . import refine
-from .generate import get_generator
+from . import metrics, refine
+from .cache import default_cache_dir
 
+GEN_MODELS = [
+    "comfyui-flux",
+    "comfyui-flux-krea",
+    "comfyui-z-image-turbo",
+    "flux-pro-1.1-ultra",
+    "flux-pro-1.1",
+    "flux-pro",
+    "flux-dev",
+    "flux-2-max",
+    "flux-2-pro",
+    "flux-2-flex",
+]
 
-@click.command()
+
+def parse_size(ctx, param, value):
+    if value is None:
+        return None
+    try:
+        width, height = (int(side) for side in value.lower().split("x"))
+    except ValueError:
+        raise click.BadParameter("expected WIDTHxHEIGHT, e.g. 608x416") from None
+    if width <= 0 or height <= 0:
+        raise click.BadParameter("width and height must be positive")
+    return width, height
+
+
+RUN_OPTIONS = [
+    click.option(
+        "-o",
+        "--output-dir",
+        required=True,
+        type=click.Path(writable=True, path_type=Path),
+        help="Directory where final images will be saved",
+    ),
+    click.option(
+        "--iterations",
+        "-n",
+        default=3,
+        show_default=True,
+        help="Number of refinement iterations",
+    ),
+    click.option(
+        "--refine-model",
+        default="ministral-3:14b",
+        show_default=True,
+        help="Model to use for refining prompts",
+    ),
+    click.option(
+        "--gen-model",
+        default="comfyui-flux",
+        show_default=True,
+        type=click.Choice(GEN_MODELS),
+        help="Model to use for generating images",
+    ),
+    click.option(
+        "--draft-model",
+        type=click.Choice(GEN_MODELS),
+        help="Render while refining with this model, then only the best prompt with --gen-model",
+    ),
+    click.option(
+        "--draft-steps",
+        type=click.IntRange(min=1),
+        help="Render while refining with this many sampling steps (ComfyUI), then only the best prompt at full quality",
+    ),
+    click.option(
+        "--draft-size",
+        metavar="WxH",
+        callback=parse_size,
+        help="Render while refining at this size (ComfyUI), then only the best prompt at full size",
+    ),
+    click.option(
+        "--comfyui-url",
+        "comfyui_urls",
+        multiple=True,
+        default=["http://127.0.0.1:8000"],
+        show_default=True,
+        help="ComfyUI server; repeat to spread jobs over several servers",
+    ),
+    click.option(
+        "--pin-comfyui-server",
+        "pin_comfyui",
+        is_flag=True,
+        help="With several --comfyui-url servers, run each prompt's whole refine chain on one server",
+    ),
+    click.option(
+        "--bfl-concurrency",
+        default=24,
+        show_default=True,
+        type=click.IntRange(min=1),
+        help="Maximum Flux API tasks in flight at once",
+    ),
+    click.option(
+        "--bfl-rps",
+        default=10.0,
+        show_default=True,
+        type=click.FloatRange(min=0, min_open=True),
+        help="Maximum Flux API requests per second, including polls",
+    ),
+    click.option(
+        "--bfl-timeout",
+        default=600.0,
+        show_default=True,
+        type=click.FloatRange(min=0, min_open=True),
+        help="Seconds to wait for a Flux API image before giving up",
+    ),
+    click.option(
+        "--comfyui-output-dir",
+        hidden=True,
+        type=click.Path(path_type=Path),
+        help="Deprecated: images are now fetched from the ComfyUI server",
+    ),
+    click.option(
+        "--raw",
+        is_flag=True,
+        help="Request raw-style image from the Flux API",
+    ),
+    click.option(
+        "--review-temperature",
+        type=float,
+        help="Temperature setting for the review prompt",
+    ),
+    click.option(
+        "--refine-temperature",
+        type=float,
+        help="Temperature setting for the refine prompt",
+    ),
+    click.option(
+        "--fused-review",
+        "fused",
+        is_flag=True,
+        help="Ask for the review and the next prompt in one LLM call per image, falling back to separate calls if the answer can't be parsed",
+    ),
+    click.option(
+        "--history",
+        default="all",
+        show_default=True,
+        type=click.Choice(list(refine.HISTORY_STRATEGIES)),
+        help="Previous attempts to show the refine model: all of them, the latest --history-size, the best-scoring --history-size, or a summary of all with the latest --history-size in full",
+    ),
+    click.option(
+        "--history-size",
+        default=3,
+        show_default=True,
+        type=click.IntRange(min=1),
+        help="Attempts shown in full with --history last, best or summary",
+    ),
+    click.option(
+        "--similarity-threshold",
+        default=0.9,
+        show_default=True,
+        type=click.FloatRange(0, 1),
+        help="Ask again for revisions at least this similar to a prompt already tried (1 only catches changes of case, punctuation and clause order)",
+    ),
+    click.option(
+        "--review-max-side",
+        type=click.IntRange(min=64),
+        help="Scale images down to at most this many pixels on the longest side before review",
+    ),
+    click.option(
+        "--review-format",
+        default="png",
+        show_default=True,
+        type=click.Choice(list(refine.REVIEW_IMAGE_FORMATS)),
+        help="Image format sent to the refine model",
+    ),
+    click.option(
+        "--review-quality",
+        default=85,
+        show_default=True,
+        type=click.IntRange(1, 100),
+        help="Quality for --review-format jpeg or webp",
+    ),
+    click.option(
+        "--ollama-keep-alive",
+        metavar="DURATION",
+        help="Preload an Ollama refine model at startup and keep it loaded for this long after each review (e.g. 30m)",
+    ),
+    click.option(
+        "--free-vram",
+        is_flag=True,
+        help="Free image generation VRAM before running refine model (once per phase when refining several prompts)",
+    ),
+    click.option(
+        "--candidates",
+        "-k",
+        default=1,
+        show_default=True,
+        type=click.IntRange(min=1),
+        help="Number of images to generate and review per iteration; the best-scoring one is refined",
+    ),
+    click.option(
+        "--candidate-mode",
+        default="seed",
+        show_default=True,
+        type=click.Choice(["seed", "prompt"]),
+        help="Vary candidates by seed, or by generating a distinct refined prompt for each",
+    ),
+    click.option(
+        "--batch-size",
+        default=1,
+        show_default=True,
+        type=click.IntRange(min=1),
+        help="Render up to this many candidates of the same prompt as one ComfyUI job, sharing a seed",
+    ),
+    click.option(
+        "--target-score",
+        type=click.FloatRange(0, 10),
+        help="Stop once the best image scores at least this much (out of 10)",
+    ),
+    click.option(
+        "--patience",
+        type=click.IntRange(min=1),
+        help="Stop after this many iterations without a better score",
+    ),
+    click.option(
+        "--resume",
+        is_flag=True,
+        help="Continue the run journaled in the output directory, skipping completed steps",
+    ),
+    click.option(
+        "--cache-dir",
+        default=default_cache_dir,
+        show_default="~/.cache/perfect-prompt",
+        envvar="PERFECT_PROMPT_CACHE_DIR",
+        type=click.Path(file_okay=False, path_type=Path),
+        help="Directory for on-disk caches",
+    ),
+    click.option(
+        "--no-cache",
+        is_flag=True,
+        help="Don't read or write the on-disk caches",
+    ),
+    click.option(
+        "--image-cache-size",
+        default=2048,
+        show_default=True,
+        type=click.IntRange(min=0),
+        help="Maximum size of the rendered image cache in MB (0 disables it)",
+    ),
+    click.option(
+        "--llm-cache-size",
+        default=256,
+        show_default=True,
+        type=click.IntRange(min=0),
+        help="Maximum size of the review/revision cache in MB (0 disables it)",
+    ),
+    click.option(
+        "--llm-cache-ttl",
+        default=30.0,
+        show_default=True,
+        type=click.FloatRange(min=0, min_open=True),
+        help="Days before a cached review or revision expires",
+    ),
+    click.option(
+        "--profile",
+        is_flag=True,
+        help="Print a table of time spent in each stage when done",
+    ),
+    click.option(
+        "--trace",
+        type=click.Path(dir_okay=False, writable=True, path_type=Path),
+        help="Write per-stage timing spans and counters to this file as OpenTelemetry (OTLP) JSON lines",
+    ),
+    click.option(
+        "--workers",
+        type=click.IntRange(min=1),
+        help="Maximum concurrent generation jobs, and concurrent LLM jobs [default: --candidates, and for generation at least one per ComfyUI server]",
+    ),
+    click.option(
+        "--llm-concurrency",
+        type=click.IntRange(min=1),
+        help="Maximum concurrent calls to the refine model, across all prompts; match it to e.g. OLLAMA_NUM_PARALLEL [default: --workers]",
+    ),
+]
+
+
+def run_options(f):
+    for option in reversed(RUN_OPTIONS):
+        f = option(f)
+    return f
+
+
+@click.group(cls=DefaultGroup, default="refine", default_if_no_args=False)
 @click.version_option()
-@click.argument("prompt", required=True)
+def cli():
+    "Perfect your image generation prompt with a visual LLM."
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
+
+@cli.command(name="refine")
+@click.argument("prompts", metavar="PROMPT...", nargs=-1, required=True)
 @click.option(
     "--from-file",
     is_flag=True,
-    help="Treat prompt argument as file path instead of literal text",
-)
-@click.option(
-    "-o",
-    "--output-dir",
-    required=True,
-    type=click.Path(writable=True, path_type=Path),
-    help="Directory where final images will be saved",
+    help="Treat prompt arguments as file paths instead of literal text",
 )
-@click.option(
-    "--iterations",
-    "-n",
-    default=3,
-    show_default=True,
-    help="Number of refinement iterations",
+@run_options
+def refine_command(
+    prompts: tuple[str, ...], from_file: bool, output_dir: Path, **options
+):
+    "Refine one or more prompts."
+    import asyncio
+
+    from . import pipeline
+    from .session import Session
+
+    if from_file:
+        prompts = tuple(Path(prompt).read_text() for prompt in prompts)
+
+    initial_prompts = [prompt.strip() for prompt in prompts]
+
+    output_dir.mkdir(exist_ok=True, parents=True)
+    session = Session.create(output_dir, **options)
+    journal = session.journal
+    assert journal is not None
+
+    def prefixed_echo(index: int):
+        if len(initial_prompts) == 1:
+            return click.echo
+        return lambda message: click.echo(
+            "\n".join(f"[{index + 1}] {line}" for line in message.splitlines())
+        )
+
+    async def run():
+        try:
+            with metrics.span("refine", prompts=len(initial_prompts)):
+                await asyncio.gather(
+                    *(
+                        pipeline.refine_chain(
+                            session.scheduler,
+                            session.model,
+                            initial_prompt,
+                            output_dir,
+                            echo=prefixed_echo(i),
+                            journal=journal.chain(str(i + 1), initial_prompt),
+                            **session.chain_kwargs,
+                        )
+                        for i, initial_prompt in enumerate(initial_prompts)
+                    )
+                )
+        finally:
+            await session.scheduler.aclose()
+
+    try:
+        asyncio.run(run())
+    except ValueError as e:
+        raise click.ClickException(str(e)) from e
+    finally:
+        session.close()
+
+    click.echo("Image generation and refinement complete.")
+
+
+@cli.command(name="batch")
+@click.argument(
+    "manifest", type=click.Path(exists=True, dir_okay=False, path_type=Path)
 )
 @click.option(
-    "--refine-model",
-    default="ministral-3:14b",
-    show_default=True,
-    help="Model to use for refining prompts",
+    "--results",
+    type=click.Path(dir_okay=False, writable=True, path_type=Path),
+    help="JSONL file for one result record per prompt [default: OUTPUT_DIR/results.jsonl]",
 )
 @click.option(
-    "--gen-model",
-    default="comfyui-flux",
+    "--concurrency",
+    "-j",
+    default=4,
     show_default=True,
-    type=click.Choice(
-        [
-            "comfyui-flux",
-            "comfyui-flux-krea",
-            "comfyui-z-image-turbo",
-            "flux-pro-1.1-ultra",
-            "flux-pro-1.1",
-            "flux-pro",
-            "flux-dev",
-            "flux-2-max",
-            "flux-2-pro",
-            "flux-2-flex",
-        ]
-    ),
-    help="Model to use for generating images",
-)
-@click.option(
-    "--comfyui-output-dir",
-    type=click.Path(exists=True, path_type=Path),
-    help="Directory where generated images are found (required if using comfyui-* models)",
-)
-@click.option(
-    "--raw",
-    is_flag=True,
-    help="Request raw-style image from the Flux API",
-)
-@click.option(
-    "--review-temperature",
-    type=float,
-    help="Temperature setting for the review prompt",
-)
-@click.option(
-    "--refine-temperature",
-    type=float,
-    help="Temperature setting for the refine prompt",
+    type=click.IntRange(min=1),
+    help="Number of prompts to refine at once",
 )
-@click.option(
-    "--free-vram",
-    is_flag=True,
-    help="Free image generation VRAM before running refine model",
-)
-def cli(
-    prompt: str,
-    from_file: bool,
+@run_options
+def batch_command(
+    manifest: Path,
+    results: Path | None,
+    concurrency: int,
     output_dir: Path,
-    iterations,
-    refine_model,
-    gen_model,
-    comfyui_output_dir: Path,
-    raw,
-    review_temperature,
-    refine_temperature,
-    free_vram,
+    **options,
 ):
-    if from_file:
-        prompt = Path(prompt).read_text()
+    """Refine every prompt in a JSONL or CSV manifest.
 
-    if gen_model.startswith("comfyui-") and not comfyui_output_dir:
-        raise click.UsageError(
-            "--comfyui-output-dir is required when using comfyui-* models."
-        )
+    JSONL lines are objects with a "prompt" key; CSV files need a "prompt"
+    column. Either may also give an "id".
+    """
+    import asyncio
 
-    initial_prompt = prompt.strip()
+    from . import batch
+    from .session import Session
 
     output_dir.mkdir(exist_ok=True, parents=True)
+    results = results or output_dir / "results.jsonl"
+    resume = options["resume"]
+    session = Session.create(output_dir, **options)
+    counts = {"ok": 0, "failed": 0}
 
-    current_prompt = initial_prompt
-    previous_attempts = []
-    for i in range(iterations):
-        click.echo(f"Iteration {i + 1}/{iterations}")
-        click.echo(f"Prompt: {current_prompt}")
+    def on_result(record: dict):
+        if "error" in record:
+            counts["failed"] += 1
+            click.echo(f"{record['id']}: failed: {record['error']}", err=True)
+        else:
+            counts["ok"] += 1
+            click.echo(f"{record['id']}: score={record['final_score']}")
 
-        generator = get_generator(gen_model)
+    async def run():
+        try:
+            with (
+                results.open("a" if resume else "w", encoding="utf-8") as f,
+                metrics.span("batch"),
+            ):
+                await batch.run_batch(
+                    batch.read_manifest(manifest),
+                    f,
+                    session.scheduler,
+                    session.model,
+                    output_dir,
+                    concurrency=concurrency,
+                    on_result=on_result,
+                    journal=session.journal,
+                    **session.chain_kwargs,
+                )
+        finally:
+            await session.scheduler.aclose()
 
-        current_image_path = generator.generate_image(
-            current_prompt,
-            output_dir,
-            comfyui_output_dir=comfyui_output_dir,
-            raw=raw,
-        )
-        if free_vram:
-            generator.free_memory()
-        click.echo(f"Image: {current_image_path}")
-
-        review, refined_prompt = refine.refine_prompt(
-            initial_prompt,
-            current_prompt,
-            current_image_path,
-            previous_attempts,
-            refine_model=refine_model,
-            review_temperature=review_temperature,
-            refine_temperature=refine_temperature,
-        )
-        click.echo(f"Review: {review}")
+    try:
+        asyncio.run(run())
+    finally:
+        session.close()
 
-        previous_attempts.append((current_prompt, review))
-        current_prompt = refined_prompt
-        click.echo("\n\n")
+    click.echo(
+        f"Refined {counts['ok']} prompts ({counts['failed']} failed). "
+        f"Results: {results}"
+    )
 
-    click.echo("Image generation and refinement complete.")
+
+@cli.command(name="serve")
+@click.option("--host", default="127.0.0.1", show_default=True)
+@click.option("--port", default=8765, show_default=True, type=int)
+@click.option(
+    "--concurrency",
+    "-j",
+    default=4,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Number of jobs to refine at once",
+)
+@run_options
+def serve_command(host: str, port: int, concurrency: int, output_dir: Path, **options):
+    """Refine prompts submitted over a local HTTP API.
+
+    The refine model and image generators stay loaded between jobs. POST
+    {"prompt": ..., "priority": 0} to /jobs to queue a job; higher priorities
+    run first. GET /jobs/ID/events streams its progress as JSON lines, GET
+    /jobs/ID returns its result and DELETE /jobs/ID cancels it. Each job's
+    images are written to OUTPUT_DIR/ID.
+    """
+    import asyncio
+
+    from . import server
+    from .session import Session
+
+    output_dir.mkdir(exist_ok=True, parents=True)
+    # Each job keeps its own journal; see `server.JobQueue`.
+    session = Session.create(output_dir, journal=False, **options)
+
+    async def run():
+        try:
+            async with server.serving(
+                session,
+                output_dir,
+                host=host,
+                port=port,
+                concurrency=concurrency,
+                resume=options["resume"],
+            ) as url:
+                click.echo(f"Serving on {url}", err=True)
+                await asyncio.Event().wait()
+        finally:
+            await session.scheduler.aclose()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    except OSError as e:
+        raise click.ClickException(f"Can't serve on {host}:{port}: {e}") from e
+    finally:
+        session.close()
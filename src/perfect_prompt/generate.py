@@ -1,17 +1,30 @@
+import asyncio
 import copy
+import importlib.util
 import json
 import os
+import random
+import threading
 import time
+import uuid
+import weakref
 from abc import ABC, abstractmethod
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable, Coroutine, Sequence
 from dataclasses import dataclass
 from pathlib import Path
-from urllib import request
+from typing import TYPE_CHECKING, Any, TypeVar
 
 import httpx
-from dotenv import load_dotenv
-from PIL import Image, PngImagePlugin
 
-load_dotenv()
+from . import metrics, png
+from .cache import ImageCache, cache_key
+
+# Only ComfyUI needs websockets, so it is imported on first use.
+if TYPE_CHECKING:
+    from websockets.asyncio.client import ClientConnection
+
+T = TypeVar("T")
 
 # Flux.1 Dev workflow
 WORKFLOW_FLUX = {
@@ -219,16 +232,66 @@ WORKFLOW_Z_IMAGE_TURBO = {
 class WorkflowConfig:
     workflow: dict
     prompt_node_id: str
+    seed_node_id: str
+    latent_node_id: str
+    seed_input: str = "seed"
+
+    def resolve(
+        self,
+        prompt: str,
+        seed: int | None = None,
+        batch_size: int = 1,
+        *,
+        steps: int | None = None,
+        width: int | None = None,
+        height: int | None = None,
+    ) -> dict:
+        workflow = copy.deepcopy(self.workflow)
+        workflow[self.prompt_node_id]["inputs"]["text"] = prompt
+        if seed is not None:
+            workflow[self.seed_node_id]["inputs"][self.seed_input] = seed
+        workflow[self.latent_node_id]["inputs"]["batch_size"] = batch_size
+        # Every node with a steps or size input follows the override (Flux's
+        # ModelSamplingFlux needs the same size as the latent image).
+        for node in workflow.values():
+            inputs = node["inputs"]
+            if steps is not None and "steps" in inputs:
+                inputs["steps"] = steps
+            if width is not None and "width" in inputs:
+                inputs["width"] = width
+            if height is not None and "height" in inputs:
+                inputs["height"] = height
+        return workflow
+
+    @property
+    def default_seed(self) -> int:
+        return self.workflow[self.seed_node_id]["inputs"][self.seed_input]
 
 
 COMFYUI_WORKFLOWS = {
-    "comfyui-flux": WorkflowConfig(workflow=WORKFLOW_FLUX, prompt_node_id="6"),
-    "comfyui-flux-krea": WorkflowConfig(workflow=WORKFLOW_KREA, prompt_node_id="6"),
+    "comfyui-flux": WorkflowConfig(
+        workflow=WORKFLOW_FLUX,
+        prompt_node_id="6",
+        seed_node_id="25",
+        latent_node_id="27",
+        seed_input="noise_seed",
+    ),
+    "comfyui-flux-krea": WorkflowConfig(
+        workflow=WORKFLOW_KREA,
+        prompt_node_id="6",
+        seed_node_id="31",
+        latent_node_id="27",
+    ),
     "comfyui-z-image-turbo": WorkflowConfig(
-        workflow=WORKFLOW_Z_IMAGE_TURBO, prompt_node_id="45"
+        workflow=WORKFLOW_Z_IMAGE_TURBO,
+        prompt_node_id="45",
+        seed_node_id="44",
+        latent_node_id="41",
     ),
 }
 
+DEFAULT_COMFYUI_URL = "http://127.0.0.1:8000"
+
 BFL_MODELS = frozenset(
     {
         "flux-pro-1.1-ultra",
@@ -242,15 +305,140 @@ BFL_MODELS = frozenset(
 )
 
 
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+
+
+def write_output_image(output_dir: Path, model: str, image_bytes: bytes) -> Path:
+    # Written in full under a temporary name first, so an interrupted run never
+    # leaves a truncated image behind.
+    tmp_path = output_dir / f".{model}_{uuid.uuid4().hex}.tmp"
+    tmp_path.write_bytes(image_bytes)
+    try:
+        return _publish(tmp_path, output_dir, model)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+async def download_output_image(
+    client: httpx.AsyncClient,
+    url: str,
+    output_dir: Path,
+    model: str,
+    metadata: dict[str, str],
+    **kwargs,
+) -> Path:
+    # Streamed to disk so that a full-resolution image is never held in memory.
+    # The metadata is spliced in before IEND, which only rewrites the tail.
+    tmp_path = output_dir / f".{model}_{uuid.uuid4().hex}.tmp"
+    try:
+        async with client.stream("GET", url, **kwargs) as response:
+            response.raise_for_status()
+            with tmp_path.open("wb") as f:
+                async for data in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                    f.write(data)
+        png.append_text(tmp_path, metadata)
+        return _publish(tmp_path, output_dir, model)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+def _publish(tmp_path: Path, output_dir: Path, model: str) -> Path:
+    timestamp = int(time.time() * 1000)
+    suffix = 0
+    while True:
+        name = f"{model}_{timestamp}" + (f"_{suffix}" if suffix else "")
+        output_path = output_dir / f"{name}.png"
+        try:
+            # Unlike a rename, a hard link never replaces an existing file, so
+            # concurrent jobs can't overwrite each other.
+            os.link(tmp_path, output_path)
+        except FileExistsError:
+            suffix += 1
+            continue
+        return output_path
+
+
+_sync_loop: asyncio.AbstractEventLoop | None = None
+_sync_loop_lock = threading.Lock()
+
+
+def run_sync(coro: Coroutine[Any, Any, T]) -> T:
+    # Sync callers share one background event loop (and so one pooled client per
+    # backend) instead of each spinning up their own.
+    global _sync_loop
+    with _sync_loop_lock:
+        if _sync_loop is None:
+            _sync_loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=_sync_loop.run_forever, name="perfect-prompt-io", daemon=True
+            ).start()
+    return asyncio.run_coroutine_threadsafe(coro, _sync_loop).result()
+
+
+class SharedAsyncClient:
+    """One long-lived, keep-alive `httpx.AsyncClient` per event loop."""
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault("timeout", 60.0)
+        kwargs.setdefault(
+            "limits",
+            httpx.Limits(max_keepalive_connections=32, keepalive_expiry=60.0),
+        )
+        # HTTP/2 needs the optional h2 package (`pip install httpx[http2]`).
+        kwargs.setdefault("http2", importlib.util.find_spec("h2") is not None)
+        self._kwargs = kwargs
+        self._clients: weakref.WeakKeyDictionary[
+            asyncio.AbstractEventLoop, httpx.AsyncClient
+        ] = weakref.WeakKeyDictionary()
+
+    def get(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None or client.is_closed:
+            client = self._clients[loop] = httpx.AsyncClient(**self._kwargs)
+        return client
+
+    async def aclose(self) -> None:
+        client = self._clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+
+
 class ImageGenerator(ABC):
     @abstractmethod
-    def generate_image(self, prompt: str, output_dir: Path, **kwargs) -> Path:
+    async def agenerate_image(self, prompt: str, output_dir: Path, **kwargs) -> Path:
         pass
 
     @abstractmethod
-    def free_memory(self) -> None:
+    async def afree_memory(self) -> None:
+        pass
+
+    @abstractmethod
+    async def aclose(self) -> None:
         pass
 
+    @property
+    def supports_batch(self) -> bool:
+        return False
+
+    async def agenerate_batch(
+        self, prompt: str, output_dir: Path, batch_size: int, **kwargs
+    ) -> list[Path]:
+        # Renders batch_size images of one prompt in a single job. They share
+        # one seed, and differ by their position in the batch.
+        raise NotImplementedError(f"{self.model_name} can't render batches")
+
+    def generate_image(self, prompt: str, output_dir: Path, **kwargs) -> Path:
+        return run_sync(self.agenerate_image(prompt, output_dir, **kwargs))
+
+    def free_memory(self) -> None:
+        run_sync(self.afree_memory())
+
+    def request_key(self, prompt: str, **kwargs) -> Any:
+        # Everything that determines the rendered image, or None if the
+        # backend's output can't be cached.
+        return None
+
     @property
     @abstractmethod
     def model_name(self) -> str:
@@ -262,91 +450,475 @@ class ComfyUIGenerator(ImageGenerator):
         self,
         model: str,
         config: WorkflowConfig,
-        comfyui_url: str = "http://127.0.0.1:8000",
+        comfyui_url: str = DEFAULT_COMFYUI_URL,
+        poll_interval: float = 0.5,
     ):
         self._model = model
         self._config = config
-        self._comfyui_url = comfyui_url
+        self._comfyui_url = comfyui_url.rstrip("/")
+        self._poll_interval = poll_interval
+        self._http = SharedAsyncClient(base_url=self._comfyui_url)
 
     @property
     def model_name(self) -> str:
         return self._model
 
-    def generate_image(
+    def request_key(
         self,
         prompt: str,
-        output_dir: Path,
         *,
-        comfyui_output_dir: Path,
+        seed: int | None = None,
+        batch_size: int = 1,
+        steps: int | None = None,
+        width: int | None = None,
+        height: int | None = None,
         **_,
+    ) -> Any:
+        return self._config.resolve(
+            prompt, seed, batch_size, steps=steps, width=width, height=height
+        )
+
+    @property
+    def supports_batch(self) -> bool:
+        return True
+
+    async def agenerate_image(self, prompt: str, output_dir: Path, **kwargs) -> Path:
+        (path,) = await self.agenerate_batch(prompt, output_dir, 1, **kwargs)
+        return path
+
+    async def agenerate_batch(
+        self,
+        prompt: str,
+        output_dir: Path,
+        batch_size: int,
+        *,
+        seed: int | None = None,
+        **kwargs,
+    ) -> list[Path]:
+        from websockets.exceptions import WebSocketException
+
+        client = self._http.get()
+        # A client id per job keeps concurrent jobs' progress events apart.
+        client_id = uuid.uuid4().hex
+        # Connect before queueing so that no progress events are missed.
+        ws = await self._connect_ws(client_id)
+        try:
+            with metrics.span("comfyui.queue_prompt"):
+                prompt_id = await self._queue_prompt(
+                    client,
+                    self.request_key(
+                        prompt, seed=seed, batch_size=batch_size, **kwargs
+                    ),
+                    client_id,
+                )
+            # Includes time spent behind other jobs in ComfyUI's own queue.
+            with metrics.span("comfyui.render"):
+                if ws is None:
+                    metrics.count("comfyui.ws_fallbacks")
+                else:
+                    try:
+                        await self._wait_for_ws(ws, prompt_id)
+                    except (OSError, WebSocketException):
+                        # Fall back to polling /history below.
+                        metrics.count("comfyui.ws_fallbacks")
+                outputs = await self._wait_for_history(client, prompt_id)
+        finally:
+            if ws is not None:
+                await ws.close()
+
+        images = self._output_images(outputs)
+        if len(images) < batch_size:
+            raise RuntimeError(
+                f"ComfyUI prompt {prompt_id} produced {len(images)} output images, "
+                f"expected {batch_size}"
+            )
+        metadata = {
+            "prompt": prompt,
+            "model": self._model,
+            "seed": str(self._config.default_seed if seed is None else seed),
+        }
+        with metrics.span("comfyui.download", images=batch_size):
+            return await asyncio.gather(
+                *(
+                    download_output_image(
+                        client,
+                        "/view",
+                        output_dir,
+                        self._model,
+                        metadata
+                        | (
+                            {"batch_size": str(batch_size), "batch_index": str(i)}
+                            if batch_size > 1
+                            else {}
+                        ),
+                        params={
+                            "filename": image["filename"],
+                            "subfolder": image.get("subfolder", ""),
+                            "type": image.get("type", "output"),
+                        },
+                    )
+                    for i, image in enumerate(images[:batch_size])
+                )
+            )
+
+    async def _connect_ws(self, client_id: str) -> "ClientConnection | None":
+        from websockets.asyncio.client import connect as ws_connect
+        from websockets.exceptions import WebSocketException
+
+        ws_url = self._comfyui_url.replace("http", "ws", 1)
+        try:
+            return await ws_connect(
+                f"{ws_url}/ws?clientId={client_id}",
+                open_timeout=5,
+                max_size=None,
+            )
+        except (OSError, WebSocketException):
+            return None
+
+    async def _queue_prompt(
+        self, client: httpx.AsyncClient, workflow: dict, client_id: str
+    ) -> str:
+        response = await client.post(
+            "/prompt", json={"prompt": workflow, "client_id": client_id}
+        )
+        response.raise_for_status()
+        return response.json()["prompt_id"]
+
+    async def _wait_for_ws(self, ws: "ClientConnection", prompt_id: str) -> None:
+        while True:
+            message = await ws.recv()
+            if isinstance(message, bytes):
+                continue  # Binary preview frames.
+            event = json.loads(message)
+            data = event.get("data", {})
+            if data.get("prompt_id") != prompt_id:
+                continue
+            if event["type"] == "execution_error":
+                raise RuntimeError(
+                    f"ComfyUI execution failed: {data.get('exception_message')}"
+                )
+            if event["type"] == "execution_success" or (
+                event["type"] == "executing" and data.get("node") is None
+            ):
+                return
+
+    async def _wait_for_history(
+        self, client: httpx.AsyncClient, prompt_id: str
+    ) -> dict:
+        while True:
+            metrics.count("comfyui.history_polls")
+            response = await client.get(f"/history/{prompt_id}")
+            response.raise_for_status()
+            history = response.json()
+            if prompt_id in history:
+                entry = history[prompt_id]
+                status = entry.get("status", {})
+                if status.get("status_str") == "error":
+                    raise RuntimeError(f"ComfyUI execution failed: {status}")
+                return entry.get("outputs", {})
+            await asyncio.sleep(self._poll_interval)
+
+    def _output_images(self, outputs: dict) -> list[dict]:
+        # In batch order.
+        return [
+            image
+            for node_output in outputs.values()
+            for image in node_output.get("images", [])
+            if image.get("type", "output") == "output"
+        ]
+
+    async def queue_depth(self) -> int:
+        response = await self._http.get().get("/queue", timeout=5)
+        response.raise_for_status()
+        queue = response.json()
+        return len(queue.get("queue_running", [])) + len(queue.get("queue_pending", []))
+
+    async def afree_memory(self) -> None:
+        response = await self._http.get().post(
+            "/free", json={"unload_models": True, "free_memory": True}
+        )
+        response.raise_for_status()
+
+    async def aclose(self) -> None:
+        await self._http.aclose()
+
+    @property
+    def url(self) -> str:
+        return self._comfyui_url
+
+
+@dataclass(eq=False)
+class _Server:
+    generator: ComfyUIGenerator
+    in_flight: int = 0
+    down_until: float = 0.0
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.down_until
+
+
+# A pinned chain that is forgotten is simply placed afresh on its next job.
+MAX_PINNED = 1024
+
+
+class ComfyUIPool(ImageGenerator):
+    """Spreads jobs over several ComfyUI servers running the same models.
+
+    Each job goes to the healthy server with the shortest queue. A server that
+    can't be reached, including one that dies mid-job, is skipped for
+    ``retry_after`` seconds and its job is resubmitted elsewhere. With
+    ``pin``, every job with the same ``affinity`` key (one refine chain) runs
+    on the same server, so that server keeps its models loaded for the chain.
+    """
+
+    def __init__(
+        self,
+        generators: list[ComfyUIGenerator],
+        *,
+        pin: bool = False,
+        retry_after: float = 30.0,
+    ):
+        self._servers = [_Server(generator) for generator in generators]
+        self._pin = pin
+        self._retry_after = retry_after
+        # Most recently used last; only the newest MAX_PINNED chains stay pinned.
+        self._pinned: OrderedDict[Any, _Server] = OrderedDict()
+
+    @property
+    def model_name(self) -> str:
+        return self._servers[0].generator.model_name
+
+    def request_key(self, prompt: str, **kwargs) -> Any:
+        # Every server renders the same request identically.
+        return self._servers[0].generator.request_key(prompt, **kwargs)
+
+    def _mark_down(self, server: _Server) -> None:
+        server.down_until = time.monotonic() + self._retry_after
+
+    async def _load(self, server: _Server) -> int | None:
+        try:
+            depth = await server.generator.queue_depth()
+        except (httpx.HTTPError, OSError):
+            self._mark_down(server)
+            return None
+        # Jobs that were just dispatched may not show up in /queue yet.
+        return max(depth, server.in_flight)
+
+    async def _pick(self, tried: list[_Server]) -> _Server:
+        untried = [server for server in self._servers if server not in tried]
+        # If every server is marked down, try them anyway rather than fail.
+        candidates = [server for server in untried if server.healthy] or untried
+        loads = await asyncio.gather(*(self._load(server) for server in candidates))
+        # No awaits from here until the job is counted as in flight, so
+        # concurrent picks see each other's choices, including those made
+        # while this one was fetching queue depths.
+        scored = [
+            (max(load, server.in_flight), server.in_flight, i, server)
+            for i, (server, load) in enumerate(zip(candidates, loads, strict=True))
+            if load is not None
+        ]
+        if not scored:
+            urls = ", ".join(server.generator.url for server in candidates)
+            raise RuntimeError(f"No ComfyUI server is reachable ({urls})")
+        return min(scored)[-1]
+
+    @property
+    def supports_batch(self) -> bool:
+        return True
+
+    async def agenerate_image(
+        self, prompt: str, output_dir: Path, *, affinity: Any = None, **kwargs
     ) -> Path:
-        initial_files = set(comfyui_output_dir.glob("*.png"))
+        return await self._dispatch(
+            affinity,
+            lambda generator: generator.agenerate_image(prompt, output_dir, **kwargs),
+        )
+
+    async def agenerate_batch(
+        self,
+        prompt: str,
+        output_dir: Path,
+        batch_size: int,
+        *,
+        affinity: Any = None,
+        **kwargs,
+    ) -> list[Path]:
+        return await self._dispatch(
+            affinity,
+            lambda generator: generator.agenerate_batch(
+                prompt, output_dir, batch_size, **kwargs
+            ),
+        )
 
-        self._queue_prompt(prompt)
+    async def _dispatch(
+        self, affinity: Any, job: Callable[[ComfyUIGenerator], Awaitable[T]]
+    ) -> T:
+        from websockets.exceptions import WebSocketException
 
+        pin = self._pin and affinity is not None
+        tried: list[_Server] = []
         while True:
-            current_files = set(comfyui_output_dir.glob("*.png"))
-            new_files = current_files - initial_files
-            if new_files:
-                latest_image = max(new_files, key=os.path.getctime)
-                break
-            time.sleep(5)
+            server = self._pinned.get(affinity) if pin else None
+            if server is None or server in tried or not server.healthy:
+                server = await self._pick(tried)
+            if pin:
+                self._pinned[affinity] = server
+                self._pinned.move_to_end(affinity)
+                if len(self._pinned) > MAX_PINNED:
+                    self._pinned.popitem(last=False)
+            server.in_flight += 1
+            try:
+                return await job(server.generator)
+            # Only failures to reach the server; a local error such as a full
+            # disk would fail the same way on any server.
+            except (httpx.TransportError, ConnectionError, WebSocketException):
+                self._mark_down(server)
+                tried.append(server)
+                if len(tried) == len(self._servers):
+                    raise
+                metrics.count("comfyui.failovers")
+            finally:
+                server.in_flight -= 1
 
-        return self._move_image_to_output(latest_image, output_dir)
+    async def afree_memory(self) -> None:
+        await asyncio.gather(
+            *(
+                server.generator.afree_memory()
+                for server in self._servers
+                if server.healthy
+            )
+        )
 
-    def _queue_prompt(self, prompt: str) -> None:
-        workflow = copy.deepcopy(self._config.workflow)
-        workflow[self._config.prompt_node_id]["inputs"]["text"] = prompt
+    async def aclose(self) -> None:
+        for server in self._servers:
+            await server.generator.aclose()
 
-        data = json.dumps({"prompt": workflow}).encode("utf-8")
-        req = request.Request(f"{self._comfyui_url}/prompt", data=data)
-        request.urlopen(req)
 
-    def _move_image_to_output(self, image_path: Path, output_dir: Path) -> Path:
-        timestamp = int(time.time() * 1000)
-        output_path = output_dir / f"{self._model}_{timestamp}.png"
-        image_path.rename(output_path)
-        return output_path
+class _RateLimiter:
+    """Spaces requests at least 1/rate seconds apart, across tasks and loops."""
 
-    def free_memory(self) -> None:
-        data = json.dumps({"unload_models": True, "free_memory": True}).encode("utf-8")
-        req = request.Request(f"{self._comfyui_url}/free", data=data)
-        request.urlopen(req)
+    def __init__(self, rate: float):
+        self._interval = 1 / rate
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    async def wait(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self._interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+def _retry_delay(response: httpx.Response | None, attempt: int) -> float:
+    # Honours Retry-After; otherwise exponential backoff with full jitter, so
+    # that many jobs rejected at once don't all retry at once.
+    if response is not None:
+        try:
+            return float(response.headers["retry-after"])
+        except (KeyError, ValueError):
+            pass
+    return random.uniform(0, min(30.0, 0.5 * 2**attempt))
+
+
+class _APILimits:
+    """The task and request limits of one API key, shared by its generators."""
+
+    def __init__(self, max_concurrency: int, requests_per_second: float):
+        self.max_concurrency = max_concurrency
+        self.rate = _RateLimiter(requests_per_second)
+        # asyncio primitives belong to one event loop.
+        self._tasks: weakref.WeakKeyDictionary[
+            asyncio.AbstractEventLoop, asyncio.Semaphore
+        ] = weakref.WeakKeyDictionary()
+
+    def tasks(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        tasks = self._tasks.get(loop)
+        if tasks is None:
+            tasks = self._tasks[loop] = asyncio.Semaphore(self.max_concurrency)
+        return tasks
+
+
+_api_limits: dict[tuple[str, str | None], _APILimits] = {}
+_api_limits_lock = threading.Lock()
+
+# Errors raised before a request was sent, so retrying can't repeat it.
+_NOT_SENT = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
 
 
 class BFLAPIGenerator(ImageGenerator):
-    def __init__(self, model: str, api_key: str | None = None):
+    """Renders through the Black Forest Labs API.
+
+    At most ``max_concurrency`` tasks are in flight at once (the API rejects
+    more than 24 active tasks) and requests are limited to
+    ``requests_per_second``. Both limits are shared by every generator with
+    the same API key and endpoint, such as a draft and a final model; the
+    first one created sets them. Rate limit errors are retried with jittered
+    backoff, and so are server and network errors, except for submissions,
+    where a retry could start (and bill) a job twice. Results are first
+    polled once a job has had about as long as recent jobs took, then at a
+    growing interval, up to ``timeout`` seconds in all.
+    """
+
+    def __init__(
+        self,
+        model: str,
+        api_key: str | None = None,
+        *,
+        base_url: str | None = None,
+        max_concurrency: int = 24,
+        requests_per_second: float = 10.0,
+        max_retries: int = 5,
+        poll_interval: float = 0.5,
+        max_poll_interval: float = 5.0,
+        timeout: float = 600.0,
+    ):
         self._model = model
         self._api_key = api_key or os.getenv("BFL_API_KEY")
-        self._base_url = "https://api.bfl.ai"
+        # BFL_API_URL points at a regional endpoint, a proxy or a stand-in.
+        base_url = base_url or os.getenv("BFL_API_URL", "https://api.bfl.ai")
+        self._base_url = base_url.rstrip("/")
+        self._http = SharedAsyncClient()
+        with _api_limits_lock:
+            key = (self._base_url, self._api_key)
+            if key not in _api_limits:
+                _api_limits[key] = _APILimits(max_concurrency, requests_per_second)
+            self._limits = _api_limits[key]
+        self._max_retries = max_retries
+        self._poll_interval = poll_interval
+        self._max_poll_interval = max_poll_interval
+        self._timeout = timeout
+        # Moving average of how long jobs take to be ready, once one has.
+        self._expected_seconds: float | None = None
 
     @property
     def model_name(self) -> str:
         return self._model
 
-    def generate_image(
+    def request_key(
         self,
         prompt: str,
-        output_dir: Path,
         *,
         width: int = 1216,
         height: int = 832,
         raw: bool = False,
+        seed: int | None = None,
         **_,
-    ) -> Path:
-        if not self._api_key:
-            raise ValueError("BFL_API_KEY environment variable is not set")
-        headers = {
-            "accept": "application/json",
-            "x-key": self._api_key,
-            "Content-Type": "application/json",
-        }
+    ) -> Any:
+        # raw is also recorded in the image metadata, even where the API ignores it.
+        return {"payload": self._payload(prompt, width, height, raw, seed), "raw": raw}
 
+    def _payload(
+        self, prompt: str, width: int, height: int, raw: bool, seed: int | None
+    ) -> dict:
         payload: dict = {
             "prompt": prompt,
             "width": width,
             "height": height,
-            "seed": 42,
+            "seed": 42 if seed is None else seed,
             "output_format": "png",
         }
 
@@ -358,65 +930,248 @@ class BFLAPIGenerator(ImageGenerator):
                 payload["raw"] = True
         else:
             payload["safety_tolerance"] = 5  # Max permissiveness for Flux 2.x (0-5)
+        return payload
 
-        with httpx.Client(timeout=60.0) as client:
-            response = client.post(
-                f"{self._base_url}/v1/{self._model}",
-                headers=headers,
-                json=payload,
-            )
-            response.raise_for_status()
+    async def agenerate_image(
+        self,
+        prompt: str,
+        output_dir: Path,
+        *,
+        width: int = 1216,
+        height: int = 832,
+        raw: bool = False,
+        seed: int | None = None,
+        **_,
+    ) -> Path:
+        if not self._api_key:
+            raise ValueError("BFL_API_KEY environment variable is not set")
+        headers = {
+            "accept": "application/json",
+            "x-key": self._api_key,
+            "Content-Type": "application/json",
+        }
+        payload = self._payload(prompt, width, height, raw, seed)
+
+        client = self._http.get()
+        tasks = self._limits.tasks()
+        with metrics.span("bfl.wait"):
+            await tasks.acquire()
+        try:
+            with metrics.span("bfl.submit"):
+                response = await self._request(
+                    client,
+                    "POST",
+                    f"{self._base_url}/v1/{self._model}",
+                    headers=headers,
+                    json=payload,
+                )
             result = response.json()
             polling_url = result.get(
                 "polling_url", f"{self._base_url}/v1/get_result?id={result['id']}"
             )
+            with metrics.span("bfl.render"):
+                poll_data = await self._wait_for_result(
+                    client, polling_url, headers, result.get("id", polling_url)
+                )
+        finally:
+            tasks.release()
 
-            while True:
-                poll_response = client.get(polling_url, headers=headers)
-                poll_response.raise_for_status()
-                poll_data = poll_response.json()
-
-                status = poll_data["status"]
-                if status == "Ready":
-                    image_url = poll_data["result"]["sample"]
-                    image_response = client.get(image_url)
-                    image_response.raise_for_status()
-
-                    timestamp = int(time.time() * 1000)
-                    output_path = output_dir / f"{self._model}_{timestamp}.png"
-                    output_path.write_bytes(image_response.content)
-
-                    image = Image.open(output_path)
-                    metadata = PngImagePlugin.PngInfo()
-                    metadata.add_text("prompt", prompt)
-                    metadata.add_text("model", self._model)
-                    metadata.add_text("raw", str(raw))
-                    image.save(output_path, "PNG", pnginfo=metadata)
-
-                    return output_path
-
-                if status in (
-                    "Error",
-                    "Failed",
-                    "Request Moderated",
-                    "Content Moderated",
+        metadata = {
+            "prompt": prompt,
+            "model": self._model,
+            "raw": str(raw),
+            "seed": str(payload["seed"]),
+        }
+        with metrics.span("bfl.download"):
+            return await download_output_image(
+                client, poll_data["result"]["sample"], output_dir, self._model, metadata
+            )
+
+    async def _request(
+        self, client: httpx.AsyncClient, method: str, url: str, **kwargs
+    ) -> httpx.Response:
+        # The API has no idempotency keys, so a POST is only retried when the
+        # server can't have acted on it.
+        idempotent = method == "GET"
+        attempt = 0
+        while True:
+            await self._limits.rate.wait()
+            try:
+                response = await client.request(method, url, **kwargs)
+            except httpx.TransportError as e:
+                if attempt == self._max_retries or not (
+                    idempotent or isinstance(e, _NOT_SENT)
                 ):
-                    error_msg = poll_data.get("error", status)
-                    raise RuntimeError(f"Generation failed: {error_msg}")
+                    raise
+                response = None
+            else:
+                retry = response.status_code == 429 or (
+                    idempotent and response.status_code >= 500
+                )
+                if not retry or attempt == self._max_retries:
+                    response.raise_for_status()
+                    return response
+            metrics.count("bfl.retries")
+            await asyncio.sleep(_retry_delay(response, attempt))
+            attempt += 1
 
-                time.sleep(0.5)
+    async def _wait_for_result(
+        self,
+        client: httpx.AsyncClient,
+        polling_url: str,
+        headers: dict,
+        task_id: str,
+    ) -> dict:
+        start = time.monotonic()
+        # Wait out most of a typical render before the first poll, rather
+        # than polling all the way through it.
+        delay = self._poll_interval
+        if self._expected_seconds is not None:
+            delay = max(delay, 0.8 * self._expected_seconds)
+        interval = self._poll_interval
+        while True:
+            remaining = self._timeout - (time.monotonic() - start)
+            if remaining <= 0:
+                raise TimeoutError(
+                    f"BFL task {task_id} was not ready after {self._timeout:g}s"
+                )
+            await asyncio.sleep(min(delay, remaining))
+            metrics.count("bfl.polls")
+            response = await self._request(client, "GET", polling_url, headers=headers)
+            poll_data = response.json()
 
-    def free_memory(self) -> None:
+            status = poll_data["status"]
+            if status == "Ready":
+                seconds = time.monotonic() - start
+                self._expected_seconds = (
+                    seconds
+                    if self._expected_seconds is None
+                    else 0.8 * self._expected_seconds + 0.2 * seconds
+                )
+                return poll_data
+            if status in (
+                "Error",
+                "Failed",
+                "Request Moderated",
+                "Content Moderated",
+            ):
+                error_msg = poll_data.get("error", status)
+                raise RuntimeError(f"Generation failed: {error_msg}")
+
+            delay = interval
+            interval = min(interval * 1.5, self._max_poll_interval)
+
+    async def afree_memory(self) -> None:
         pass
 
+    async def aclose(self) -> None:
+        await self._http.aclose()
+
+
+class CachedGenerator(ImageGenerator):
+    """Serves repeated requests from an `ImageCache` instead of re-rendering."""
+
+    def __init__(self, generator: ImageGenerator, cache: ImageCache):
+        self._generator = generator
+        self._cache = cache
 
-def get_generator(model: str) -> ImageGenerator:
+    @property
+    def model_name(self) -> str:
+        return self._generator.model_name
+
+    def request_key(self, prompt: str, **kwargs) -> Any:
+        return self._generator.request_key(prompt, **kwargs)
+
+    async def agenerate_image(self, prompt: str, output_dir: Path, **kwargs) -> Path:
+        request = self.request_key(prompt, **kwargs)
+        if request is None:
+            return await self._generator.agenerate_image(prompt, output_dir, **kwargs)
+
+        key = cache_key(self.model_name, request)
+        image_bytes = await asyncio.to_thread(self._cache.get, key)
+        if image_bytes is not None:
+            return await asyncio.to_thread(
+                write_output_image, output_dir, self.model_name, image_bytes
+            )
+
+        output_path = await self._generator.agenerate_image(
+            prompt, output_dir, **kwargs
+        )
+        await asyncio.to_thread(self._store, key, output_path)
+        return output_path
+
+    @property
+    def supports_batch(self) -> bool:
+        return self._generator.supports_batch
+
+    async def agenerate_batch(
+        self, prompt: str, output_dir: Path, batch_size: int, **kwargs
+    ) -> list[Path]:
+        request = self.request_key(prompt, batch_size=batch_size, **kwargs)
+        if request is None:
+            return await self._generator.agenerate_batch(
+                prompt, output_dir, batch_size, **kwargs
+            )
+
+        # The batch is only served from the cache if every image in it is.
+        keys = [cache_key(self.model_name, request, i) for i in range(batch_size)]
+        cached = []
+        for key in keys:
+            image_bytes = await asyncio.to_thread(self._cache.get, key)
+            if image_bytes is None:
+                break
+            cached.append(image_bytes)
+        else:
+            return [
+                await asyncio.to_thread(
+                    write_output_image, output_dir, self.model_name, image_bytes
+                )
+                for image_bytes in cached
+            ]
+
+        output_paths = await self._generator.agenerate_batch(
+            prompt, output_dir, batch_size, **kwargs
+        )
+        for key, output_path in zip(keys, output_paths, strict=True):
+            await asyncio.to_thread(self._store, key, output_path)
+        return output_paths
+
+    async def afree_memory(self) -> None:
+        await self._generator.afree_memory()
+
+    async def aclose(self) -> None:
+        await self._generator.aclose()
+
+    def _store(self, key: str, output_path: Path) -> None:
+        # Images are written (and read) off the event loop; they can be large.
+        self._cache.put(key, output_path.read_bytes())
+
+
+def get_generator(
+    model: str,
+    *,
+    cache: ImageCache | None = None,
+    comfyui_urls: Sequence[str] = (DEFAULT_COMFYUI_URL,),
+    pin_comfyui: bool = False,
+    bfl_options: dict[str, Any] | None = None,
+) -> ImageGenerator:
+    generator: ImageGenerator
     if model in COMFYUI_WORKFLOWS:
         config = COMFYUI_WORKFLOWS[model]
-        return ComfyUIGenerator(model=model, config=config)
-
-    if model in BFL_MODELS:
-        return BFLAPIGenerator(model=model)
+        servers = [
+            ComfyUIGenerator(model=model, config=config, comfyui_url=url)
+            for url in comfyui_urls
+        ]
+        if len(servers) == 1:
+            generator = servers[0]
+        else:
+            generator = ComfyUIPool(servers, pin=pin_comfyui)
+    elif model in BFL_MODELS:
+        generator = BFLAPIGenerator(model=model, **(bfl_options or {}))
+    else:
+        available = list(COMFYUI_WORKFLOWS.keys()) + list(BFL_MODELS)
+        raise ValueError(f"Unknown model: {model}. Available models: {available}")
 
-    available = list(COMFYUI_WORKFLOWS.keys()) + list(BFL_MODELS)
-    raise ValueError(f"Unknown model: {model}. Available models: {available}")
+    if cache is not None:
+        return CachedGenerator(generator, cache)
+    return generator
@@ -0,0 +1,125 @@
+import asyncio
+import json
+import os
+from collections.abc import Awaitable, Callable
+from pathlib import Path
+from typing import Any
+
+JOURNAL_NAME = "journal.jsonl"
+
+
+class Journal:
+    """Append-only record of every completed step of a run.
+
+    Each line is one JSON event: ``{"chain": ..., "step": ..., "value": ...}``.
+    Lines are flushed and fsynced as they are written, so after a crash at
+    most the step that was in progress is lost. A torn final line is dropped
+    when the journal is reopened with ``resume=True``. Once a chain is done,
+    only that is remembered, not its steps, so memory stays bounded by the
+    chains in progress.
+    """
+
+    def __init__(self, path: Path, *, resume: bool = False):
+        self.path = path
+        self._steps: dict[str, dict[str, Any]] = {}
+        self._done: set[str] = set()
+        if resume and path.exists():
+            self._load()
+        self._file = path.open("a" if resume else "w", encoding="utf-8")
+
+    def _load(self) -> None:
+        good_size = 0
+        with self.path.open("rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    event = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                self._remember(event["chain"], event["step"], event.get("value"))
+                good_size += len(line)
+        # Drop anything after the last complete event so appends stay parseable.
+        os.truncate(self.path, good_size)
+
+    def _remember(self, chain: str, step: str, value: Any) -> None:
+        if step == "done":
+            self._steps.pop(chain, None)
+            self._done.add(chain)
+        else:
+            self._steps.setdefault(chain, {})[step] = value
+
+    def _write(self, chain: str, step: str, value: Any) -> None:
+        self._remember(chain, step, value)
+        self._file.write(json.dumps({"chain": chain, "step": step, "value": value}))
+        self._file.write("\n")
+        self._file.flush()
+
+    def record(self, chain: str, step: str, value: Any = None) -> None:
+        self._write(chain, step, value)
+        os.fsync(self._file.fileno())
+
+    async def arecord(self, chain: str, step: str, value: Any = None) -> None:
+        # Syncs in a thread, so a slow disk doesn't stall every chain on the loop.
+        self._write(chain, step, value)
+        await asyncio.to_thread(os.fsync, self._file.fileno())
+
+    def get(self, chain: str, step: str) -> Any:
+        return self._steps.get(chain, {}).get(step)
+
+    def is_done(self, chain: str) -> bool:
+        return chain in self._done
+
+    def chain(self, chain: str, prompt: str) -> "ChainJournal":
+        steps = self._steps.get(chain, {})
+        if "start" not in steps:
+            self.record(chain, "start", {"prompt": prompt})
+        elif steps["start"]["prompt"] != prompt:
+            raise ValueError(
+                f"{self.path} records a different prompt for {chain!r}; "
+                "remove it or run without --resume"
+            )
+        return ChainJournal(self, chain)
+
+    def close(self) -> None:
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ChainJournal:
+    def __init__(self, journal: Journal | None, chain: str):
+        self._journal = journal
+        self._chain = chain
+
+    def get(self, step: str) -> Any:
+        if self._journal is None:
+            return None
+        return self._journal.get(self._chain, step)
+
+    async def step(
+        self,
+        step: str,
+        run: Callable[[], Awaitable[Any]],
+        valid: Callable[[Any], bool] = lambda value: True,
+    ) -> Any:
+        # Replays a recorded step, or runs and records it.
+        value = self.get(step)
+        if value is not None and valid(value):
+            return value
+        value = await run()
+        if self._journal is not None:
+            await self._journal.arecord(self._chain, step, value)
+        return value
+
+    async def finish(self) -> None:
+        if self._journal is not None:
+            await self._journal.arecord(self._chain, "done")
+
+
+# Runs every step and records nothing.
+NULL_JOURNAL = ChainJournal(None, "")
@@ -0,0 +1,207 @@
+import json
+import os
+import statistics
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar, Token
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any
+
+
+@dataclass
+class Span:
+    name: str
+    span_id: str
+    parent_id: str | None
+    start_ns: int
+    duration_ns: int
+    attributes: dict[str, Any] = field(default_factory=dict)
+
+
+class Metrics:
+    """Timing spans and counters for one run.
+
+    Instrumented code calls the module-level `span` and `count`, which record
+    into whichever `Metrics` is active in the current context (and are no-ops
+    when none is). The context is inherited by asyncio tasks and
+    `asyncio.to_thread`, so concurrent chains all record into the same run.
+    """
+
+    def __init__(self):
+        self.spans: list[Span] = []
+        self.counters: dict[str, int] = {}
+        self.trace_id = os.urandom(16).hex()
+        self.start_ns = time.time_ns()
+        self._lock = threading.Lock()
+
+    def activate(self) -> Token:
+        return _active.set(self)
+
+    def add_span(self, span: Span) -> None:
+        with self._lock:
+            self.spans.append(span)
+
+    def count(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def summary(self) -> str:
+        durations: dict[str, list[float]] = {}
+        for span in self.spans:
+            durations.setdefault(span.name, []).append(span.duration_ns / 1e9)
+        width = max((len(name) for name in [*durations, *self.counters]), default=5)
+        lines = [
+            f"{'stage':<{width}}  {'count':>6}  {'total s':>9}  {'mean s':>8}"
+            f"  {'p95 s':>8}  {'max s':>8}"
+        ]
+        for name, values in sorted(durations.items(), key=lambda item: -sum(item[1])):
+            p95 = (
+                statistics.quantiles(values, n=20, method="inclusive")[-1]
+                if len(values) > 1
+                else values[0]
+            )
+            lines.append(
+                f"{name:<{width}}  {len(values):>6}  {sum(values):>9.3f}"
+                f"  {statistics.fmean(values):>8.3f}  {p95:>8.3f}  {max(values):>8.3f}"
+            )
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"{name:<{width}}  {value:>6}")
+        return "\n".join(lines)
+
+    def write_trace(self, path: Path) -> None:
+        # The OTLP JSON file format, as read by OpenTelemetry collectors'
+        # file receivers: one export request per line, the spans as an
+        # ExportTraceServiceRequest and then the counters as an
+        # ExportMetricsServiceRequest.
+        spans = [
+            {
+                "traceId": self.trace_id,
+                "spanId": span.span_id,
+                **({"parentSpanId": span.parent_id} if span.parent_id else {}),
+                "name": span.name,
+                "kind": 1,
+                "startTimeUnixNano": str(span.start_ns),
+                "endTimeUnixNano": str(span.start_ns + span.duration_ns),
+                "attributes": [
+                    {"key": key, "value": _otlp_value(value)}
+                    for key, value in span.attributes.items()
+                ],
+            }
+            for span in self.spans
+        ]
+        end_ns = time.time_ns()
+        counters = [
+            {
+                "name": name,
+                "sum": {
+                    "dataPoints": [
+                        {
+                            "startTimeUnixNano": str(self.start_ns),
+                            "timeUnixNano": str(end_ns),
+                            "asInt": str(value),
+                        }
+                    ],
+                    "aggregationTemporality": 2,
+                    "isMonotonic": True,
+                },
+            }
+            for name, value in sorted(self.counters.items())
+        ]
+        resource = {
+            "attributes": [
+                {"key": "service.name", "value": {"stringValue": "perfect-prompt"}}
+            ]
+        }
+        scope = {"name": "perfect_prompt"}
+        requests = [
+            {
+                "resourceSpans": [
+                    {
+                        "resource": resource,
+                        "scopeSpans": [{"scope": scope, "spans": spans}],
+                    }
+                ]
+            },
+            {
+                "resourceMetrics": [
+                    {
+                        "resource": resource,
+                        "scopeMetrics": [{"scope": scope, "metrics": counters}],
+                    }
+                ]
+            },
+        ]
+        path.write_text(
+            "".join(json.dumps(request) + "\n" for request in requests),
+            encoding="utf-8",
+        )
+
+
+def _otlp_value(value: Any) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+_active: ContextVar[Metrics | None] = ContextVar("metrics", default=None)
+_parent: ContextVar[str | None] = ContextVar("metrics_parent", default=None)
+_attributes: ContextVar[dict[str, Any] | None] = ContextVar(
+    "metrics_attributes", default=None
+)
+
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator[None]:
+    metrics = _active.get()
+    if metrics is None:
+        yield
+        return
+
+    span_id = os.urandom(8).hex()
+    parent_id = _parent.get()
+    token = _parent.set(span_id)
+    attributes_token = _attributes.set(attributes)
+    start_ns = time.time_ns()
+    start = time.perf_counter_ns()
+    try:
+        yield
+    except BaseException as e:
+        attributes["error"] = type(e).__name__
+        raise
+    finally:
+        _parent.reset(token)
+        _attributes.reset(attributes_token)
+        metrics.add_span(
+            Span(
+                name,
+                span_id,
+                parent_id,
+                start_ns,
+                time.perf_counter_ns() - start,
+                attributes,
+            )
+        )
+
+
+def annotate(**attributes) -> None:
+    # Adds attributes to the innermost open span, if any.
+    current = _attributes.get()
+    if current is not None:
+        current.update(attributes)
+
+
+def deactivate(token: Token) -> None:
+    _active.reset(token)
+
+
+def count(name: str, n: int = 1) -> None:
+    metrics = _active.get()
+    if metrics is not None:
+        metrics.count(name, n)
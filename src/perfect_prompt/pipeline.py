@@ -0,0 +1,649 @@
+import asyncio
+import functools
+import heapq
+import itertools
+import time
+from collections.abc import Awaitable, Callable, Coroutine
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any, TypeVar
+
+import llm
+
+from . import metrics, png, refine
+from .cache import ResponseCache
+from .generate import ImageGenerator
+from .journal import NULL_JOURNAL, ChainJournal
+from .similarity import PromptIndex
+
+T = TypeVar("T")
+
+
+@dataclass
+class Candidate:
+    prompt: str
+    seed: int | None
+    image_path: Path
+    review: str = ""
+    score: float | None = None
+    present: list[str] = field(default_factory=list)
+    missing: list[str] = field(default_factory=list)
+    # Position within a batch rendered from one seed, if it was batched.
+    batch_index: int | None = None
+    # Suggested by a fused review; see `refine.review_and_revise`.
+    next_prompt: str | None = None
+
+
+# The priority of the current refine chain's jobs; see `PriorityLimit`.
+priority: ContextVar[int] = ContextVar("priority", default=0)
+
+
+class PriorityLimit:
+    """A semaphore that admits waiters with the highest `priority` first.
+
+    Waiters of equal priority are admitted in arrival order, so with a single
+    priority it behaves like `asyncio.Semaphore`. ``on_idle`` is called each
+    time the last holder releases it.
+    """
+
+    def __init__(self, value: int, on_idle: Callable[[], None] | None = None):
+        self._value = value
+        self._capacity = value
+        self._on_idle = on_idle
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._order = itertools.count()
+
+    async def acquire(self) -> None:
+        if self._value > 0 and not self._waiters:
+            self._value -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        waiter = (-priority.get(), next(self._order), future)
+        heapq.heappush(self._waiters, waiter)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.cancelled():
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    heapq.heapify(self._waiters)
+            else:
+                # Admitted just as it was cancelled, so pass the slot on.
+                self.release()
+            raise
+
+    def release(self) -> None:
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            # Skips waiters cancelled since they queued.
+            if not future.done():
+                future.set_result(None)
+                return
+        self._value += 1
+        if self._value == self._capacity and self._on_idle is not None:
+            self._on_idle()
+
+
+Limit = asyncio.Semaphore | PriorityLimit
+
+
+async def _limited(
+    limit: Limit, job: Coroutine[Any, Any, T], stage: str, iteration: int
+) -> T:
+    with metrics.span(f"{stage}.wait"):
+        try:
+            await limit.acquire()
+        except asyncio.CancelledError:
+            # Cancelled before it started.
+            job.close()
+            raise
+    try:
+        with metrics.span(stage, iteration=iteration + 1):
+            return await job
+    finally:
+        limit.release()
+
+
+async def _gather_or_cancel(*jobs: Awaitable[T]) -> list[T]:
+    # Like gather, but the first failure cancels the other jobs instead of
+    # leaving them running (and holding their limit) after the caller gave up.
+    tasks = [asyncio.ensure_future(job) for job in jobs]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+def candidate_jobs(prompts: list[str], count: int) -> list[tuple[str, int | None]]:
+    # Spread the candidates over the prompts. The first render of each prompt
+    # keeps the model's default seed so a single candidate renders exactly as
+    # before; repeats of the same prompt get seeds 1, 2, ...
+    jobs = []
+    for i in range(count):
+        repeat, index = divmod(i, len(prompts))
+        jobs.append((prompts[index], repeat or None))
+    return jobs
+
+
+def batch_jobs(jobs: list[tuple[str, int | None]], batch_size: int) -> list[list[int]]:
+    # Groups the indices of jobs for the same prompt into batches of up to
+    # batch_size. A batch renders from the seed of its first job.
+    by_prompt: dict[str, list[int]] = {}
+    for j, (prompt, _) in enumerate(jobs):
+        by_prompt.setdefault(prompt, []).append(j)
+    return [
+        indices[start : start + batch_size]
+        for indices in by_prompt.values()
+        for start in range(0, len(indices), batch_size)
+    ]
+
+
+async def generate_candidates(
+    limit: Limit,
+    generator: ImageGenerator,
+    jobs: list[tuple[str, int | None]],
+    output_dir: Path,
+    *,
+    batch_size: int = 1,
+    journal: ChainJournal = NULL_JOURNAL,
+    iteration: int = 0,
+    **kwargs,
+) -> list[Candidate]:
+    async def generate(prompt: str, seed: int | None) -> str:
+        image_path = await _limited(
+            limit,
+            generator.agenerate_image(prompt, output_dir, seed=seed, **kwargs),
+            "generate",
+            iteration,
+        )
+        return str(image_path)
+
+    async def generate_batch(prompt: str, seed: int | None, size: int) -> list[str]:
+        image_paths = await _limited(
+            limit,
+            generator.agenerate_batch(prompt, output_dir, size, seed=seed, **kwargs),
+            "generate",
+            iteration,
+        )
+        return [str(image_path) for image_path in image_paths]
+
+    async def run(indices: list[int]) -> list[str]:
+        prompt, seed = jobs[indices[0]]
+        if len(indices) == 1:
+            image_path = await journal.step(
+                f"{iteration}/image/{indices[0]}",
+                lambda: generate(prompt, seed),
+                # Re-render if the image was deleted since it was recorded.
+                valid=lambda path: Path(path).exists(),
+            )
+            return [image_path]
+        return await journal.step(
+            f"{iteration}/batch/{indices[0]}",
+            lambda: generate_batch(prompt, seed, len(indices)),
+            valid=lambda paths: all(Path(path).exists() for path in paths),
+        )
+
+    batches = (
+        batch_jobs(jobs, batch_size)
+        if batch_size > 1 and generator.supports_batch
+        else [[j] for j in range(len(jobs))]
+    )
+    results = await _gather_or_cancel(*(run(indices) for indices in batches))
+    candidates: list[Candidate | None] = [None] * len(jobs)
+    for indices, image_paths in zip(batches, results, strict=True):
+        prompt, seed = jobs[indices[0]]
+        for i, (j, image_path) in enumerate(zip(indices, image_paths, strict=True)):
+            candidates[j] = Candidate(
+                prompt,
+                seed,
+                Path(image_path),
+                batch_index=i if len(indices) > 1 else None,
+            )
+    return [candidate for candidate in candidates if candidate is not None]
+
+
+async def review_candidates(
+    limit: Limit,
+    model: llm.Model | llm.AsyncModel,
+    original_prompt: str,
+    candidates: list[Candidate],
+    temperature=None,
+    *,
+    cache: ResponseCache | None = None,
+    image_settings: refine.ReviewImageSettings = refine.DEFAULT_REVIEW_IMAGE,
+    fused: bool = False,
+    previous_attempt_pairs: list | None = None,
+    history: refine.HistorySettings = refine.DEFAULT_HISTORY,
+    journal: ChainJournal = NULL_JOURNAL,
+    iteration: int = 0,
+    on_chunk: Callable[[int, str], None] = lambda j, chunk: None,
+) -> None:
+    # Each review is passed to ``on_chunk`` with its candidate's index as it
+    # streams in; reviews replayed from the journal aren't.
+    def run(j: int, candidate: Candidate) -> Awaitable[str]:
+        receive = functools.partial(on_chunk, j)
+        if fused:
+            job = refine.areview_and_revise(
+                model,
+                original_prompt,
+                candidate.prompt,
+                candidate.image_path,
+                previous_attempt_pairs or [],
+                temperature,
+                cache,
+                image_settings,
+                history,
+                receive,
+            )
+        else:
+            job = refine.areview_image(
+                model,
+                original_prompt,
+                candidate.image_path,
+                temperature,
+                cache,
+                image_settings,
+                receive,
+            )
+        return _limited(limit, job, "review", iteration)
+
+    reviews = await _gather_or_cancel(
+        *(
+            journal.step(
+                f"{iteration}/review/{j}",
+                lambda j=j, candidate=candidate: run(j, candidate),
+            )
+            for j, candidate in enumerate(candidates)
+        )
+    )
+    for candidate, text in zip(candidates, reviews, strict=True):
+        if fused and (result := refine.parse_fused(text)) is not None:
+            candidate.next_prompt = result[1]
+        review = refine.parse_review(text)
+        candidate.review = str(review)
+        candidate.score = review.score
+        candidate.present = review.present
+        candidate.missing = review.missing
+        metadata = {"iteration": str(iteration + 1)}
+        if review.score is not None:
+            metadata["score"] = f"{review.score:g}"
+        await asyncio.to_thread(png.append_text, candidate.image_path, metadata)
+
+
+def score_key(candidate: Candidate) -> float:
+    # Unscored reviews rank last.
+    return float("-inf") if candidate.score is None else candidate.score
+
+
+def best_candidate(candidates: list[Candidate]) -> Candidate:
+    # Ties go to the earliest candidate.
+    return max(candidates, key=score_key)
+
+
+async def revise_candidates(
+    limit: Limit,
+    model: llm.Model | llm.AsyncModel,
+    original_prompt: str,
+    best: Candidate,
+    previous_attempt_pairs: list,
+    count: int,
+    temperature=None,
+    *,
+    cache: ResponseCache | None = None,
+    history: refine.HistorySettings = refine.DEFAULT_HISTORY,
+    index: PromptIndex | None = None,
+    journal: ChainJournal = NULL_JOURNAL,
+    iteration: int = 0,
+    echo: Callable[[str], None] = lambda message: None,
+) -> list[str]:
+    prompts = await _gather_or_cancel(
+        *(
+            journal.step(
+                f"{iteration}/revision/{j}",
+                lambda j=j: _limited(
+                    limit,
+                    refine.arevise_prompt(
+                        model,
+                        original_prompt,
+                        best.prompt,
+                        best.review,
+                        previous_attempt_pairs,
+                        temperature,
+                        cache=cache,
+                        variant=j,
+                        history=history,
+                        index=index,
+                        echo=echo,
+                    ),
+                    "revise",
+                    iteration,
+                ),
+            )
+            for j in range(count)
+        )
+    )
+    # Concurrent revisions can't see each other, so drop sibling duplicates.
+    siblings = PromptIndex(1.0 if index is None else index.threshold)
+    unique = []
+    for prompt in prompts:
+        if siblings.match(prompt) is None:
+            siblings.add(prompt, prompt)
+            unique.append(prompt)
+    return unique
+
+
+GENERATE = "generate"
+LLM = "llm"
+
+
+class Scheduler:
+    """Shares the image generators and the refine model between refine chains.
+
+    Generation and LLM jobs are bounded separately, so one chain's review can
+    run while another chain's image renders. With ``free_vram``, the two kinds
+    of work instead run in alternating phases: every queued generation job
+    runs, VRAM is freed once, then every queued LLM job runs, and so on.
+    Either way, queued jobs of higher-`priority` chains run first.
+
+    ``draft_generator``, if given, renders the images reviewed while refining
+    in draft mode; see `refine_chain`. ``on_llm_idle`` is called whenever the
+    last running LLM job finishes.
+    """
+
+    def __init__(
+        self,
+        generator: ImageGenerator,
+        *,
+        draft_generator: ImageGenerator | None = None,
+        gen_concurrency: int = 1,
+        llm_concurrency: int = 1,
+        free_vram: bool = False,
+        on_llm_idle: Callable[[], None] | None = None,
+    ):
+        self.generator = generator
+        self.draft_generator = draft_generator or generator
+        self.gen_limit = PriorityLimit(gen_concurrency)
+        self.llm_limit = PriorityLimit(llm_concurrency, on_idle=on_llm_idle)
+        self.free_vram = free_vram
+        self._cond = asyncio.Condition()
+        self._phase: str | None = None
+        self._active = 0
+
+    @asynccontextmanager
+    async def phase(self, kind: str):
+        if not self.free_vram:
+            yield
+            return
+
+        async with self._cond:
+            with metrics.span("phase.wait", phase=kind):
+                await self._cond.wait_for(
+                    lambda: self._phase == kind or self._active == 0
+                )
+            if self._phase != kind:
+                if self._phase == GENERATE:
+                    with metrics.span("free_vram"):
+                        await asyncio.gather(
+                            *(generator.afree_memory() for generator in self.generators)
+                        )
+                self._phase = kind
+            self._active += 1
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self._active -= 1
+                self._cond.notify_all()
+
+    @property
+    def generators(self) -> list[ImageGenerator]:
+        return list(dict.fromkeys([self.generator, self.draft_generator]))
+
+    async def aclose(self) -> None:
+        for generator in self.generators:
+            await generator.aclose()
+
+
+@dataclass(frozen=True)
+class DraftSettings:
+    """Cheaper rendering for the images reviewed while refining."""
+
+    steps: int | None = None
+    width: int | None = None
+    height: int | None = None
+
+    def overrides(self) -> dict:
+        return {key: value for key, value in asdict(self).items() if value is not None}
+
+
+@dataclass
+class Iteration:
+    candidates: list[Candidate]
+    best: Candidate
+    # Empty when the chain stopped early instead of revising.
+    refined_prompts: list[str]
+    generate_seconds: float = 0.0
+    llm_seconds: float = 0.0
+    # In draft mode, the last iteration holds the full-quality render of the
+    # best prompt.
+    final: Candidate | None = None
+
+
+def best_image(history: list[Iteration]) -> Candidate | None:
+    """The best-scoring candidate of a whole chain, or None if it has none."""
+    # Prefer the latest of equally scored prompts; it had the most feedback.
+    return max(
+        reversed([iteration.best for iteration in history]),
+        key=score_key,
+        default=None,
+    )
+
+
+async def refine_chain(
+    scheduler: Scheduler,
+    model: llm.Model | llm.AsyncModel,
+    initial_prompt: str,
+    output_dir: Path,
+    *,
+    iterations: int,
+    candidates: int = 1,
+    candidate_mode: str = "seed",
+    review_temperature=None,
+    refine_temperature=None,
+    echo: Callable[[str], None] = print,
+    on_iteration: Callable[[int, Iteration], None] = lambda i, iteration: None,
+    on_review_chunk: Callable[[int, int, str], None] = lambda i, j, chunk: None,
+    journal: ChainJournal = NULL_JOURNAL,
+    llm_cache: ResponseCache | None = None,
+    review_image: refine.ReviewImageSettings = refine.DEFAULT_REVIEW_IMAGE,
+    history: refine.HistorySettings = refine.DEFAULT_HISTORY,
+    similarity_threshold: float = 0.9,
+    draft: DraftSettings | None = None,
+    fused: bool = False,
+    target_score: float | None = None,
+    patience: int | None = None,
+    batch_size: int = 1,
+    **gen_kwargs,
+) -> list[Iteration]:
+    """Render, review and revise a prompt for up to ``iterations`` rounds.
+
+    With ``draft``, every round renders with the scheduler's draft generator
+    and the draft overrides, and only the best prompt is then rendered again
+    with the full-quality generator; ``on_iteration`` is then called again for
+    the last round, with its ``final`` render set. With ``fused``, each review
+    also suggests the next prompt, which saves the separate revision call.
+    ``on_review_chunk`` receives each review, with its iteration and candidate
+    index, as it streams in.
+    """
+    revisions = candidates if candidate_mode == "prompt" else 1
+    generator, draft_kwargs = scheduler.generator, gen_kwargs
+    if draft is not None:
+        generator = scheduler.draft_generator
+        draft_kwargs = gen_kwargs | draft.overrides()
+
+    current_prompts = [initial_prompt]
+    previous_attempts = []
+    completed = []
+    # Every prompt rendered so far, so revisions don't waste renders on
+    # near-duplicates of them.
+    tried = PromptIndex(similarity_threshold)
+    best_score = float("-inf")
+    stale = 0
+    for i in range(iterations):
+        echo(f"Iteration {i + 1}/{iterations}")
+        jobs = candidate_jobs(current_prompts, candidates)
+        for current_prompt in current_prompts:
+            echo(f"Prompt: {current_prompt}")
+
+        async with scheduler.phase(GENERATE):
+            start = time.perf_counter()
+            results = await generate_candidates(
+                scheduler.gen_limit,
+                generator,
+                jobs,
+                output_dir,
+                batch_size=batch_size,
+                journal=journal,
+                iteration=i,
+                # Lets a multi-server generator keep the chain on one server.
+                affinity=initial_prompt,
+                **draft_kwargs,
+            )
+            generate_seconds = time.perf_counter() - start
+
+        async with scheduler.phase(LLM):
+            start = time.perf_counter()
+            await review_candidates(
+                scheduler.llm_limit,
+                model,
+                initial_prompt,
+                results,
+                temperature=review_temperature,
+                cache=llm_cache,
+                image_settings=review_image,
+                fused=fused,
+                previous_attempt_pairs=previous_attempts,
+                history=history,
+                journal=journal,
+                iteration=i,
+                on_chunk=functools.partial(on_review_chunk, i),
+            )
+            best = best_candidate(results)
+            for prompt in dict.fromkeys(candidate.prompt for candidate in results):
+                # The best prompt is numbered in the next revision request.
+                label = f"Prompt #{i + 1}" if prompt == best.prompt else f'"{prompt}"'
+                tried.add(prompt, label)
+            if score_key(best) > best_score:
+                best_score = score_key(best)
+                stale = 0
+            elif best_score > float("-inf"):
+                # Patience only runs once some review has given a score.
+                stale += 1
+            stop_reason = None
+            if target_score is not None and score_key(best) >= target_score:
+                stop_reason = f"Reached target score {target_score:g}"
+            elif patience is not None and stale >= patience:
+                stop_reason = f"No improvement in {stale} iterations"
+            if stop_reason:
+                # No point paying for a revision that will never be rendered.
+                current_prompts = []
+            else:
+                current_prompts = []
+                # A fused review's suggestion stands in for one revision,
+                # unless it repeats a prompt already tried.
+                if best.next_prompt and tried.match(best.next_prompt) is None:
+                    current_prompts.append(best.next_prompt)
+                current_prompts += await revise_candidates(
+                    scheduler.llm_limit,
+                    model,
+                    initial_prompt,
+                    best,
+                    previous_attempts,
+                    revisions - len(current_prompts),
+                    temperature=refine_temperature,
+                    cache=llm_cache,
+                    history=history,
+                    index=tried,
+                    journal=journal,
+                    iteration=i,
+                    echo=echo,
+                )
+            llm_seconds = time.perf_counter() - start
+
+        for j, candidate in enumerate(results):
+            if candidates > 1:
+                batch_index = (
+                    ""
+                    if candidate.batch_index is None
+                    else f", batch index={candidate.batch_index}"
+                )
+                echo(
+                    f"Candidate {j + 1}/{candidates}: seed={candidate.seed}"
+                    f"{batch_index}, score={candidate.score}"
+                )
+            echo(f"Image: {candidate.image_path}")
+            echo(f"Review: {candidate.review}")
+        if candidates > 1:
+            echo(f"Best candidate: {best.image_path}")
+
+        previous_attempts.append((best.prompt, best.review))
+        completed.append(
+            Iteration(results, best, current_prompts, generate_seconds, llm_seconds)
+        )
+        on_iteration(i, completed[-1])
+        if stop_reason:
+            echo(f"{stop_reason}; stopping early")
+            break
+        echo("\n\n")
+
+    if draft is not None and (best := best_image(completed)) is not None:
+        generator = scheduler.generator
+        # An image's noise depends on its position in a batch as well as the
+        # seed, so a later image of a batch is reproduced by rendering the
+        # batch up to it.
+        batch_size = (
+            best.batch_index + 1 if best.batch_index and generator.supports_batch else 1
+        )
+
+        async def render() -> str:
+            options = {"seed": best.seed, "affinity": initial_prompt, **gen_kwargs}
+            if batch_size == 1:
+                image_path = await _limited(
+                    scheduler.gen_limit,
+                    generator.agenerate_image(best.prompt, output_dir, **options),
+                    "generate",
+                    len(completed),
+                )
+                return str(image_path)
+            *others, image_path = await _limited(
+                scheduler.gen_limit,
+                generator.agenerate_batch(
+                    best.prompt, output_dir, batch_size, **options
+                ),
+                "generate",
+                len(completed),
+            )
+            for path in others:
+                path.unlink(missing_ok=True)
+            return str(image_path)
+
+        echo(f"Rendering the best prompt at full quality: {best.prompt}")
+        async with scheduler.phase(GENERATE):
+            image_path = await journal.step(
+                "final/image", render, valid=lambda path: Path(path).exists()
+            )
+        completed[-1].final = Candidate(
+            best.prompt,
+            best.seed,
+            Path(image_path),
+            batch_index=best.batch_index if batch_size > 1 else None,
+        )
+        echo(f"Final image: {image_path}")
+        on_iteration(len(completed) - 1, completed[-1])
+
+    return completed
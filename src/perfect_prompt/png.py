@@ -0,0 +1,72 @@
+import struct
+import zlib
+from collections.abc import Iterator, Mapping
+from pathlib import Path
+from typing import BinaryIO
+
+SIGNATURE = b"\x89PNG\r\n\x1a\n"
+IEND = struct.pack(">I", 0) + b"IEND" + struct.pack(">I", zlib.crc32(b"IEND"))
+
+
+def chunk(kind: bytes, data: bytes) -> bytes:
+    return (
+        struct.pack(">I", len(data))
+        + kind
+        + data
+        + struct.pack(">I", zlib.crc32(kind + data))
+    )
+
+
+def text_chunk(keyword: str, text: str) -> bytes:
+    # tEXt is Latin-1 only; anything else goes in an uncompressed iTXt chunk.
+    try:
+        return chunk(
+            b"tEXt", keyword.encode("latin-1") + b"\0" + text.encode("latin-1")
+        )
+    except UnicodeEncodeError:
+        return chunk(
+            b"iTXt",
+            keyword.encode("latin-1") + b"\0\0\0\0\0" + text.encode("utf-8"),
+        )
+
+
+def _read_chunks(f: BinaryIO) -> Iterator[tuple[int, bytes, bytes | None]]:
+    # Yields each chunk's offset and type, and the keyword of text chunks,
+    # seeking past the data of every other chunk.
+    if f.read(len(SIGNATURE)) != SIGNATURE:
+        raise ValueError("not a PNG file")
+    while header := f.read(8):
+        offset = f.tell() - 8
+        length, kind = struct.unpack(">I4s", header)
+        keyword = None
+        if kind in (b"tEXt", b"iTXt", b"zTXt"):
+            data = f.read(length)
+            keyword = data.split(b"\0", 1)[0]
+            f.seek(4, 1)
+        else:
+            f.seek(length + 4, 1)
+        yield offset, kind, keyword
+
+
+def append_text(path: Path, text: Mapping[str, str]) -> None:
+    """Add text chunks to a PNG file in place, just before IEND.
+
+    Only the end of the file is rewritten, so this is cheap even for large
+    images. Keywords already in the image are kept as they are: ComfyUI, for
+    one, stores its workflow under "prompt", and overwriting it would stop the
+    image from loading back into ComfyUI.
+    """
+    with path.open("r+b") as f:
+        chunks = list(_read_chunks(f))
+        if not chunks or chunks[-1][1] != b"IEND":
+            raise ValueError(f"{path}: PNG has no IEND chunk")
+        existing = {keyword for _, _, keyword in chunks if keyword}
+        new = b"".join(
+            text_chunk(keyword, value)
+            for keyword, value in text.items()
+            if keyword.encode("latin-1") not in existing
+        )
+        if new:
+            f.seek(chunks[-1][0])
+            f.write(new + IEND)
+            f.truncate()
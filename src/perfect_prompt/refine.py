@@ -1,8 +1,28 @@
+import hashlib
+import io
+import json
+import re
 import textwrap
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable, Coroutine
+from dataclasses import asdict, dataclass, field
 from pathlib import Path
+from typing import TYPE_CHECKING, Any, Literal, TypeVar, overload
 
-import llm
-import llm_mistral
+from . import metrics
+from .cache import ResponseCache, cache_key
+from .similarity import PromptIndex
+
+# llm (with its plugins), PIL and asyncio are slow to import, so they are only
+# imported once they're needed, which keeps `--help` and `--version` fast.
+if TYPE_CHECKING:
+    import llm
+
+    RefineModel = llm.Model | llm.AsyncModel
+
+T = TypeVar("T")
 
 
 def create_review_prompt(original_prompt: str) -> str:
@@ -15,19 +35,74 @@ def create_review_prompt(original_prompt: str) -> str:
     return template.format(original_prompt=original_prompt)
 
 
+HISTORY_STRATEGIES = ("all", "last", "best", "summary")
+
+
+@dataclass(frozen=True)
+class HistorySettings:
+    """Which previous attempts a revision prompt shows the refine model.
+
+    "all" shows every attempt in full, so the prompt grows with each
+    iteration. The others show the latest attempt plus ``size - 1`` more:
+    "last" the most recent ones, "best" the best-scoring ones, and "summary"
+    the most recent ones, with every older attempt cut down to its prompt and
+    score.
+    """
+
+    strategy: str = "all"
+    size: int = 3
+
+
+DEFAULT_HISTORY = HistorySettings()
+
+
+def format_attempts(attempt_pairs: list, history: HistorySettings) -> str:
+    if not attempt_pairs:
+        return ""
+    attempts = list(enumerate(attempt_pairs))
+    *older, latest = attempts
+    summarized = []
+    if history.strategy == "all":
+        shown = attempts
+    elif history.strategy == "best":
+        # Ties go to the earliest attempt, so the selection rarely changes.
+        best = sorted(
+            older,
+            key=lambda attempt: -(parse_review(attempt[1][1]).score or 0),
+        )[: history.size - 1]
+        shown = sorted(best) + [latest]
+    else:
+        shown = attempts[-history.size :]
+        if history.strategy == "summary":
+            summarized = attempts[: -history.size]
+
+    # Attempts keep their numbers and stay in order, and summaries come first,
+    # so that consecutive revision prompts share as long a prefix as possible
+    # and providers' prompt caches can skip re-reading it.
+    previous_attempts = "\n\n".join(
+        [
+            f"Prompt #{i + 1}: {prompt}\nPrompt #{i + 1} review: {review}"
+            for i, (prompt, review) in shown
+        ]
+    )
+    if summarized:
+        summary = "\n".join(
+            f"Prompt #{i + 1} ({_score_text(review)}): {prompt}"
+            for i, (prompt, review) in summarized
+        )
+        previous_attempts = f"{summary}\n\n{previous_attempts}"
+    return previous_attempts
+
+
 def create_revision_prompt(
     original_prompt: str,
     current_prompt: str,
     current_review: str,
     previous_attempt_pairs: list,
+    history: HistorySettings = DEFAULT_HISTORY,
 ) -> str:
-    previous_attempts = "\n\n".join(
-        [
-            f"Prompt #{i + 1}: {pair[0]}\nPrompt #{i + 1} review: {pair[1]}"
-            for i, pair in enumerate(
-                previous_attempt_pairs + [(current_prompt, current_review)]
-            )
-        ]
+    previous_attempts = format_attempts(
+        previous_attempt_pairs + [(current_prompt, current_review)], history
     )
 
     template = textwrap.dedent("""\
@@ -45,45 +120,632 @@ def create_revision_prompt(
     )
 
 
-def refine_prompt(
-    original_prompt,
-    current_prompt,
-    current_image_path: Path,
-    previous_attempt_pairs,
-    refine_model,
-    review_temperature=None,
-    refine_temperature=None,
-):
+def create_fused_prompt(
+    original_prompt: str,
+    current_prompt: str,
+    previous_attempt_pairs: list,
+    history: HistorySettings = DEFAULT_HISTORY,
+) -> str:
+    # Laid out like the revision prompt, so that the intent and the earlier
+    # attempts form a prefix that is stable from one iteration to the next.
+    previous_attempts = format_attempts(previous_attempt_pairs, history)
+    if previous_attempts:
+        previous_attempts = (
+            "Here are the previous prompt attempts, and how well each performed:\n"
+            f"{previous_attempts}\n\n"
+        )
+    template = textwrap.dedent("""\
+        We need to create a prompt for image generation that reflects the following intent:
+        {original_prompt}
+
+        {previous_attempts}The image provided was generated from this prompt:
+        {current_prompt}
+
+        First, evaluate how well the image adhered to the intent and its overall aesthetic quality: list the elements of the intent that are present and missing from the image, critique it, and score it from 1 (worst) to 10 (best). Then write a new prompt to generate an image that captures all the elements of the intent better than this and any previous attempt. Be creative; do not repeat any existing prompt.
+
+        Respond with a JSON object with the keys "present" and "missing" (lists of elements), "critique", "score" and "next_prompt".
+        """)
+    return template.format(
+        original_prompt=original_prompt,
+        previous_attempts=previous_attempts,
+        current_prompt=current_prompt,
+    )
+
+
+def _score_text(review: str) -> str:
+    score = parse_review(review).score
+    return "unscored" if score is None else f"score {score:g}/10"
+
+
+SCORE_PATTERNS = [
+    # "8/10", "8.5 / 10", "8 out of 10"
+    re.compile(r"(\d+(?:\.\d+)?)\s*(?:/|out of)\s*10\b", re.IGNORECASE),
+    # "Score: 8", "**Score:** 8", "overall score of 8"
+    re.compile(
+        r"score\W{0,4}?(?:(?:of|is)\s+)?(\d+(?:\.\d+)?)(?!-|\d|\.\d)", re.IGNORECASE
+    ),
+]
+# "(1-10)", "(0 to 10)": the scale, not the score.
+_SCALE = re.compile(r"\(\s*\d+\s*(?:-|–|to)\s*\d+\s*\)", re.IGNORECASE)
+
+
+def parse_score(review: str) -> float | None:
+    """Extract the final 1-10 score from a free-form review, if present."""
+    review = _SCALE.sub("", review)
+    for pattern in SCORE_PATTERNS:
+        matches = [float(m) for m in pattern.findall(review) if 0 <= float(m) <= 10]
+        if matches:
+            # The prompt asks for the overall score last.
+            return matches[-1]
+    return None
+
+
+REVIEW_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "present": {"type": "array", "items": {"type": "string"}},
+        "missing": {"type": "array", "items": {"type": "string"}},
+        "critique": {"type": "string"},
+        "score": {"type": "number"},
+    },
+    "required": ["present", "missing", "critique", "score"],
+}
+
+
+FUSED_SCHEMA = {
+    "type": "object",
+    "properties": {
+        **REVIEW_SCHEMA["properties"],
+        "next_prompt": {"type": "string"},
+    },
+    "required": [*REVIEW_SCHEMA["required"], "next_prompt"],
+}
+
+
+@dataclass
+class Review:
+    score: float | None
+    critique: str
+    present: list[str] = field(default_factory=list)
+    missing: list[str] = field(default_factory=list)
+    structured: bool = False
+
+    def __str__(self) -> str:
+        if not self.structured:
+            return self.critique
+        lines = [
+            f"Present: {', '.join(self.present) or 'none'}",
+            f"Missing: {', '.join(self.missing) or 'none'}",
+        ]
+        if self.critique:
+            lines.append(self.critique)
+        if self.score is not None:
+            lines.append(f"Score: {self.score:g}/10")
+        return "\n".join(lines)
+
+
+def _score(value) -> float | None:
+    try:
+        score = float(value)
+    except (TypeError, ValueError):
+        return None
+    return score if 0 <= score <= 10 else None
+
+
+def _strings(value) -> list[str]:
+    if not isinstance(value, list):
+        return []
+    return [str(item).strip() for item in value if str(item).strip()]
+
+
+def parse_review(text: str) -> Review:
+    """Parse a review, whether JSON (with or without a schema) or free-form."""
+    # Models without schema support sometimes still answer in JSON, often
+    # wrapped in a Markdown code fence.
+    start, end = text.find("{"), text.rfind("}")
+    if start != -1 and end > start:
+        try:
+            data = json.loads(text[start : end + 1])
+        except json.JSONDecodeError:
+            data = None
+        if isinstance(data, dict) and "score" in data:
+            return Review(
+                score=_score(data.get("score")),
+                critique=str(data.get("critique") or "").strip(),
+                present=_strings(data.get("present")),
+                missing=_strings(data.get("missing")),
+                structured=True,
+            )
+    return Review(score=parse_score(text), critique=text.strip())
+
+
+def parse_fused(text: str) -> tuple[Review, str] | None:
+    """Parse a combined review and next prompt; None unless it has both."""
+    review = parse_review(text)
+    if not review.structured or review.score is None:
+        return None
+    start, end = text.find("{"), text.rfind("}")
+    next_prompt = json.loads(text[start : end + 1]).get("next_prompt")
+    if not isinstance(next_prompt, str) or not next_prompt.strip():
+        return None
+    return review, next_prompt.strip()
+
+
+REVIEW_IMAGE_FORMATS = {
+    "png": ("PNG", "image/png"),
+    "jpeg": ("JPEG", "image/jpeg"),
+    "webp": ("WEBP", "image/webp"),
+}
+
+
+@dataclass(frozen=True)
+class ReviewImageSettings:
+    """How images are encoded for the refine model."""
+
+    # Longest side in pixels; larger images are scaled down to fit.
+    max_side: int | None = None
+    format: str = "png"
+    # For lossy formats.
+    quality: int = 85
+
+
+DEFAULT_REVIEW_IMAGE = ReviewImageSettings()
+
+_encoded_images: OrderedDict[tuple[str, ReviewImageSettings], tuple[bytes, str]] = (
+    OrderedDict()
+)
+_encoded_images_lock = threading.Lock()
+ENCODED_IMAGES_CACHE_SIZE = 32
+
+
+def encode_review_image(
+    image_bytes: bytes, settings: ReviewImageSettings
+) -> tuple[bytes, str]:
+    """Return the attachment bytes and MIME type for a (PNG) image."""
+    from PIL import Image
+
+    pil_format, mime_type = REVIEW_IMAGE_FORMATS[settings.format]
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        if settings.max_side is not None and max(image.size) > settings.max_side:
+            image.thumbnail(
+                (settings.max_side, settings.max_side), Image.Resampling.LANCZOS
+            )
+        elif image.format == pil_format:
+            return image_bytes, mime_type
+        if pil_format == "JPEG" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        buffer = io.BytesIO()
+        image.save(buffer, pil_format, quality=settings.quality)
+    return buffer.getvalue(), mime_type
+
+
+def _cached_review_image(
+    image_hash: str, image_bytes: bytes, settings: ReviewImageSettings
+) -> tuple[bytes, str]:
+    # Kept for a few recent images, so that reviewing the same image more than
+    # once (e.g. re-reviews of a cached render) encodes it only once.
+    key = (image_hash, settings)
+    with _encoded_images_lock:
+        if key in _encoded_images:
+            _encoded_images.move_to_end(key)
+            return _encoded_images[key]
+    with metrics.span("review_image.encode"):
+        encoded = encode_review_image(image_bytes, settings)
+    with _encoded_images_lock:
+        _encoded_images[key] = encoded
+        while len(_encoded_images) > ENCODED_IMAGES_CACHE_SIZE:
+            _encoded_images.popitem(last=False)
+    return encoded
+
+
+@overload
+def get_refine_model(
+    refine_model: str, *, prefer_async: Literal[False] = False
+) -> "llm.Model": ...
+
+
+@overload
+def get_refine_model(refine_model: str, *, prefer_async: bool) -> "RefineModel": ...
+
+
+def get_refine_model(refine_model: str, *, prefer_async: bool = False) -> "RefineModel":
+    """Look up a refine model by id or alias.
+
+    With ``prefer_async``, the model's async variant is returned if its plugin
+    has one, so that calls to it don't each tie up a thread.
+    """
+    import llm
+    import llm_mistral
+
+    def get() -> "RefineModel":
+        if prefer_async:
+            try:
+                return llm.get_async_model(refine_model)
+            except llm.UnknownModelError:
+                pass
+        return llm.get_model(refine_model)
+
+    try:
+        return get()
+    except llm.UnknownModelError:
+        # Refreshing fetches the Mistral model list over the network, so only do
+        # it for ids that might be newly released Mistral models.
+        if not llm.get_key("", "mistral", "LLM_MISTRAL_KEY"):
+            raise
     llm_mistral.refresh_models()
-    model = llm.get_model(refine_model)
+    return get()
 
+
+def preload_model(model: "RefineModel", keep_alive: str) -> None:
+    """Load an Ollama model and keep it loaded for ``keep_alive``.
+
+    Other models are loaded on demand by their providers; this is a no-op.
+    """
+    import llm_ollama
+
+    if isinstance(model, (llm_ollama.Ollama, llm_ollama.AsyncOllama)):
+        import ollama
+
+        # A generate request without a prompt just loads the model.
+        ollama.Client().generate(model=model.model_id, keep_alive=keep_alive)
+
+
+def _run(coro: Coroutine[Any, Any, T]) -> T:
+    # The sync API runs the async one on a private event loop, which (unlike a
+    # shared one) keeps the caller's metrics context.
+    import asyncio
+
+    return asyncio.run(coro)
+
+
+async def _stream(response, receive: Callable[[str], None]) -> "llm.Usage":
+    # Cancelling mid-stream cancels the plugin's request, which closes its
+    # connection too.
+    async for chunk in response:
+        receive(chunk)
+    return await response.usage()
+
+
+async def _stream_in_thread(response, receive: Callable[[str], None]) -> "llm.Usage":
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    cancelled = threading.Event()
+
+    def run() -> "llm.Usage | None":
+        for chunk in response:
+            if cancelled.is_set():
+                # A thread can't be interrupted, but it can stop reading.
+                return None
+            loop.call_soon_threadsafe(receive, chunk)
+        return response.usage()
+
+    try:
+        usage = await asyncio.to_thread(run)
+    except asyncio.CancelledError:
+        cancelled.set()
+        raise
+    assert usage is not None
+    return usage
+
+
+async def aprompt_text(
+    model: "RefineModel",
+    prompt: str,
+    *,
+    image_path: Path | None = None,
+    image_settings: ReviewImageSettings = DEFAULT_REVIEW_IMAGE,
+    temperature=None,
+    schema: dict | None = None,
+    cache: ResponseCache | None = None,
+    variant: int = 0,
+    attempt: int = 0,
+    on_chunk: Callable[[str], None] | None = None,
+) -> str:
+    """Prompt the model and return its whole answer.
+
+    The answer is streamed, and passed to ``on_chunk`` on the event loop as it
+    arrives (all at once if it was cached). Async models are called on the
+    event loop, and sync ones in a worker thread. If the call is cancelled,
+    the response stops being read and nothing is cached.
+    """
+    import asyncio
+
+    import llm
+
+    # The image is read once and handed to both the cache key and the model,
+    # rather than letting the attachment re-read it (and sniff its type).
+    metrics.annotate(prompt_chars=len(prompt))
+    image_bytes = await asyncio.to_thread(image_path.read_bytes) if image_path else None
+    image_hash = hashlib.sha256(image_bytes).hexdigest() if image_bytes else None
+
+    async def run() -> str:
+        attachments = []
+        if image_path and image_bytes and image_hash:
+            # Only encoded on a cache miss.
+            content, mime_type = await asyncio.to_thread(
+                _cached_review_image, image_hash, image_bytes, image_settings
+            )
+            attachments.append(
+                llm.Attachment(type=mime_type, path=str(image_path), content=content)
+            )
+        metrics.count("llm.calls")
+        chunks = []
+        start = time.perf_counter()
+
+        def receive(chunk: str) -> None:
+            if not chunks:
+                metrics.annotate(first_chunk_seconds=time.perf_counter() - start)
+            chunks.append(chunk)
+            if on_chunk is not None:
+                on_chunk(chunk)
+
+        response = model.prompt(
+            prompt, attachments=attachments, schema=schema, temperature=temperature
+        )
+        if isinstance(model, (llm.AsyncModel, llm.AsyncKeyModel)):
+            usage = await _stream(response, receive)
+        else:
+            usage = await _stream_in_thread(response, receive)
+        if usage.input is not None:
+            metrics.count("llm.input_tokens", usage.input)
+            metrics.annotate(input_tokens=usage.input)
+        if usage.output is not None:
+            metrics.count("llm.output_tokens", usage.output)
+            metrics.annotate(output_tokens=usage.output)
+        return "".join(chunks)
+
+    if cache is None:
+        return await run()
+
+    # Images are keyed by content, so a re-rendered identical image still hits.
+    # Sibling variants and retries are keyed separately so that they don't all
+    # replay the same response.
+    key = cache_key(
+        model.model_id,
+        prompt,
+        image_hash,
+        asdict(image_settings) if image_hash else None,
+        temperature,
+        schema,
+        variant,
+        attempt,
+    )
+    text = await asyncio.to_thread(cache.get, key)
+    if text is not None:
+        metrics.count("llm.cache_hits")
+        metrics.annotate(cached=True)
+        if on_chunk is not None:
+            on_chunk(text)
+    else:
+        text = await run()
+        await asyncio.to_thread(cache.put, key, text)
+    return text
+
+
+def prompt_text(model: "RefineModel", prompt: str, **kwargs) -> str:
+    return _run(aprompt_text(model, prompt, **kwargs))
+
+
+async def areview_image(
+    model: "RefineModel",
+    original_prompt: str,
+    image_path: Path,
+    temperature=None,
+    cache: ResponseCache | None = None,
+    image_settings: ReviewImageSettings = DEFAULT_REVIEW_IMAGE,
+    on_chunk: Callable[[str], None] | None = None,
+) -> str:
     review_prompt = create_review_prompt(original_prompt)
 
-    review = model.prompt(
-        review_prompt,
-        attachments=[llm.Attachment(path=str(current_image_path))],
-        temperature=review_temperature,
-    ).text()
+    # The raw response is returned so it can be journaled; see `parse_review`.
+    with metrics.span("llm.review"):
+        return await aprompt_text(
+            model,
+            review_prompt,
+            image_path=image_path,
+            image_settings=image_settings,
+            temperature=temperature,
+            schema=REVIEW_SCHEMA if getattr(model, "supports_schema", False) else None,
+            cache=cache,
+            on_chunk=on_chunk,
+        )
+
+
+def review_image(
+    model: "RefineModel", original_prompt: str, image_path: Path, *args, **kwargs
+) -> str:
+    return _run(areview_image(model, original_prompt, image_path, *args, **kwargs))
+
+
+async def areview_and_revise(
+    model: "RefineModel",
+    original_prompt: str,
+    current_prompt: str,
+    image_path: Path,
+    previous_attempt_pairs: list,
+    temperature=None,
+    cache: ResponseCache | None = None,
+    image_settings: ReviewImageSettings = DEFAULT_REVIEW_IMAGE,
+    history: HistorySettings = DEFAULT_HISTORY,
+    on_chunk: Callable[[str], None] | None = None,
+) -> str:
+    """Review an image and suggest the next prompt in a single call.
+
+    Returns the raw response, which `parse_fused` splits into the review and
+    the next prompt. If the model's answer can't be parsed, the image is
+    reviewed on its own instead, and `parse_fused` returns None.
+    """
+    with metrics.span("llm.review_and_revise"):
+        text = await aprompt_text(
+            model,
+            create_fused_prompt(
+                original_prompt, current_prompt, previous_attempt_pairs, history
+            ),
+            image_path=image_path,
+            image_settings=image_settings,
+            temperature=temperature,
+            schema=FUSED_SCHEMA if getattr(model, "supports_schema", False) else None,
+            cache=cache,
+            on_chunk=on_chunk,
+        )
+    if parse_fused(text) is not None:
+        return text
+    metrics.count("llm.fused_fallbacks")
+    return await areview_image(
+        model, original_prompt, image_path, temperature, cache, image_settings, on_chunk
+    )
+
 
+def review_and_revise(model: "RefineModel", *args, **kwargs) -> str:
+    return _run(areview_and_revise(model, *args, **kwargs))
+
+
+async def arevise_prompt(
+    model: "RefineModel",
+    original_prompt: str,
+    current_prompt: str,
+    review: str,
+    previous_attempt_pairs,
+    temperature=None,
+    cache: ResponseCache | None = None,
+    variant: int = 0,
+    history: HistorySettings = DEFAULT_HISTORY,
+    index: PromptIndex | None = None,
+    echo: Callable[[str], None] = lambda message: None,
+) -> str:
+    """Ask the model for a new prompt, retrying near-duplicates of tried ones.
+
+    Without an ``index`` of the prompts tried so far, only the attempts
+    passed in count, and only when they match up to case, punctuation and
+    clause order.
+    """
     revision_prompt = create_revision_prompt(
-        original_prompt, current_prompt, review, previous_attempt_pairs
+        original_prompt, current_prompt, review, previous_attempt_pairs, history
     )
+    if index is None:
+        index = PromptIndex(1.0)
+        tried = previous_attempt_pairs + [(current_prompt, review)]
+        for i, (prompt, _) in enumerate(tried):
+            index.add(prompt, f"Prompt #{i + 1}")
 
     max_attempts = 3
     attempts = 0
     refined_prompt = current_prompt
+    hint = ""
     while attempts < max_attempts:
-        refined_prompt = model.prompt(
-            revision_prompt, temperature=refine_temperature
-        ).text()
-
-        if (
-            refined_prompt not in [pair[0] for pair in previous_attempt_pairs]
-            and refined_prompt != current_prompt
-        ):
+        with metrics.span("llm.revise", attempt=attempts):
+            refined_prompt = await aprompt_text(
+                model,
+                revision_prompt + hint,
+                temperature=temperature,
+                cache=cache,
+                variant=variant,
+                attempt=attempts,
+            )
+
+        duplicate = index.match(refined_prompt)
+        if duplicate is None:
             break
 
-        print("Skipping duplicate prompt")
+        label, score = duplicate
+        echo(f"Skipping prompt too similar to {label} ({score:.0%})")
+        metrics.count("llm.duplicate_retries")
+        # Appended, so the retry shares the whole first request as a prefix.
+        hint = (
+            f"\nYour last suggestion was:\n{refined_prompt}\n\n"
+            f"It was rejected as too similar to {label}, which was already "
+            "tried. Write a substantially different prompt.\n"
+        )
         attempts += 1
 
+    return refined_prompt
+
+
+def revise_prompt(model: "RefineModel", *args, **kwargs) -> str:
+    return _run(arevise_prompt(model, *args, **kwargs))
+
+
+async def _refine_prompt(
+    model: "RefineModel",
+    original_prompt,
+    current_prompt,
+    current_image_path: Path,
+    previous_attempt_pairs,
+    review_temperature=None,
+    refine_temperature=None,
+    on_chunk: Callable[[str], None] | None = None,
+) -> tuple[str, str]:
+    review = str(
+        parse_review(
+            await areview_image(
+                model,
+                original_prompt,
+                current_image_path,
+                temperature=review_temperature,
+                on_chunk=on_chunk,
+            )
+        )
+    )
+    refined_prompt = await arevise_prompt(
+        model,
+        original_prompt,
+        current_prompt,
+        review,
+        previous_attempt_pairs,
+        temperature=refine_temperature,
+    )
+
     return review, refined_prompt
+
+
+def refine_prompt(
+    original_prompt,
+    current_prompt,
+    current_image_path: Path,
+    previous_attempt_pairs,
+    refine_model,
+    review_temperature=None,
+    refine_temperature=None,
+):
+    model = get_refine_model(refine_model)
+    return _run(
+        _refine_prompt(
+            model,
+            original_prompt,
+            current_prompt,
+            current_image_path,
+            previous_attempt_pairs,
+            review_temperature,
+            refine_temperature,
+        )
+    )
+
+
+async def arefine_prompt(
+    original_prompt,
+    current_prompt,
+    current_image_path: Path,
+    previous_attempt_pairs,
+    refine_model,
+    review_temperature=None,
+    refine_temperature=None,
+    on_chunk: Callable[[str], None] | None = None,
+) -> tuple[str, str]:
+    """Like `refine_prompt`, but without blocking the event loop.
+
+    Uses the model's async variant if its plugin has one, so that any number
+    of calls can share one event loop; ``on_chunk`` receives the review as
+    it streams in.
+    """
+    model = get_refine_model(refine_model, prefer_async=True)
+    return await _refine_prompt(
+        model,
+        original_prompt,
+        current_prompt,
+        current_image_path,
+        previous_attempt_pairs,
+        review_temperature,
+        refine_temperature,
+        on_chunk,
+    )
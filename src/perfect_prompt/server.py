@@ -0,0 +1,372 @@
+import asyncio
+import itertools
+import json
+import re
+import threading
+import time
+import uuid
+from collections import deque
+from collections.abc import AsyncIterator, Iterator
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import urlsplit
+
+import click
+
+from . import batch, pipeline
+from .journal import JOURNAL_NAME, Journal
+from .session import Session
+
+# Chain options a job may override, checked as the command line checks them;
+# the rest are fixed when the server starts.
+JOB_OPTIONS: dict[str, click.ParamType] = {
+    "iterations": click.IntRange(min=1),
+    "candidates": click.IntRange(min=1),
+    "target_score": click.FloatRange(0, 10),
+    "patience": click.IntRange(min=1),
+}
+FINISHED = ("done", "failed", "cancelled")
+# Finished jobs beyond this many are forgotten, oldest first.
+MAX_FINISHED_JOBS = 1000
+
+_JOB_ID = re.compile(r"[A-Za-z0-9_-]+")
+_JOB_PATH = re.compile(r"/jobs/([A-Za-z0-9_-]+)(/events)?")
+
+
+class JobConflict(ValueError):
+    pass
+
+
+@dataclass
+class Job:
+    id: str
+    prompt: str
+    priority: int
+    options: dict
+    status: str = "queued"
+    events: list[dict] = field(default_factory=list)
+    result: dict | None = None
+    task: asyncio.Task | None = None
+    # Jobs change on the event loop and are read from HTTP handler threads.
+    _changed: threading.Condition = field(default_factory=threading.Condition)
+
+    def emit(self, event: dict, status: str | None = None) -> None:
+        with self._changed:
+            if status is not None:
+                self.status = status
+            self.events.append({"job": self.id, **event})
+            if self.status in FINISHED:
+                # Streamed reviews are only kept while the job runs. Followers
+                # keep the list they started with, so none of them miss a chunk.
+                self.events = [e for e in self.events if e["type"] != "review_chunk"]
+            self._changed.notify_all()
+
+    def follow(self) -> Iterator[dict]:
+        """Every event so far, then each new one until the job finishes."""
+        with self._changed:
+            events = self.events
+        seen = 0
+        while True:
+            with self._changed:
+                while len(events) == seen and self.status not in FINISHED:
+                    self._changed.wait()
+                new = events[seen:]
+                finished = self.status in FINISHED
+            yield from new
+            seen += len(new)
+            if finished:
+                return
+
+    def summary(self) -> dict:
+        return {
+            "id": self.id,
+            "prompt": self.prompt,
+            "priority": self.priority,
+            "status": self.status,
+            "result": self.result,
+        }
+
+
+class JobQueue:
+    """Refinement jobs, run highest priority first on one long-lived session.
+
+    Up to ``concurrency`` jobs run at once. Their renders and LLM calls then
+    queue for the session's scheduler, which also serves higher-priority jobs
+    first. Each job's images and journal are written under
+    ``output_dir/<job id>``; with ``resume``, a job resubmitted under the same
+    id picks up where its journal left off.
+    """
+
+    def __init__(
+        self,
+        session: Session,
+        output_dir: Path,
+        concurrency: int,
+        *,
+        resume: bool = False,
+    ):
+        self.session = session
+        self.output_dir = output_dir
+        self.concurrency = concurrency
+        self.resume = resume
+        self.jobs: dict[str, Job] = {}
+        self._queue: asyncio.PriorityQueue[tuple[int, int, Job]] = (
+            asyncio.PriorityQueue()
+        )
+        self._order = itertools.count()
+        self._finished: deque[str] = deque()
+
+    def submit(self, request: dict) -> Job:
+        prompt = request.get("prompt")
+        if not isinstance(prompt, str) or not prompt.strip():
+            raise ValueError("a job needs a prompt")
+        job_id = str(request.get("id") or uuid.uuid4().hex[:12])
+        if not _JOB_ID.fullmatch(job_id):
+            raise ValueError("job ids may only contain letters, digits, - and _")
+        if job_id in self.jobs:
+            raise JobConflict(f"job {job_id} already exists")
+        priority = request.get("priority", 0)
+        if not isinstance(priority, int):
+            raise ValueError("priority must be an integer")
+        options = {}
+        for name, value in request.items():
+            if name in ("id", "prompt", "priority"):
+                continue
+            if name not in JOB_OPTIONS:
+                raise ValueError(f"unknown job option: {name}")
+            try:
+                options[name] = JOB_OPTIONS[name].convert(value, None, None)
+            except click.BadParameter as e:
+                raise ValueError(f"{name}: {e.message}") from None
+        prompt = prompt.strip()
+        if self.resume:
+            journaled = _journaled_prompt(self.output_dir / job_id / JOURNAL_NAME)
+            if journaled is not None and journaled != prompt:
+                raise JobConflict(f"job {job_id} was run with a different prompt")
+
+        job = Job(job_id, prompt, priority, options)
+        self.jobs[job_id] = job
+        self._queue.put_nowait((-priority, next(self._order), job))
+        job.emit({"type": "queued"})
+        return job
+
+    def cancel(self, job: Job) -> None:
+        if job.status == "queued":
+            # Its worker skips it when it reaches the front of the queue.
+            job.emit({"type": "cancelled"}, "cancelled")
+            self._forget_finished(job)
+        elif job.task is not None:
+            job.task.cancel()
+
+    async def run(self) -> None:
+        await asyncio.gather(*(self._worker() for _ in range(self.concurrency)))
+
+    async def _worker(self) -> None:
+        while True:
+            _, _, job = await self._queue.get()
+            if job.status != "queued":
+                continue
+            # A task of its own, so cancelling the job leaves the worker running.
+            job.task = asyncio.create_task(self._run(job))
+            await asyncio.wait([job.task])
+            self._forget_finished(job)
+
+    async def _run(self, job: Job) -> None:
+        # Set in the job's own task, so every stage it schedules inherits it.
+        pipeline.priority.set(job.priority)
+        job.emit({"type": "started"}, "running")
+        start = time.perf_counter()
+
+        def on_iteration(i: int, iteration: pipeline.Iteration) -> None:
+            if iteration.final is not None:
+                # The best draft prompt, rendered again at full quality.
+                job.emit(
+                    {
+                        "type": "final",
+                        "prompt": iteration.final.prompt,
+                        "image_path": str(iteration.final.image_path),
+                    }
+                )
+                return
+            best = iteration.best
+            job.emit(
+                {
+                    "type": "iteration",
+                    "iteration": i + 1,
+                    "prompt": best.prompt,
+                    "image_path": str(best.image_path),
+                    "review": best.review,
+                    "score": best.score,
+                    "next_prompts": iteration.refined_prompts,
+                }
+            )
+
+        def on_review_chunk(i: int, j: int, chunk: str) -> None:
+            job.emit(
+                {
+                    "type": "review_chunk",
+                    "iteration": i + 1,
+                    "candidate": j,
+                    "text": chunk,
+                }
+            )
+
+        output_dir = self.output_dir / job.id
+        try:
+            output_dir.mkdir(parents=True, exist_ok=True)
+            # One journal per job, closed when it ends, so the server holds
+            # nothing for finished jobs and no file grows without bound.
+            with Journal(output_dir / JOURNAL_NAME, resume=self.resume) as journal:
+                chain_journal = journal.chain(job.id, job.prompt)
+                history = await pipeline.refine_chain(
+                    self.session.scheduler,
+                    self.session.model,
+                    job.prompt,
+                    output_dir,
+                    echo=lambda message: None,
+                    on_iteration=on_iteration,
+                    on_review_chunk=on_review_chunk,
+                    journal=chain_journal,
+                    **(self.session.chain_kwargs | job.options),
+                )
+                entry = batch.ManifestEntry(job.id, job.prompt)
+                job.result = batch.result_record(
+                    entry, history, time.perf_counter() - start
+                )
+                await chain_journal.finish()
+        except asyncio.CancelledError:
+            job.emit({"type": "cancelled"}, "cancelled")
+            raise
+        except Exception as e:
+            job.emit({"type": "failed", "error": repr(e)}, "failed")
+        else:
+            job.emit({"type": "done", "result": job.result}, "done")
+
+    def _forget_finished(self, job: Job) -> None:
+        self._finished.append(job.id)
+        while len(self._finished) > MAX_FINISHED_JOBS:
+            self.jobs.pop(self._finished.popleft(), None)
+
+
+def _journaled_prompt(path: Path) -> str | None:
+    # A job's journal starts with the prompt it was run with.
+    try:
+        with path.open(encoding="utf-8") as f:
+            event = json.loads(f.readline())
+    except (OSError, ValueError):
+        return None
+    return event["value"]["prompt"] if event.get("step") == "start" else None
+
+
+def _handler(jobs: JobQueue, loop: asyncio.AbstractEventLoop):
+    def on_loop(fn, *args):
+        # Jobs are only changed on the event loop.
+        async def call():
+            return fn(*args)
+
+        return asyncio.run_coroutine_threadsafe(call(), loop).result()
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, data, status: int = 200) -> None:
+            body = json.dumps(data).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def route(self) -> tuple[Job | None, bool]:
+            match = _JOB_PATH.fullmatch(urlsplit(self.path).path.rstrip("/"))
+            job = jobs.jobs.get(match[1]) if match else None
+            if job is None:
+                self.send_json({"error": "no such job"}, 404)
+                return None, False
+            return job, bool(match and match[2])
+
+        def do_POST(self):
+            if urlsplit(self.path).path.rstrip("/") != "/jobs":
+                self.send_json({"error": "not found"}, 404)
+                return
+            try:
+                length = int(self.headers.get("Content-Length") or 0)
+                request = json.loads(self.rfile.read(length) or b"{}")
+                if not isinstance(request, dict):
+                    raise ValueError("expected a JSON object")
+                job = on_loop(jobs.submit, request)
+            except JobConflict as e:
+                self.send_json({"error": str(e)}, 409)
+                return
+            except ValueError as e:
+                self.send_json({"error": str(e)}, 400)
+                return
+            self.send_json(job.summary(), 202)
+
+        def do_GET(self):
+            if urlsplit(self.path).path.rstrip("/") == "/jobs":
+                self.send_json([job.summary() for job in list(jobs.jobs.values())])
+                return
+            job, events = self.route()
+            if job is None:
+                return
+            if not events:
+                self.send_json(job.summary())
+                return
+            # One JSON object per line, until the job finishes and the
+            # connection closes.
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.end_headers()
+            try:
+                for event in job.follow():
+                    self.wfile.write(json.dumps(event).encode() + b"\n")
+                    self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+        def do_DELETE(self):
+            job, events = self.route()
+            if job is None:
+                return
+            on_loop(jobs.cancel, job)
+            self.send_json(job.summary(), 202)
+
+    return Handler
+
+
+@asynccontextmanager
+async def serving(
+    session: Session,
+    output_dir: Path,
+    *,
+    host: str,
+    port: int,
+    concurrency: int,
+    resume: bool = False,
+) -> AsyncIterator[str]:
+    """Run a job queue and its HTTP API until the block exits; yields its URL."""
+    jobs = JobQueue(session, output_dir, concurrency, resume=resume)
+    httpd = ThreadingHTTPServer(
+        (host, port), _handler(jobs, asyncio.get_running_loop())
+    )
+    httpd.daemon_threads = True
+    threading.Thread(
+        target=httpd.serve_forever, name="perfect-prompt-http", daemon=True
+    ).start()
+    workers = asyncio.create_task(jobs.run())
+    try:
+        yield f"http://{host}:{httpd.server_port}"
+    finally:
+        workers.cancel()
+        running = [job.task for job in jobs.jobs.values() if job.task is not None]
+        for task in running:
+            task.cancel()
+        await asyncio.gather(workers, *running, return_exceptions=True)
+        # Blocks until the serving thread stops; handlers may still be waiting
+        # on this loop.
+        await asyncio.to_thread(httpd.shutdown)
+        httpd.server_close()
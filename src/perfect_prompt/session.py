@@ -0,0 +1,221 @@
+import contextvars
+import functools
+import threading
+from collections.abc import Sequence
+from contextvars import Token
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any
+
+import click
+
+from . import metrics, pipeline, refine
+from .cache import ImageCache, ResponseCache
+from .generate import COMFYUI_WORKFLOWS, get_generator
+from .journal import JOURNAL_NAME, Journal
+
+
+@dataclass
+class Session:
+    """Everything that lives for a whole run or batch.
+
+    The refine model and the image generator are resolved once, in `create`,
+    and shared by every chain, so nothing is re-resolved per prompt or per
+    iteration.
+    """
+
+    scheduler: pipeline.Scheduler
+    model: Any
+    # None if the caller journals each job itself, as serve does.
+    journal: Journal | None
+    image_cache: ImageCache | None
+    llm_cache: ResponseCache | None
+    chain_kwargs: dict
+    run_metrics: metrics.Metrics | None = None
+    metrics_token: Token | None = None
+    profile: bool = False
+    trace: Path | None = None
+
+    @classmethod
+    def create(
+        cls,
+        output_dir: Path,
+        *,
+        resume: bool,
+        journal: bool = True,
+        refine_model: str,
+        gen_model: str,
+        draft_model: str | None,
+        draft_steps: int | None,
+        draft_size: tuple[int, int] | None,
+        comfyui_urls: Sequence[str],
+        pin_comfyui: bool,
+        bfl_concurrency: int,
+        bfl_rps: float,
+        bfl_timeout: float,
+        comfyui_output_dir: Path | None,
+        free_vram: bool,
+        workers: int | None,
+        llm_concurrency: int | None,
+        cache_dir: Path,
+        no_cache: bool,
+        image_cache_size: int,
+        llm_cache_size: int,
+        llm_cache_ttl: float,
+        profile: bool,
+        trace: Path | None,
+        review_max_side: int | None,
+        review_format: str,
+        review_quality: int,
+        history: str,
+        history_size: int,
+        ollama_keep_alive: str | None,
+        **chain_kwargs,
+    ) -> "Session":
+        draft_target = draft_model or gen_model
+        if (draft_steps or draft_size) and draft_target not in COMFYUI_WORKFLOWS:
+            # The Flux API would ignore them, so every draft would cost as much
+            # as a full render.
+            raise click.UsageError(
+                f"--draft-steps and --draft-size only apply to ComfyUI models, "
+                f"not {draft_target}; pass a ComfyUI --draft-model"
+            )
+        if comfyui_output_dir:
+            click.echo(
+                "Warning: --comfyui-output-dir is deprecated and ignored; images are "
+                "fetched from the ComfyUI server.",
+                err=True,
+            )
+
+        image_cache = None
+        if not no_cache and image_cache_size > 0:
+            image_cache = ImageCache(cache_dir / "images", image_cache_size * 1024**2)
+        llm_cache = None
+        if not no_cache and llm_cache_size > 0:
+            llm_cache = ResponseCache(
+                cache_dir / "llm.sqlite",
+                llm_cache_size * 1024**2,
+                llm_cache_ttl * 86400,
+            )
+
+        model = refine.get_refine_model(refine_model, prefer_async=True)
+        keep_alive = None
+        if ollama_keep_alive:
+            if free_vram:
+                click.echo(
+                    "Warning: not preloading the refine model, since it would "
+                    "compete with image generation for VRAM under --free-vram.",
+                    err=True,
+                )
+            else:
+                keep_alive = ollama_keep_alive
+                _start_preload(model, keep_alive)
+
+        bfl_options = {
+            "max_concurrency": bfl_concurrency,
+            "requests_per_second": bfl_rps,
+            "timeout": bfl_timeout,
+        }
+        generator = get_generator(
+            gen_model,
+            cache=image_cache,
+            comfyui_urls=comfyui_urls,
+            pin_comfyui=pin_comfyui,
+            bfl_options=bfl_options,
+        )
+        draft = None
+        draft_generator = None
+        if draft_model or draft_steps or draft_size:
+            width, height = draft_size or (None, None)
+            draft = pipeline.DraftSettings(draft_steps, width, height)
+            if draft_model and draft_model != gen_model:
+                draft_generator = get_generator(
+                    draft_model,
+                    cache=image_cache,
+                    comfyui_urls=comfyui_urls,
+                    pin_comfyui=pin_comfyui,
+                    bfl_options=bfl_options,
+                )
+        # Keep every ComfyUI server busy by default.
+        servers = len(comfyui_urls) if gen_model in COMFYUI_WORKFLOWS else 1
+        scheduler = pipeline.Scheduler(
+            generator,
+            draft_generator=draft_generator,
+            gen_concurrency=workers or max(chain_kwargs["candidates"], servers),
+            llm_concurrency=llm_concurrency or workers or chain_kwargs["candidates"],
+            free_vram=free_vram,
+            # Every request to Ollama resets how long the model stays loaded to
+            # the server's default, so the keep-alive is renewed whenever the
+            # model goes quiet.
+            on_llm_idle=(
+                functools.partial(_start_preload, model, keep_alive)
+                if keep_alive
+                else None
+            ),
+        )
+        session_metrics = {}
+        if profile or trace:
+            # Activated before the event loop starts so every task inherits it.
+            run_metrics = metrics.Metrics()
+            session_metrics = {
+                "run_metrics": run_metrics,
+                "metrics_token": run_metrics.activate(),
+                "profile": profile,
+                "trace": trace,
+            }
+
+        return cls(
+            scheduler=scheduler,
+            model=model,
+            journal=(
+                Journal(output_dir / JOURNAL_NAME, resume=resume) if journal else None
+            ),
+            image_cache=image_cache,
+            llm_cache=llm_cache,
+            chain_kwargs={
+                **chain_kwargs,
+                "llm_cache": llm_cache,
+                "review_image": refine.ReviewImageSettings(
+                    review_max_side, review_format, review_quality
+                ),
+                "history": refine.HistorySettings(history, history_size),
+                "draft": draft,
+            },
+            **session_metrics,
+        )
+
+    def close(self) -> None:
+        if self.journal is not None:
+            self.journal.close()
+        for name, cache in [("Image", self.image_cache), ("LLM", self.llm_cache)]:
+            if cache is not None:
+                click.echo(
+                    f"{name} cache: {cache.hits} hits, {cache.misses} misses",
+                    err=True,
+                )
+                cache.close()
+        if self.run_metrics is not None:
+            assert self.metrics_token is not None
+            metrics.deactivate(self.metrics_token)
+            if self.profile:
+                click.echo(self.run_metrics.summary(), err=True)
+            if self.trace is not None:
+                self.run_metrics.write_trace(self.trace)
+
+
+def _start_preload(model, keep_alive: str) -> None:
+    # Loads the model while the first images render, so the first review
+    # doesn't wait for it, and later renews its keep-alive.
+    def preload():
+        try:
+            with metrics.span("llm.preload"):
+                refine.preload_model(model, keep_alive)
+        except Exception as e:
+            click.echo(f"Warning: failed to preload {model.model_id}: {e}", err=True)
+
+    threading.Thread(
+        target=contextvars.copy_context().run,
+        args=(preload,),
+        name="preload-refine-model",
+        daemon=True,
+    ).start()
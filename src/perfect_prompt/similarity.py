@@ -0,0 +1,60 @@
+import itertools
+import re
+import threading
+
+_CLAUSE = re.compile(r"[,.;:!?\n]+")
+_WORD = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+
+
+def shingles(prompt: str) -> frozenset[str]:
+    """Word pairs within each clause of a prompt, ignoring case and punctuation.
+
+    Pairs don't span clauses, so reordering a prompt's clauses leaves its
+    shingles unchanged.
+    """
+    result = set()
+    for clause in _CLAUSE.split(prompt.lower()):
+        words = _WORD.findall(clause)
+        if len(words) == 1:
+            result.add(words[0])
+        result.update(f"{a} {b}" for a, b in itertools.pairwise(words))
+    return frozenset(result)
+
+
+def similarity(a: frozenset[str], b: frozenset[str]) -> float:
+    # Jaccard similarity of two shingle sets.
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+class PromptIndex:
+    """The prompts tried so far, for spotting near-duplicates of them.
+
+    A prompt is a near-duplicate if the Jaccard similarity of its shingles
+    and an indexed prompt's is at least ``threshold``; 1.0 only matches
+    prompts that differ in case, punctuation or clause order. Chains index a
+    few dozen prompts at most, so every lookup compares against all of them.
+    """
+
+    def __init__(self, threshold: float):
+        self.threshold = threshold
+        self._prompts: list[tuple[frozenset[str], str]] = []
+        self._lock = threading.Lock()
+
+    def add(self, prompt: str, label: str) -> None:
+        with self._lock:
+            self._prompts.append((shingles(prompt), label))
+
+    def match(self, prompt: str) -> tuple[str, float] | None:
+        """Return the label and similarity of the closest near-duplicate."""
+        candidate = shingles(prompt)
+        with self._lock:
+            scored = [
+                (similarity(candidate, indexed), label)
+                for indexed, label in self._prompts
+            ]
+        score, label = max(scored, key=lambda item: item[0], default=(0.0, ""))
+        if score < self.threshold:
+            return None
+        return label, score
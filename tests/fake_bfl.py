@@ -0,0 +1,155 @@
+import json
+import random
+import threading
+import time
+import uuid
+from collections.abc import Callable
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from fake_comfyui import make_png
+
+
+class FakeBFL:
+    """Minimal in-process stand-in for the Black Forest Labs API.
+
+    The first ``failures`` requests, and then a ``failure_rate`` fraction of
+    them, are rejected with ``failure_status``. Each task reports "Pending"
+    for ``pending_polls`` polls before it is ready (forever if None), or with
+    ``render_seconds``, until that many seconds after it was submitted.
+    """
+
+    def __init__(
+        self,
+        *,
+        failures: int = 0,
+        failure_rate: float = 0.0,
+        failure_status: int = 429,
+        pending_polls: int | None = 1,
+        render_seconds: Callable[[], float] | None = None,
+    ):
+        self.failures = failures
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+        self.pending_polls = pending_polls
+        self.render_seconds = render_seconds
+        self._ready_at: dict[str, float] = {}
+        self._finished: set[str] = set()
+        self.requests = 0
+        self.submissions: list[dict] = []
+        self.polls: dict[str, int] = {}
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, args=(0.05,), daemon=True
+        )
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _fail(self) -> bool:
+        with self._lock:
+            self.requests += 1
+            if self.failures > 0:
+                self.failures -= 1
+                return True
+            return random.random() < self.failure_rate
+
+    def _submit(self, body: dict) -> str:
+        task_id = uuid.uuid4().hex
+        with self._lock:
+            self.submissions.append(body)
+            self.polls[task_id] = 0
+            if self.render_seconds is not None:
+                self._ready_at[task_id] = time.monotonic() + self.render_seconds()
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        return task_id
+
+    def _ready(self, task_id: str) -> bool:
+        if task_id in self._ready_at:
+            return time.monotonic() >= self._ready_at[task_id]
+        return (
+            self.pending_polls is not None and self.polls[task_id] > self.pending_polls
+        )
+
+    def _poll(self, task_id: str) -> dict:
+        with self._lock:
+            self.polls[task_id] += 1
+            if not self._ready(task_id):
+                return {"id": task_id, "status": "Pending"}
+            if task_id not in self._finished:
+                self._finished.add(task_id)
+                self.active -= 1
+        return {
+            "id": task_id,
+            "status": "Ready",
+            "result": {"sample": f"{self.url}/sample/{task_id}.png"},
+        }
+
+    def _make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send_json(self, data, status=200):
+                body = json.dumps(data).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                if status == 429:
+                    self.send_header("Retry-After", "0")
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path.startswith("/sample/"):
+                    body = make_png()
+                    self.send_response(200)
+                    self.send_header("Content-Type", "image/png")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                elif fake._fail():
+                    self._send_json({"detail": "busy"}, status=fake.failure_status)
+                elif url.path == "/v1/get_result":
+                    task_id = parse_qs(url.query)["id"][0]
+                    self._send_json(fake._poll(task_id))
+                else:
+                    self._send_json({"detail": "not found"}, status=404)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+                if fake._fail():
+                    self._send_json({"detail": "busy"}, status=fake.failure_status)
+                elif self.path.startswith("/v1/"):
+                    task_id = fake._submit(body)
+                    self._send_json(
+                        {
+                            "id": task_id,
+                            "polling_url": f"{fake.url}/v1/get_result?id={task_id}",
+                        }
+                    )
+                else:
+                    self._send_json({"detail": "not found"}, status=404)
+
+        return Handler
@@ -0,0 +1,188 @@
+import base64
+import hashlib
+import io
+import json
+import queue
+import struct
+import threading
+import time
+import uuid
+from collections.abc import Callable
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from PIL import Image
+
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC11B80"
+
+
+def make_png(color="red", size=(8, 8)) -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", size, color).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+class FakeComfyUI:
+    """Minimal in-process stand-in for the ComfyUI HTTP and websocket API.
+
+    ``render``, if given, is called with each queued workflow before it
+    completes, e.g. to simulate rendering; if it raises, the request fails.
+    """
+
+    def __init__(
+        self,
+        websocket: bool = True,
+        delay: float = 0.0,
+        render: Callable[[dict], None] | None = None,
+    ):
+        self.websocket = websocket
+        # Seconds each prompt takes to queue, so that jobs overlap.
+        self.delay = delay
+        self.render = render
+        self.prompts: list[dict] = []
+        self.history: dict[str, dict] = {}
+        self.images: dict[str, bytes] = {}
+        self.free_calls = 0
+        self.queue_calls = 0
+        self.ws_clients: list[str] = []
+        self._ws_queues: dict[str, queue.Queue] = {}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, args=(0.05,), daemon=True
+        )
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _run_prompt(self, body: dict) -> str:
+        time.sleep(self.delay)
+        if self.render is not None:
+            self.render(body["prompt"])
+        prompt_id = uuid.uuid4().hex
+        batch_size = next(
+            node["inputs"]["batch_size"]
+            for node in body["prompt"].values()
+            if node["class_type"] == "EmptySD3LatentImage"
+        )
+        with self._lock:
+            filenames = [
+                f"ComfyUI_{len(self.images) + i:05}_.png" for i in range(batch_size)
+            ]
+            self.prompts.append(body)
+            for i, filename in enumerate(filenames):
+                self.images[filename] = make_png(size=(8 + i, 8))
+            self.history[prompt_id] = {
+                "outputs": {
+                    "9": {
+                        "images": [
+                            {"filename": filename, "subfolder": "", "type": "output"}
+                            for filename in filenames
+                        ]
+                    }
+                },
+                "status": {"status_str": "success", "completed": True},
+            }
+        events = self._ws_queues.get(body.get("client_id", ""))
+        if events is not None:
+            events.put(
+                {"type": "executing", "data": {"node": "9", "prompt_id": prompt_id}}
+            )
+            events.put(
+                {"type": "executing", "data": {"node": None, "prompt_id": prompt_id}}
+            )
+            events.put(None)
+        return prompt_id
+
+    def _make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send_json(self, data, status=200):
+                body = json.dumps(data).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _read_json(self):
+                length = int(self.headers.get("Content-Length", 0))
+                return json.loads(self.rfile.read(length) or b"{}")
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path == "/ws" and fake.websocket:
+                    self._serve_ws(parse_qs(url.query)["clientId"][0])
+                elif url.path.startswith("/history/"):
+                    prompt_id = url.path.removeprefix("/history/")
+                    entry = fake.history.get(prompt_id)
+                    self._send_json({prompt_id: entry} if entry else {})
+                elif url.path == "/queue":
+                    fake.queue_calls += 1
+                    self._send_json({"queue_running": [], "queue_pending": []})
+                elif url.path == "/view":
+                    filename = parse_qs(url.query)["filename"][0]
+                    body = fake.images[filename]
+                    self.send_response(200)
+                    self.send_header("Content-Type", "image/png")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                else:
+                    self._send_json({"error": "not found"}, status=404)
+
+            def do_POST(self):
+                body = self._read_json()
+                if self.path == "/prompt":
+                    prompt_id = fake._run_prompt(body)
+                    self._send_json({"prompt_id": prompt_id, "number": 0})
+                elif self.path == "/free":
+                    fake.free_calls += 1
+                    self._send_json({})
+                else:
+                    self._send_json({"error": "not found"}, status=404)
+
+            def _serve_ws(self, client_id):
+                events = queue.Queue()
+                fake._ws_queues[client_id] = events
+                fake.ws_clients.append(client_id)
+                key = self.headers["Sec-WebSocket-Key"] + WS_GUID
+                accept = base64.b64encode(hashlib.sha1(key.encode()).digest())
+                self.send_response(101)
+                self.send_header("Upgrade", "websocket")
+                self.send_header("Connection", "Upgrade")
+                self.send_header("Sec-WebSocket-Accept", accept.decode())
+                self.end_headers()
+                self.wfile.flush()
+                while (event := events.get(timeout=10)) is not None:
+                    self._send_frame(0x1, json.dumps(event).encode("utf-8"))
+                self._send_frame(0x8, struct.pack("!H", 1000))
+                self.close_connection = True
+
+            def _send_frame(self, opcode, payload):
+                header = bytes([0x80 | opcode])
+                if len(payload) < 126:
+                    header += bytes([len(payload)])
+                else:
+                    header += bytes([126]) + struct.pack("!H", len(payload))
+                self.wfile.write(header + payload)
+                self.wfile.flush()
+
+        return Handler
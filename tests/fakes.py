@@ -0,0 +1,114 @@
+import asyncio
+import re
+
+import llm
+from fake_comfyui import make_png
+from llm.models import Usage
+
+from perfect_prompt.generate import ImageGenerator, write_output_image
+
+
+class FakeGenerator(ImageGenerator):
+    def __init__(self, concurrency=1, batches=False):
+        # With concurrency > 1, jobs only complete once that many are in flight.
+        self.concurrency = concurrency
+        self.batches = batches
+        self.calls = []
+        self.options = []
+        self.free_calls = 0
+        self._barrier: asyncio.Barrier | None = None
+
+    @property
+    def model_name(self) -> str:
+        return "fake"
+
+    async def agenerate_image(self, prompt, output_dir, *, seed=None, **kwargs):
+        self.calls.append((prompt, seed))
+        kwargs.pop("affinity", None)
+        self.options.append(kwargs)
+        if self._barrier is None:
+            self._barrier = asyncio.Barrier(self.concurrency)
+        async with asyncio.timeout(5):
+            await self._barrier.wait()
+        return write_output_image(output_dir, f"fake-{seed}", make_png())
+
+    @property
+    def supports_batch(self) -> bool:
+        return self.batches
+
+    async def agenerate_batch(self, prompt, output_dir, batch_size, *, seed=None, **_):
+        self.calls.append((prompt, seed, batch_size))
+        return [
+            write_output_image(output_dir, f"fake-{seed}-b{i}", make_png())
+            for i in range(batch_size)
+        ]
+
+    async def afree_memory(self):
+        self.free_calls += 1
+
+    async def aclose(self):
+        pass
+
+
+class FakeResponse:
+    def __init__(self, text, input_tokens=None):
+        self._text = text
+        self._input_tokens = input_tokens
+
+    def __iter__(self):
+        return iter([self._text])
+
+    def text(self):
+        return self._text
+
+    def usage(self):
+        return Usage(input=self._input_tokens)
+
+
+class FakeModel:
+    """Stands in for an `llm.Model`; `respond` maps a prompt to response text."""
+
+    model_id = "fake"
+
+    def __init__(self, respond):
+        self.respond = respond
+        self.prompts = []
+
+    def prompt(self, prompt, attachments=(), **_):
+        self.prompts.append((prompt, [a.path for a in attachments]))
+        # Roughly one token per word.
+        return FakeResponse(self.respond(prompt, attachments), len(prompt.split()))
+
+
+class FakeAsyncModel(llm.AsyncModel):
+    """An async `llm` model that streams `respond`'s answer word by word."""
+
+    model_id = "fake-async"
+    attachment_types = {"image/png"}
+
+    class Options(llm.Options):  # type: ignore[override]
+        temperature: float | None = None
+
+    def __init__(self, respond, delay=0.0):
+        self.respond = respond
+        self.delay = delay
+        self.prompts = []
+        self.active = 0
+        self.max_active = 0
+        self.cancelled = 0
+
+    async def execute(self, prompt, stream, response, conversation):
+        self.prompts.append((prompt.prompt, [a.path for a in prompt.attachments]))
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            text = self.respond(prompt.prompt, prompt.attachments)
+            for chunk in re.findall(r"\S+\s*", text):
+                await asyncio.sleep(self.delay)
+                yield chunk
+            response.set_usage(input=len(prompt.prompt.split()))
+        except (asyncio.CancelledError, GeneratorExit):
+            self.cancelled += 1
+            raise
+        finally:
+            self.active -= 1
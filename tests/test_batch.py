@@ -0,0 +1,79 @@
+import asyncio
+import io
+import json
+
+from fakes import FakeGenerator, FakeModel
+
+from perfect_prompt import batch, pipeline
+
+
+def test_read_manifest(tmp_path):
+    jsonl = tmp_path / "manifest.jsonl"
+    jsonl.write_text('{"prompt": "a cat", "id": "cat"}\n\n{"prompt": " a dog "}\n')
+    csv = tmp_path / "manifest.csv"
+    csv.write_text("id,prompt\ncat,a cat\n,a dog\n")
+
+    expected = [batch.ManifestEntry("cat", "a cat"), batch.ManifestEntry("2", "a dog")]
+    assert list(batch.read_manifest(jsonl)) == expected
+    assert list(batch.read_manifest(csv)) == expected
+
+
+def test_read_manifest_bad_entries(tmp_path):
+    jsonl = tmp_path / "manifest.jsonl"
+    jsonl.write_text('{"prompt": "a cat"}\nnot json\n["a dog"]\n{"id": "x"}\n')
+
+    entries = list(batch.read_manifest(jsonl))
+    assert [(e.id, e.prompt) for e in entries] == [
+        ("1", "a cat"),
+        ("2", ""),
+        ("3", ""),
+        ("x", ""),
+    ]
+    assert entries[0].error is None
+    assert "entry 2 is not valid JSON" in str(entries[1].error)
+    assert "entry 3 is not a JSON object" in str(entries[2].error)
+    assert "entry 4 has no prompt" in str(entries[3].error)
+
+
+def test_run_batch(tmp_path):
+    class FlakyGenerator(FakeGenerator):
+        async def agenerate_image(self, prompt, output_dir, **kwargs):
+            if prompt == "broken":
+                raise RuntimeError("render failed")
+            return await super().agenerate_image(prompt, output_dir, **kwargs)
+
+    def respond(prompt, attachments):
+        if not attachments:
+            return "revised"
+        return "7/10" if "a cat" in prompt else "Score: 3"
+
+    entries = [
+        batch.ManifestEntry("1", "a cat"),
+        batch.ManifestEntry("2", "broken"),
+        batch.ManifestEntry("3", "a dog"),
+        batch.ManifestEntry("4", "", "manifest.jsonl: entry 4 has no prompt"),
+    ]
+    results = io.StringIO()
+    asyncio.run(
+        batch.run_batch(
+            entries,
+            results,
+            pipeline.Scheduler(FlakyGenerator()),
+            FakeModel(respond),  # type: ignore[arg-type]
+            tmp_path,
+            concurrency=2,
+            iterations=2,
+        )
+    )
+
+    records = {r["id"]: r for r in map(json.loads, results.getvalue().splitlines())}
+    assert records["2"]["error"] == "RuntimeError('render failed')"
+    cat = records["1"]
+    assert cat["final_prompt"] == "revised"
+    assert cat["final_score"] == 7
+    assert cat["next_prompt"] == "revised"
+    assert [a["prompt"] for a in cat["attempts"]] == ["a cat", "revised"]
+    assert all(a["selected"] for a in cat["attempts"])
+    assert len(cat["timings"]["iterations"]) == 2
+    assert records["3"]["final_score"] == 3
+    assert "entry 4 has no prompt" in records["4"]["error"]
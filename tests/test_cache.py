@@ -0,0 +1,82 @@
+import asyncio
+
+from fake_comfyui import FakeComfyUI, make_png
+from fakes import FakeModel
+
+from perfect_prompt import refine
+from perfect_prompt.cache import ImageCache, ResponseCache, cache_key
+from perfect_prompt.generate import (
+    COMFYUI_WORKFLOWS,
+    CachedGenerator,
+    ComfyUIGenerator,
+)
+
+
+def test_lru_eviction(tmp_path):
+    cache = ImageCache(tmp_path, max_bytes=10)
+    cache.put("a", b"aaaa")
+    cache.put("b", b"bbbb")
+    assert cache.get("a") == b"aaaa"  # "b" is now least recently used.
+    cache.put("c", b"cccc")
+
+    assert cache.get("b") is None
+    assert cache.get("a") == b"aaaa"
+    assert cache.get("c") == b"cccc"
+    assert (cache.hits, cache.misses) == (3, 1)
+    assert not (tmp_path / "b.png").exists()
+
+
+def test_cache_key_is_order_independent():
+    assert cache_key("m", {"a": 1, "b": 2}) == cache_key("m", {"b": 2, "a": 1})
+    assert cache_key("m", {"a": 1}) != cache_key("m", {"a": 2})
+
+
+def test_cached_generator_skips_repeat_renders(tmp_path):
+    cache = ImageCache(tmp_path / "cache", max_bytes=2**20)
+
+    async def run(generator):
+        paths = [
+            await generator.agenerate_image("a cat", tmp_path),
+            await generator.agenerate_image("a cat", tmp_path),
+            await generator.agenerate_image("a cat", tmp_path, seed=1),
+        ]
+        await generator.aclose()
+        return paths
+
+    with FakeComfyUI() as server:
+        generator = ComfyUIGenerator(
+            "comfyui-flux", COMFYUI_WORKFLOWS["comfyui-flux"], comfyui_url=server.url
+        )
+        paths = asyncio.run(run(CachedGenerator(generator, cache)))
+
+    assert len(server.prompts) == 2
+    assert len(set(paths)) == 3
+    assert paths[0].read_bytes() == paths[1].read_bytes()
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_response_cache_ttl_and_eviction(tmp_path):
+    cache = ResponseCache(tmp_path / "llm.sqlite", max_bytes=8, ttl=60)
+    cache.put("a", "aaaa")
+    cache.put("b", "bbbb")
+    assert cache.get("a") == "aaaa"
+    cache.put("c", "cccc")
+    assert cache.get("b") is None
+
+    cache.ttl = 0
+    assert cache.get("a") is None
+
+
+def test_review_is_memoized_by_image_content(tmp_path):
+    cache = ResponseCache(tmp_path / "llm.sqlite", max_bytes=2**20)
+    model = FakeModel(lambda prompt, attachments: "Looks right. Score: 9/10")
+    first, second = tmp_path / "1.png", tmp_path / "2.png"
+    first.write_bytes(make_png())
+    second.write_bytes(make_png())
+
+    def review(prompt, image_path):
+        return refine.review_image(model, prompt, image_path, cache=cache)  # type: ignore[arg-type]
+
+    assert review("a cat", first) == review("a cat", second)
+    review("a dog", second)
+    assert len(model.prompts) == 2
@@ -0,0 +1,242 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+from fake_bfl import FakeBFL
+from fake_comfyui import FakeComfyUI
+from PIL import Image
+
+from perfect_prompt.generate import (
+    COMFYUI_WORKFLOWS,
+    BFLAPIGenerator,
+    ComfyUIGenerator,
+    ComfyUIPool,
+    _RateLimiter,
+)
+
+
+@pytest.mark.parametrize("websocket", [True, False])
+def test_comfyui_generate_image(tmp_path, websocket):
+    with FakeComfyUI(websocket=websocket) as server:
+        generator = ComfyUIGenerator(
+            "comfyui-flux",
+            COMFYUI_WORKFLOWS["comfyui-flux"],
+            comfyui_url=server.url,
+            poll_interval=0.01,
+        )
+        image_path = generator.generate_image("a red cat", tmp_path)
+
+    # Streamed via a temporary file, which is gone once the image is in place.
+    assert list(tmp_path.iterdir()) == [image_path]
+    with Image.open(image_path) as image:
+        assert image.getpixel((0, 0)) == (255, 0, 0)
+        assert image.text == {  # type: ignore[attr-defined]
+            "prompt": "a red cat",
+            "model": "comfyui-flux",
+            "seed": str(COMFYUI_WORKFLOWS["comfyui-flux"].default_seed),
+        }
+    (body,) = server.prompts
+    assert body["prompt"]["6"]["inputs"]["text"] == "a red cat"
+    assert server.ws_clients == ([body["client_id"]] if websocket else [])
+    # The shared workflow template must not be modified.
+    assert COMFYUI_WORKFLOWS["comfyui-flux"].workflow["6"]["inputs"]["text"] == ""
+
+
+def test_workflow_overrides():
+    workflow = COMFYUI_WORKFLOWS["comfyui-flux"].resolve(
+        "a red cat", steps=8, width=608, height=416
+    )
+    assert workflow["17"]["inputs"]["steps"] == 8
+    for node_id in ["27", "30"]:
+        assert workflow[node_id]["inputs"]["width"] == 608
+        assert workflow[node_id]["inputs"]["height"] == 416
+    assert COMFYUI_WORKFLOWS["comfyui-flux"].workflow["17"]["inputs"]["steps"] == 20
+
+
+def test_comfyui_generate_batch(tmp_path):
+    async def run(generator):
+        paths = await generator.agenerate_batch("a red cat", tmp_path, 3, seed=7)
+        await generator.aclose()
+        return paths
+
+    with FakeComfyUI() as server:
+        generator = ComfyUIGenerator(
+            "comfyui-flux", COMFYUI_WORKFLOWS["comfyui-flux"], comfyui_url=server.url
+        )
+        paths = asyncio.run(run(generator))
+
+    (body,) = server.prompts
+    assert body["prompt"]["27"]["inputs"]["batch_size"] == 3
+    assert body["prompt"]["25"]["inputs"]["noise_seed"] == 7
+    # In batch order.
+    for i, path in enumerate(paths):
+        with Image.open(path) as image:
+            assert image.size == (8 + i, 8)
+            assert image.text["batch_index"] == str(i)  # type: ignore[attr-defined]
+            assert image.text["seed"] == "7"  # type: ignore[attr-defined]
+
+
+def test_comfyui_free_memory():
+    with FakeComfyUI() as server:
+        generator = ComfyUIGenerator(
+            "comfyui-flux", COMFYUI_WORKFLOWS["comfyui-flux"], comfyui_url=server.url
+        )
+        generator.free_memory()
+    assert server.free_calls == 1
+
+
+def test_comfyui_concurrent_jobs_share_one_loop(tmp_path):
+    async def run(generator):
+        paths = await asyncio.gather(
+            *(generator.agenerate_image(f"cat {i}", tmp_path) for i in range(3))
+        )
+        await generator.aclose()
+        return paths
+
+    with FakeComfyUI() as server:
+        generator = ComfyUIGenerator(
+            "comfyui-flux", COMFYUI_WORKFLOWS["comfyui-flux"], comfyui_url=server.url
+        )
+        paths = asyncio.run(run(generator))
+
+    assert len(set(paths)) == 3
+    assert sorted(server.ws_clients) == sorted(p["client_id"] for p in server.prompts)
+    assert len(server.ws_clients) == 3
+
+
+def comfyui_pool(servers, **kwargs):
+    config = COMFYUI_WORKFLOWS["comfyui-flux"]
+    return ComfyUIPool(
+        [
+            ComfyUIGenerator("comfyui-flux", config, server.url, poll_interval=0.01)
+            for server in servers
+        ],
+        **kwargs,
+    )
+
+
+def test_comfyui_pool_spreads_jobs_and_fails_over(tmp_path):
+    async def run(generator, prompts):
+        paths = await asyncio.gather(
+            *(generator.agenerate_image(prompt, tmp_path) for prompt in prompts)
+        )
+        await generator.aclose()
+        return paths
+
+    with FakeComfyUI(delay=0.2) as first, FakeComfyUI(delay=0.2) as second:
+        asyncio.run(run(comfyui_pool([first, second]), ["a", "b", "c", "d"]))
+        assert (len(first.prompts), len(second.prompts)) == (2, 2)
+
+    # Nothing is listening at the first server's address any more.
+    with FakeComfyUI() as second:
+        pool = comfyui_pool([first, second])
+        paths = asyncio.run(run(pool, ["e", "f"]))
+    assert len(second.prompts) == 2
+    assert len(paths) == 2
+
+
+def test_comfyui_pool_doesnt_fail_over_local_errors(tmp_path):
+    async def run(generator):
+        try:
+            await generator.agenerate_image("a", tmp_path / "missing")
+        finally:
+            await generator.aclose()
+
+    with FakeComfyUI() as first, FakeComfyUI() as second:
+        pool = comfyui_pool([first, second])
+        with pytest.raises(FileNotFoundError):
+            asyncio.run(run(pool))
+        assert len(first.prompts) + len(second.prompts) == 1
+    assert all(server.healthy for server in pool._servers)
+
+
+def test_comfyui_pool_pins_chains(tmp_path):
+    async def chain(generator, subject, iterations):
+        for i in range(iterations):
+            await generator.agenerate_image(
+                f"{subject} {i}", tmp_path, affinity=subject
+            )
+
+    async def run(generator):
+        await asyncio.gather(chain(generator, "cat", 3), chain(generator, "dog", 1))
+        await generator.aclose()
+
+    with FakeComfyUI(delay=0.1) as first, FakeComfyUI(delay=0.1) as second:
+        asyncio.run(run(comfyui_pool([first, second], pin=True)))
+    assert sorted([len(first.prompts), len(second.prompts)]) == [1, 3]
+
+
+def bfl_generator(server, **kwargs):
+    kwargs.setdefault("requests_per_second", 1000)
+    return BFLAPIGenerator(
+        "flux-dev", api_key="test", base_url=server.url, poll_interval=0.01, **kwargs
+    )
+
+
+def test_bfl_retries_rate_limited_requests(tmp_path, monkeypatch):
+    monkeypatch.setattr("perfect_prompt.generate.random.uniform", lambda a, b: 0)
+    with FakeBFL(failures=3, failure_status=429) as server:
+        image_path = bfl_generator(server).generate_image("a red cat", tmp_path)
+
+    with Image.open(image_path) as image:
+        assert image.text["prompt"] == "a red cat"  # type: ignore[attr-defined]
+    assert len(server.submissions) == 1
+    # Three rejected submissions, the submission, then two polls.
+    assert server.requests == 6
+
+
+def test_bfl_doesnt_resubmit_after_server_errors(tmp_path):
+    # The server may have started the job anyway.
+    with (
+        FakeBFL(failures=1, failure_status=503) as server,
+        pytest.raises(httpx.HTTPStatusError),
+    ):
+        bfl_generator(server).generate_image("a red cat", tmp_path)
+    assert server.requests == 1
+
+
+def test_bfl_limits_tasks_in_flight(tmp_path):
+    async def run(generator):
+        paths = await asyncio.gather(
+            *(generator.agenerate_image(f"cat {i}", tmp_path) for i in range(6))
+        )
+        await generator.aclose()
+        return paths
+
+    with FakeBFL(pending_polls=2) as server:
+        paths = asyncio.run(run(bfl_generator(server, max_concurrency=2)))
+
+    assert len(set(paths)) == 6
+    assert server.max_active == 2
+
+
+def test_bfl_generators_share_their_api_key_limits(tmp_path):
+    async def run(generators):
+        return await asyncio.gather(
+            *(
+                generator.agenerate_image(f"cat {i}", tmp_path)
+                for i, generator in enumerate(generators * 3)
+            )
+        )
+
+    with FakeBFL(pending_polls=2) as server:
+        asyncio.run(run([bfl_generator(server, max_concurrency=2) for _ in range(2)]))
+
+    assert server.max_active == 2
+
+
+def test_bfl_times_out_pending_tasks(tmp_path):
+    with FakeBFL(pending_polls=None) as server, pytest.raises(TimeoutError):
+        bfl_generator(server, timeout=0.2).generate_image("a red cat", tmp_path)
+    assert 1 < sum(server.polls.values()) < 20
+
+
+def test_rate_limiter_spaces_requests():
+    async def run():
+        limiter = _RateLimiter(50)
+        start = time.monotonic()
+        await asyncio.gather(*(limiter.wait() for _ in range(6)))
+        return time.monotonic() - start
+
+    assert asyncio.run(run()) >= 0.1
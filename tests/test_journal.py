@@ -0,0 +1,65 @@
+import asyncio
+
+import pytest
+from fakes import FakeGenerator, FakeModel
+
+from perfect_prompt import pipeline
+from perfect_prompt.journal import Journal
+
+
+def test_torn_final_line_is_dropped(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    with Journal(path) as journal:
+        journal.record("1", "start", {"prompt": "a cat"})
+        journal.record("1", "0/review/0", "7/10")
+    with path.open("a") as f:
+        f.write('{"chain": "1", "step": "0/revi')
+
+    with Journal(path, resume=True) as journal:
+        assert journal.get("1", "0/review/0") == "7/10"
+        journal.record("1", "done")
+
+    with Journal(path, resume=True) as journal:
+        assert journal.is_done("1")
+        # A finished chain's steps aren't kept in memory.
+        assert journal.get("1", "0/review/0") is None
+
+
+def test_resume_skips_completed_steps(tmp_path):
+    generator = FakeGenerator()
+
+    def respond(prompt, attachments):
+        if attachments:
+            return "5/10"
+        if "Prompt #2" in prompt:
+            raise RuntimeError("crash")
+        return "revised"
+
+    def run(model, resume):
+        with Journal(tmp_path / "journal.jsonl", resume=resume) as journal:
+            return asyncio.run(
+                pipeline.refine_chain(
+                    pipeline.Scheduler(generator),
+                    model,
+                    "a cat",
+                    tmp_path,
+                    iterations=2,
+                    echo=lambda message: None,
+                    journal=journal.chain("1", "a cat"),
+                )
+            )
+
+    crashing = FakeModel(respond)
+    with pytest.raises(RuntimeError, match="crash"):
+        run(crashing, resume=False)
+    assert len(generator.calls) == 2
+    assert len(crashing.prompts) == 4
+
+    resumed = FakeModel(lambda prompt, attachments: "resumed")
+    history = run(resumed, resume=True)
+
+    # Both images and reviews were replayed; only the last revision re-ran.
+    assert len(generator.calls) == 2
+    assert len(resumed.prompts) == 1
+    assert [it.best.prompt for it in history] == ["a cat", "revised"]
+    assert history[-1].refined_prompts == ["resumed"]
@@ -0,0 +1,71 @@
+import asyncio
+import json
+
+from fakes import FakeGenerator, FakeModel
+
+from perfect_prompt import metrics, pipeline, refine
+
+
+def test_spans_nest_across_tasks_and_threads(tmp_path, monkeypatch):
+    # Both iterations render the same image, which is then encoded only once.
+    monkeypatch.setattr(refine, "_encoded_images", type(refine._encoded_images)())
+    revisions = iter(range(100))
+    model = FakeModel(
+        lambda prompt, attachments: "5/10" if attachments else f"cat {next(revisions)}"
+    )
+    run_metrics = metrics.Metrics()
+    token = run_metrics.activate()
+    try:
+        with metrics.span("run"):
+            asyncio.run(
+                pipeline.refine_chain(
+                    pipeline.Scheduler(FakeGenerator()),
+                    model,  # type: ignore[arg-type]
+                    "a cat",
+                    tmp_path,
+                    iterations=2,
+                    echo=lambda message: None,
+                )
+            )
+    finally:
+        metrics.deactivate(token)
+
+    with metrics.span("ignored"):
+        metrics.count("ignored")
+
+    by_name = {}
+    for span in run_metrics.spans:
+        by_name.setdefault(span.name, []).append(span)
+    assert {name: len(spans) for name, spans in by_name.items()} == {
+        "run": 1,
+        "generate.wait": 2,
+        "generate": 2,
+        "review.wait": 2,
+        "review": 2,
+        "llm.review": 2,
+        "review_image.encode": 1,
+        "revise.wait": 2,
+        "revise": 2,
+        "llm.revise": 2,
+    }
+    review_ids = {span.span_id for span in by_name["review"]}
+    assert {span.parent_id for span in by_name["llm.review"]} <= review_ids
+    assert run_metrics.counters["llm.calls"] == 4
+    assert run_metrics.counters["llm.input_tokens"] > 0
+    assert [span.attributes["iteration"] for span in by_name["revise"]] == [1, 2]
+    assert all(span.attributes["input_tokens"] for span in by_name["llm.revise"])
+    assert "llm.review" in run_metrics.summary()
+
+    run_metrics.write_trace(tmp_path / "trace.jsonl")
+    # One ExportTraceServiceRequest, then one ExportMetricsServiceRequest.
+    traces, metrics_request = (
+        json.loads(line) for line in (tmp_path / "trace.jsonl").read_text().splitlines()
+    )
+    assert traces.keys() == {"resourceSpans"}
+    assert metrics_request.keys() == {"resourceMetrics"}
+    spans = traces["resourceSpans"][0]["scopeSpans"][0]["spans"]
+    assert len(spans) == len(run_metrics.spans)
+    assert {span["traceId"] for span in spans} == {run_metrics.trace_id}
+    counters = metrics_request["resourceMetrics"][0]["scopeMetrics"][0]["metrics"]
+    (calls,) = [counter for counter in counters if counter["name"] == "llm.calls"]
+    assert calls["sum"]["dataPoints"][0]["asInt"] == "4"
@@ -1,5 +1,8 @@
 from click.testing import CliRunner
+from fakes import FakeGenerator, FakeModel
 
+from perfect_prompt import refine
+from perfect_prompt import session as session_module
 from perfect_prompt.cli import cli
 
 
@@ -9,3 +12,35 @@ def test_version():
         result = runner.invoke(cli, ["--version"])
         assert result.exit_code == 0
         assert result.output.startswith("cli, version ")
+
+
+def test_candidates(tmp_path, monkeypatch):
+    generator = FakeGenerator(concurrency=2)
+    model = FakeModel(
+        lambda prompt, attachments: "Score: 5" if attachments else "a red cat"
+    )
+    monkeypatch.setattr(session_module, "get_generator", lambda name, **_: generator)
+    monkeypatch.setattr(refine, "get_refine_model", lambda name, **kwargs: model)
+
+    result = CliRunner().invoke(
+        cli, ["a cat", "-o", str(tmp_path / "out"), "-n", "2", "--candidates", "2"]
+    )
+
+    assert result.exit_code == 0, result.output
+    assert sorted(generator.calls, key=str) == [
+        ("a cat", 1),
+        ("a cat", None),
+        ("a red cat", 1),
+        ("a red cat", None),
+    ]
+    assert len(list((tmp_path / "out").glob("*.png"))) == 4
+
+
+def test_draft_steps_need_a_comfyui_model(tmp_path):
+    result = CliRunner().invoke(
+        cli,
+        ["a cat", "-o", str(tmp_path), "--gen-model", "flux-dev", "--draft-steps", "4"],
+    )
+
+    assert result.exit_code == 2
+    assert "only apply to ComfyUI models" in result.output
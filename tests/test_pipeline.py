@@ -0,0 +1,376 @@
+import asyncio
+import json
+import threading
+from pathlib import Path
+
+import pytest
+from fakes import FakeAsyncModel, FakeGenerator, FakeModel
+
+from perfect_prompt import pipeline
+
+
+def test_candidate_jobs():
+    assert pipeline.candidate_jobs(["a"], 1) == [("a", None)]
+    assert pipeline.candidate_jobs(["a"], 3) == [("a", None), ("a", 1), ("a", 2)]
+    assert pipeline.candidate_jobs(["a", "b"], 3) == [
+        ("a", None),
+        ("b", None),
+        ("a", 1),
+    ]
+
+
+def test_batch_jobs():
+    jobs = pipeline.candidate_jobs(["a", "b"], 7)
+    assert pipeline.batch_jobs(jobs, 3) == [[0, 2, 4], [6], [1, 3, 5]]
+    assert pipeline.batch_jobs(jobs, 1) == [[j] for j in [0, 2, 4, 6, 1, 3, 5]]
+
+
+def test_best_of_k(tmp_path):
+    generator = FakeGenerator(concurrency=3)
+    jobs = pipeline.candidate_jobs(["cat"], 3)
+    scores = {"None": "6/10", "1": "Score: 9", "2": "meh"}
+    model = FakeModel(
+        lambda prompt, attachments: scores[
+            Path(attachments[0].path).stem.split("_")[0].removeprefix("fake-")
+        ]
+    )
+
+    async def run():
+        limit = asyncio.Semaphore(3)
+        results = await pipeline.generate_candidates(limit, generator, jobs, tmp_path)
+        await pipeline.review_candidates(
+            limit,
+            model,  # type: ignore[arg-type]
+            "a cat",
+            results,
+            on_chunk=lambda j, chunk: chunks.append((j, chunk)),
+        )
+        return results
+
+    chunks = []
+    results = asyncio.run(run())
+
+    assert sorted(generator.calls, key=str) == sorted(jobs, key=str)
+    assert [c.score for c in results] == [6, 9, None]
+    assert sorted(chunks) == [(0, "6/10"), (1, "Score: 9"), (2, "meh")]
+    assert pipeline.best_candidate(results).seed == 1
+
+
+def test_revise_candidates_drops_sibling_duplicates(tmp_path):
+    best = pipeline.Candidate("cat", None, tmp_path / "cat.png", "7/10", 7)
+    model = FakeModel(lambda prompt, attachments: "a red cat")
+
+    prompts = asyncio.run(
+        pipeline.revise_candidates(
+            asyncio.Semaphore(3),
+            model,  # type: ignore[arg-type]
+            "a cat",
+            best,
+            [],
+            3,
+        )
+    )
+
+    assert prompts == ["a red cat"]
+
+
+def test_phases_free_vram_once_per_phase(tmp_path):
+    generator = FakeGenerator(concurrency=2)
+    model = FakeModel(lambda prompt, attachments: "5/10" if attachments else "new")
+
+    async def run():
+        scheduler = pipeline.Scheduler(
+            generator, gen_concurrency=2, llm_concurrency=2, free_vram=True
+        )
+        return await asyncio.gather(
+            *(
+                pipeline.refine_chain(
+                    scheduler,
+                    model,  # type: ignore[arg-type]
+                    prompt,
+                    tmp_path,
+                    iterations=2,
+                    echo=lambda message: None,
+                )
+                for prompt in ["a", "b"]
+            )
+        )
+
+    chains = asyncio.run(run())
+
+    assert [len(chain) for chain in chains] == [2, 2]
+    assert len(generator.calls) == 4
+    assert generator.free_calls == 2
+
+
+def test_review_overlaps_other_prompts_render(tmp_path):
+    reviewing = threading.Event()
+
+    class BlockedGenerator(FakeGenerator):
+        async def agenerate_image(self, prompt, output_dir, **kwargs):
+            if prompt == "b":
+                # Only finishes if "a" is reviewed while "b" holds the GPU.
+                assert await asyncio.to_thread(reviewing.wait, 5)
+            return await super().agenerate_image(prompt, output_dir, **kwargs)
+
+    def respond(prompt, attachments):
+        if attachments:
+            reviewing.set()
+            return "5/10"
+        return "new"
+
+    async def run():
+        scheduler = pipeline.Scheduler(BlockedGenerator())
+        await asyncio.gather(
+            *(
+                pipeline.refine_chain(
+                    scheduler,
+                    FakeModel(respond),  # type: ignore[arg-type]
+                    prompt,
+                    tmp_path,
+                    iterations=1,
+                    echo=lambda message: None,
+                )
+                for prompt in ["a", "b"]
+            )
+        )
+
+    asyncio.run(run())
+
+
+def test_early_stopping(tmp_path):
+    def run(scores, **kwargs):
+        reviews = iter(scores)
+        revisions = iter(range(100))
+        model = FakeModel(
+            lambda prompt, attachments: (
+                next(reviews) if attachments else f"cat {next(revisions)}"
+            )
+        )
+        history = asyncio.run(
+            pipeline.refine_chain(
+                pipeline.Scheduler(FakeGenerator()),
+                model,  # type: ignore[arg-type]
+                "a cat",
+                tmp_path,
+                iterations=5,
+                echo=lambda message: None,
+                **kwargs,
+            )
+        )
+        return [iteration.best.score for iteration in history], history
+
+    scores, history = run(["6/10", '{"score": 9, "missing": []}'], target_score=9)
+    assert scores == [6, 9]
+    assert history[-1].refined_prompts == []
+
+    scores, _ = run(["6/10", "7/10", "5/10", "7/10", "9/10"], patience=2)
+    assert scores == [6, 7, 5, 7]
+
+    scores, _ = run(["looks ok", "looks ok", "6/10", "5/10"], patience=1)
+    assert scores == [None, None, 6, 5]
+
+
+def test_failed_render_cancels_its_siblings(tmp_path):
+    class FailingGenerator(FakeGenerator):
+        async def agenerate_image(self, prompt, output_dir, *, seed=None, **kwargs):
+            if seed is None:
+                raise RuntimeError("render failed")
+            await asyncio.sleep(5)
+            return await super().agenerate_image(prompt, output_dir, seed=seed)
+
+    async def run():
+        limit = pipeline.PriorityLimit(2)
+        with pytest.raises(RuntimeError, match="render failed"):
+            await pipeline.generate_candidates(
+                limit,
+                FailingGenerator(),
+                pipeline.candidate_jobs(["a cat"], 2),
+                tmp_path,
+            )
+        # The sibling render was cancelled and gave back its slot.
+        async with asyncio.timeout(1):
+            await limit.acquire()
+            await limit.acquire()
+
+    asyncio.run(run())
+
+
+def test_draft_mode_renders_only_the_best_prompt_in_full(tmp_path):
+    draft_generator = FakeGenerator()
+    generator = FakeGenerator()
+    reviews = iter(["6/10", "8/10", "8/10"])
+    revisions = iter(range(100))
+    finals = []
+    model = FakeModel(
+        lambda prompt, attachments: (
+            next(reviews) if attachments else f"cat {next(revisions)}"
+        )
+    )
+
+    history = asyncio.run(
+        pipeline.refine_chain(
+            pipeline.Scheduler(generator, draft_generator=draft_generator),
+            model,  # type: ignore[arg-type]
+            "a cat",
+            tmp_path,
+            iterations=3,
+            draft=pipeline.DraftSettings(steps=4, width=608, height=416),
+            echo=lambda message: None,
+            on_iteration=lambda i, iteration: finals.append((i, iteration.final)),
+        )
+    )
+
+    assert finals == [(0, None), (1, None), (2, None), (2, history[-1].final)]
+    assert [prompt for prompt, _ in draft_generator.calls] == [
+        "a cat",
+        "cat 0",
+        "cat 1",
+    ]
+    assert draft_generator.options == [{"steps": 4, "width": 608, "height": 416}] * 3
+    # Ties go to the later prompt.
+    assert generator.calls == [("cat 1", None)]
+    assert generator.options == [{}]
+    final = history[-1].final
+    assert final is not None and final.prompt == "cat 1" and final.image_path.exists()
+
+
+def test_draft_mode_rerenders_the_winning_batch_position(tmp_path):
+    draft_generator = FakeGenerator(batches=True)
+    generator = FakeGenerator(batches=True)
+    model = FakeModel(
+        lambda prompt, attachments: (
+            ("9/10" if "-b1_" in str(attachments[0].path) else "5/10")
+            if attachments
+            else "cat 0"
+        )
+    )
+
+    history = asyncio.run(
+        pipeline.refine_chain(
+            pipeline.Scheduler(generator, draft_generator=draft_generator),
+            model,  # type: ignore[arg-type]
+            "a cat",
+            tmp_path,
+            iterations=1,
+            candidates=3,
+            batch_size=3,
+            draft=pipeline.DraftSettings(steps=4, width=None, height=None),
+            echo=lambda message: None,
+        )
+    )
+
+    assert draft_generator.calls == [("a cat", None, 3)]
+    # Rendered up to the winner's position, and only the winner is kept.
+    assert generator.calls == [("a cat", None, 2)]
+    final = history[-1].final
+    assert final is not None and final.batch_index == 1
+    assert "-b1_" in final.image_path.name
+    # The draft's first image; the final one was discarded.
+    assert len(list(tmp_path.glob("fake-None-b0_*"))) == 1
+
+
+def test_fused_review_skips_revision_calls(tmp_path):
+    revisions = iter(range(100))
+
+    def respond(prompt, attachments):
+        if not attachments:
+            return "unused"
+        n = next(revisions)
+        # The second suggestion repeats the first prompt, so it is revised
+        # separately instead.
+        return json.dumps(
+            {
+                "present": [],
+                "missing": [],
+                "critique": "",
+                "score": 5,
+                "next_prompt": "A cat!" if n == 1 else f"cat {n}",
+            }
+        )
+
+    model = FakeModel(respond)
+    history = asyncio.run(
+        pipeline.refine_chain(
+            pipeline.Scheduler(FakeGenerator()),
+            model,  # type: ignore[arg-type]
+            "a cat",
+            tmp_path,
+            iterations=3,
+            fused=True,
+            echo=lambda message: None,
+        )
+    )
+
+    assert [iteration.refined_prompts for iteration in history] == [
+        ["cat 0"],
+        ["unused"],
+        ["cat 2"],
+    ]
+    assert sum(not attachments for _, attachments in model.prompts) == 1
+
+
+def test_async_model_reviews_chains_concurrently(tmp_path):
+    model = FakeAsyncModel(
+        lambda prompt, attachments: "5/10" if attachments else "a new cat", delay=0.01
+    )
+
+    async def run():
+        scheduler = pipeline.Scheduler(
+            FakeGenerator(concurrency=3), gen_concurrency=3, llm_concurrency=2
+        )
+        return await asyncio.gather(
+            *(
+                pipeline.refine_chain(
+                    scheduler,
+                    model,
+                    f"cat {i}",
+                    tmp_path,
+                    iterations=1,
+                    echo=lambda message: None,
+                )
+                for i in range(3)
+            )
+        )
+
+    histories = asyncio.run(run())
+
+    assert [history[0].refined_prompts for history in histories] == [["a new cat"]] * 3
+    assert model.max_active == 2
+
+
+def test_priority_limit_admits_highest_priority_first():
+    async def run():
+        limit = pipeline.PriorityLimit(1)
+        await limit.acquire()
+        order = []
+
+        async def wait(priority):
+            pipeline.priority.set(priority)
+            await limit.acquire()
+            order.append(priority)
+            limit.release()
+
+        waiters = [asyncio.create_task(wait(priority)) for priority in [0, 5, 1]]
+        cancelled = asyncio.create_task(wait(9))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        limit.release()
+        await asyncio.gather(*waiters)
+        return order
+
+    assert asyncio.run(run()) == [5, 1, 0]
+
+
+def test_priority_limit_reports_idle_once_all_slots_are_free():
+    async def run():
+        idle = []
+        limit = pipeline.PriorityLimit(2, on_idle=lambda: idle.append(True))
+        await limit.acquire()
+        await limit.acquire()
+        limit.release()
+        assert idle == []
+        limit.release()
+        return idle
+
+    assert asyncio.run(run()) == [True]
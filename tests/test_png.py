@@ -0,0 +1,22 @@
+from fake_comfyui import make_png
+from PIL import Image
+
+from perfect_prompt import png
+
+
+def test_append_text_in_place(tmp_path):
+    path = tmp_path / "image.png"
+    path.write_bytes(make_png())
+    png.append_text(path, {"prompt": '{"6": {}}', "model": "été ☀"})
+    png.append_text(path, {"prompt": "a cat", "score": "9"})
+
+    with Image.open(path) as image:
+        image.load()
+        assert image.getpixel((0, 0)) == (255, 0, 0)
+        # Existing keywords are kept.
+        assert image.text == {  # type: ignore[attr-defined]
+            "prompt": '{"6": {}}',
+            "model": "été ☀",
+            "score": "9",
+        }
+    assert path.read_bytes().endswith(png.IEND)
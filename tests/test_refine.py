@@ -1,4 +1,29 @@
-from perfect_prompt.refine import create_review_prompt, create_revision_prompt
+import asyncio
+import io
+
+import llm
+import llm_mistral
+import pytest
+from fake_comfyui import make_png
+from fakes import FakeAsyncModel, FakeModel
+from PIL import Image
+
+from perfect_prompt.cache import ResponseCache
+from perfect_prompt.refine import (
+    HistorySettings,
+    ReviewImageSettings,
+    areview_image,
+    create_review_prompt,
+    create_revision_prompt,
+    encode_review_image,
+    get_refine_model,
+    parse_fused,
+    parse_review,
+    parse_score,
+    review_and_revise,
+    review_image,
+    revise_prompt,
+)
 
 
 def test_review_prompt():
@@ -33,3 +58,203 @@ Write a new prompt to generate an image that captures all the elements of the or
         original_prompt, current_prompt, current_review, previous_pairs
     )
     assert actual == expected
+
+
+def test_revision_history_strategies():
+    attempts = [
+        (f"cat {i}", f"Score: {score}/10") for i, score in enumerate([3, 9, 5, 7])
+    ]
+
+    def shown(strategy, size=2):
+        prompt = create_revision_prompt(
+            "a cat", "cat 4", "Score: 1/10", attempts, HistorySettings(strategy, size)
+        )
+        return [line for line in prompt.splitlines() if line.startswith("Prompt #")]
+
+    assert len(shown("all")) == 10
+    assert shown("last") == [
+        "Prompt #4: cat 3",
+        "Prompt #4 review: Score: 7/10",
+        "Prompt #5: cat 4",
+        "Prompt #5 review: Score: 1/10",
+    ]
+    assert shown("best", 3) == [
+        "Prompt #2: cat 1",
+        "Prompt #2 review: Score: 9/10",
+        "Prompt #4: cat 3",
+        "Prompt #4 review: Score: 7/10",
+        "Prompt #5: cat 4",
+        "Prompt #5 review: Score: 1/10",
+    ]
+    assert shown("summary")[:3] == [
+        "Prompt #1 (score 3/10): cat 0",
+        "Prompt #2 (score 9/10): cat 1",
+        "Prompt #3 (score 5/10): cat 2",
+    ]
+    assert shown("summary")[3:] == shown("last")
+
+    # The next revision prompt starts with the whole of this one's summary.
+    previous = create_revision_prompt(
+        "a cat", "cat 3", "7/10", attempts[:3], HistorySettings("summary", 2)
+    )
+    current = create_revision_prompt(
+        "a cat", "cat 4", "1/10", attempts, HistorySettings("summary", 2)
+    )
+    prefix = previous[: previous.index("\n\nPrompt #3:")]
+    assert current.startswith(prefix)
+
+
+def test_revise_prompt_retries_near_duplicates():
+    responses = iter(["A red cat.", "a red cat on a chair"])
+    model = FakeModel(lambda prompt, attachments: next(responses))
+
+    messages = []
+    refined = revise_prompt(
+        model,  # type: ignore[arg-type]
+        "a cat",
+        "a red cat",
+        "6/10",
+        [],
+        echo=messages.append,
+    )
+
+    assert refined == "a red cat on a chair"
+    assert messages == ["Skipping prompt too similar to Prompt #1 (100%)"]
+    first, retry = (prompt for prompt, _ in model.prompts)
+    assert retry.startswith(first)
+    assert "A red cat.\n\nIt was rejected as too similar to Prompt #1" in retry
+
+
+def test_review_and_revise(tmp_path):
+    image_path = tmp_path / "cat.png"
+    image_path.write_bytes(make_png())
+    fused = (
+        '{"present": ["cat"], "missing": ["hat"], "critique": "Fine.", '
+        '"score": 6, "next_prompt": "a cat in a hat"}'
+    )
+    model = FakeModel(lambda prompt, attachments: fused)
+
+    text = review_and_revise(model, "a cat in a hat", "a cat", image_path, [])  # type: ignore[arg-type]
+
+    review, next_prompt = parse_fused(text)  # type: ignore[misc]
+    assert (review.score, review.missing, next_prompt) == (6, ["hat"], "a cat in a hat")
+    ((prompt, attachments),) = model.prompts
+    assert "generated from this prompt:\na cat\n" in prompt
+    assert attachments == [str(image_path)]
+
+    # Without a next prompt, the image is reviewed on its own.
+    responses = iter(['{"score": 6, "critique": "Fine."}', "7/10"])
+    model = FakeModel(lambda prompt, attachments: next(responses))
+    text = review_and_revise(model, "a cat in a hat", "a cat", image_path, [])  # type: ignore[arg-type]
+    assert text == "7/10"
+    assert parse_fused(text) is None
+    assert model.prompts[1][0] == create_review_prompt("a cat in a hat")
+
+
+def test_async_review_streams_and_stops_when_cancelled(tmp_path):
+    image_path = tmp_path / "cat.png"
+    image_path.write_bytes(make_png())
+    cache = ResponseCache(tmp_path / "llm.sqlite", 2**20)
+    model = FakeAsyncModel(lambda prompt, attachments: "Red cat. 7/10", delay=0.01)
+
+    async def run():
+        chunks = []
+        text = await areview_image(model, "a cat", image_path, on_chunk=chunks.append)
+        assert (text, chunks) == ("Red cat. 7/10", ["Red ", "cat. ", "7/10"])
+
+        task = asyncio.create_task(
+            areview_image(model, "a dog", image_path, cache=cache)
+        )
+        while not model.active:
+            await asyncio.sleep(0.001)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        # The partial answer wasn't cached.
+        await areview_image(model, "a dog", image_path, cache=cache)
+
+    asyncio.run(run())
+
+    assert (model.cancelled, model.active, len(model.prompts)) == (1, 0, 3)
+    assert (cache.hits, cache.misses) == (0, 2)
+
+
+def test_parse_score():
+    assert parse_score("Missing the chair. Overall score: 7/10") == 7
+    assert parse_score("The cat is 2/10 red... final score 8 out of 10") == 8
+    assert parse_score("**Score:** 6.5") == 6.5
+    assert parse_score("No score here, rated from 1 (worst) to 10") is None
+    assert parse_score("Overall score (1-10): 7") == 7
+    assert parse_score("Score (0 to 10): 4. Scored 1-10 by eye.") == 4
+
+
+def test_parse_review():
+    review = parse_review(
+        '```json\n{"present": ["cat"], "missing": ["blue chair"],'
+        ' "critique": "No chair.", "score": "6"}\n```'
+    )
+    assert (review.score, review.present, review.missing) == (
+        6,
+        ["cat"],
+        ["blue chair"],
+    )
+    assert str(review) == "Present: cat\nMissing: blue chair\nNo chair.\nScore: 6/10"
+
+    review = parse_review("The chair is {missing}. Score: 4/10")
+    assert review.score == 4
+    assert str(review) == "The chair is {missing}. Score: 4/10"
+
+
+def test_encode_review_image():
+    original = make_png(size=(200, 100))
+    assert encode_review_image(original, ReviewImageSettings()) == (
+        original,
+        "image/png",
+    )
+
+    content, mime_type = encode_review_image(
+        original, ReviewImageSettings(max_side=50, format="jpeg")
+    )
+    assert mime_type == "image/jpeg"
+    with Image.open(io.BytesIO(content)) as image:
+        assert (image.format, image.size) == ("JPEG", (50, 25))
+
+
+def test_review_sends_encoded_image(tmp_path):
+    image_path = tmp_path / "image.png"
+    image_path.write_bytes(make_png(size=(200, 100)))
+    sent = []
+
+    def respond(prompt, attachments):
+        sent.extend((a.type, len(a.content)) for a in attachments)
+        return "Score: 7"
+
+    settings = ReviewImageSettings(max_side=64, format="webp")
+    review_image(FakeModel(respond), "a cat", image_path, image_settings=settings)  # type: ignore[arg-type]
+
+    assert sent == [
+        ("image/webp", len(encode_review_image(image_path.read_bytes(), settings)[0]))
+    ]
+
+
+def test_get_refine_model_refreshes_only_unknown_models(monkeypatch):
+    known = {"ministral-3:14b": "ollama model"}
+    refreshes = []
+
+    def get_model(name):
+        if name not in known:
+            raise llm.UnknownModelError(name)
+        return known[name]
+
+    def refresh_models():
+        refreshes.append(True)
+        known["mistral-new"] = "mistral model"
+
+    monkeypatch.setattr(llm, "get_model", get_model)
+    monkeypatch.setattr(llm_mistral, "refresh_models", refresh_models)
+    monkeypatch.setenv("LLM_MISTRAL_KEY", "key")
+
+    assert get_refine_model("ministral-3:14b") == "ollama model"
+    assert refreshes == []
+    assert get_refine_model("mistral-new") == "mistral model"
+    assert refreshes == [True]
@@ -0,0 +1,157 @@
+import asyncio
+import itertools
+import json
+from contextlib import asynccontextmanager
+
+import httpx
+import pytest
+from click.testing import CliRunner
+from fakes import FakeGenerator, FakeModel
+
+from perfect_prompt import pipeline, refine, server
+from perfect_prompt import session as session_module
+from perfect_prompt.cli import cli
+from perfect_prompt.journal import JOURNAL_NAME
+from perfect_prompt.session import Session
+
+
+def make_session(tmp_path, generator):
+    revisions = itertools.count()
+    model = FakeModel(
+        lambda prompt, attachments: (
+            "Score: 6/10" if attachments else f"a cat, take {next(revisions)}"
+        )
+    )
+    return Session(
+        scheduler=pipeline.Scheduler(generator),
+        model=model,
+        journal=None,
+        image_cache=None,
+        llm_cache=None,
+        chain_kwargs={"iterations": 1},
+    )
+
+
+def test_serve_streams_job_progress(tmp_path):
+    session = make_session(tmp_path, FakeGenerator())
+
+    async def run():
+        async with (
+            server.serving(
+                session, tmp_path, host="127.0.0.1", port=0, concurrency=1
+            ) as url,
+            httpx.AsyncClient(base_url=url) as client,
+        ):
+            submitted = await client.post(
+                "/jobs", json={"id": "cat", "prompt": "a cat", "iterations": 2}
+            )
+            async with client.stream("GET", "/jobs/cat/events") as response:
+                events = [json.loads(line) async for line in response.aiter_lines()]
+            job = (await client.get("/jobs/cat")).json()
+            invalid = [
+                (await client.post("/jobs", json={"prompt": "a", **options}))
+                for options in [{"steps": 3}, {"iterations": 0}, {"target_score": 11}]
+            ]
+            duplicate = await client.post("/jobs", json={"id": "cat", "prompt": "a"})
+            missing = await client.get("/jobs/dog")
+            return submitted, events, job, invalid, duplicate, missing
+
+    submitted, events, job, invalid, duplicate, missing = asyncio.run(run())
+
+    assert submitted.status_code == 202
+    # Streamed reviews only show if the job was still running.
+    events = [event for event in events if event["type"] != "review_chunk"]
+    assert [event["type"] for event in events] == [
+        "queued",
+        "started",
+        "iteration",
+        "iteration",
+        "done",
+    ]
+    first = events[2]
+    assert first["score"] == 6
+    assert first["next_prompts"] == ["a cat, take 0"]
+    assert (tmp_path / "cat" / first["image_path"].rsplit("/", 1)[1]).exists()
+    assert job["status"] == "done"
+    assert job["result"]["final_score"] == 6
+    assert [response.status_code for response in invalid] == [400, 400, 400]
+    assert duplicate.status_code == 409
+    assert missing.status_code == 404
+
+
+def test_review_chunks_are_dropped_when_a_job_finishes():
+    job = server.Job("cat", "a cat", 0, {})
+    job.emit({"type": "started"}, "running")
+    job.emit({"type": "review_chunk", "text": "Score: 6"})
+    follower = job.follow()
+    assert next(follower)["type"] == "started"
+    job.emit({"type": "done"}, "done")
+
+    assert [event["type"] for event in follower] == ["review_chunk", "done"]
+    assert [event["type"] for event in job.follow()] == ["started", "done"]
+
+
+def test_jobs_run_by_priority(tmp_path):
+    generator = FakeGenerator()
+    session = make_session(tmp_path, generator)
+
+    async def run():
+        jobs = server.JobQueue(session, tmp_path, concurrency=1)
+        for id, priority in [("low", 0), ("high", 5), ("gone", 9)]:
+            jobs.submit({"id": id, "prompt": id, "priority": priority})
+        jobs.cancel(jobs.jobs["gone"])
+        workers = asyncio.create_task(jobs.run())
+        while any(job.status not in server.FINISHED for job in jobs.jobs.values()):
+            await asyncio.sleep(0.01)
+        workers.cancel()
+        return jobs
+
+    jobs = asyncio.run(run())
+
+    assert generator.calls == [("high", None), ("low", None)]
+    assert {id: job.status for id, job in jobs.jobs.items()} == {
+        "low": "done",
+        "high": "done",
+        "gone": "cancelled",
+    }
+
+
+def test_resubmitted_job_must_keep_its_prompt(tmp_path):
+    session = make_session(tmp_path, FakeGenerator())
+
+    async def run():
+        jobs = server.JobQueue(session, tmp_path, concurrency=1, resume=True)
+        jobs.submit({"id": "cat", "prompt": "a cat"})
+        workers = asyncio.create_task(jobs.run())
+        while jobs.jobs["cat"].status not in server.FINISHED:
+            await asyncio.sleep(0.01)
+        workers.cancel()
+
+    asyncio.run(run())
+
+    # As after a restart with --resume.
+    jobs = server.JobQueue(session, tmp_path, concurrency=1, resume=True)
+    with pytest.raises(server.JobConflict):
+        jobs.submit({"id": "cat", "prompt": "a dog"})
+    assert jobs.submit({"id": "cat", "prompt": "a cat"}).status == "queued"
+
+
+def test_serve_leaves_an_earlier_runs_journal_alone(tmp_path, monkeypatch):
+    journal = tmp_path / JOURNAL_NAME
+    journal.write_text('{"chain": "1", "step": "done", "value": null}\n')
+    model = FakeModel(lambda prompt, attachments: "Score: 5")
+    monkeypatch.setattr(
+        session_module, "get_generator", lambda name, **_: FakeGenerator()
+    )
+    monkeypatch.setattr(refine, "get_refine_model", lambda name, **kwargs: model)
+
+    @asynccontextmanager
+    async def serving(*args, **kwargs):
+        raise OSError("address in use")
+        yield
+
+    monkeypatch.setattr(server, "serving", serving)
+    result = CliRunner().invoke(cli, ["serve", "-o", str(tmp_path)])
+
+    assert "address in use" in result.output
+    assert journal.read_text() == '{"chain": "1", "step": "done", "value": null}\n'
@@ -0,0 +1,25 @@
+from perfect_prompt.similarity import PromptIndex, shingles, similarity
+
+
+def test_rewordings_are_duplicates():
+    a = shingles("A red cat, sitting on a blue chair. Soft light")
+    assert a == shingles("soft light; a red cat, sitting on a blue chair!")
+    assert similarity(a, shingles("A blue cat, sitting on a red chair")) < 0.5
+
+
+def test_prompt_index():
+    index = PromptIndex(0.8)
+    index.add(
+        "a red cat sitting on a blue chair in a sunny kitchen, soft morning light",
+        "Prompt #1",
+    )
+    index.add("a dog in the snow", "Prompt #2")
+
+    assert index.match("A dog in the snow.") == ("Prompt #2", 1.0)
+    label, score = index.match(  # type: ignore[misc]
+        "soft morning light, a red cat sitting on a blue chair in a sunny kitchen"
+        " with tiles"
+    )
+    assert label == "Prompt #1"
+    assert 0.8 <= score < 1
+    assert index.match("a cat made of glass") is None
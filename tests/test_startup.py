@@ -0,0 +1,36 @@
+import re
+import subprocess
+import sys
+
+# Backends and plugins that `--help` and `--version` must not pay for.
+HEAVY_MODULES = ["llm", "llm_mistral", "httpx", "PIL", "websockets", "dotenv"]
+
+
+def import_times(code: str) -> dict[str, int]:
+    # Cumulative microseconds per module, from `python -X importtime`.
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        match = re.match(r"import time:\s+\d+ \|\s+(\d+) \|\s+(\S+)", line)
+        if match:
+            times[match[2].strip()] = int(match[1])
+    return times
+
+
+def test_version_imports_no_backends():
+    times = import_times(
+        "from perfect_prompt.cli import cli\n"
+        "try:\n"
+        "    cli(['--version'])\n"
+        "except SystemExit:\n"
+        "    pass\n"
+    )
+
+    assert [module for module in HEAVY_MODULES if module in times] == []
+    # Measured against click itself so the bound holds on slow machines too.
+    assert times["perfect_prompt.cli"] < 5 * times["click"], times